@@ -0,0 +1,109 @@
+import sys
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import setupDatabaseTables
+
+
+def compactHistory(db, batchsize=500):
+    """Collapse consecutive ProductHistory rows with the same rank, offers, Prime, price and merchant into a single row
+    whose ValidUntil is the time of the last of them. Products are processed ``batchsize`` at a time, each batch in
+    it's own transaction. Returns the number of rows removed."""
+    q = QSqlQuery(db)
+    q.setForwardOnly(True)
+    q.exec_('SELECT DISTINCT Asin FROM ProductHistory')
+
+    asins = []
+    while q.next():
+        asins.append(q.value(0))
+
+    read = QSqlQuery(db)
+    read.setForwardOnly(True)
+    read.prepare('SELECT rowid, Timestamp, ValidUntil, SalesRank, Offers, Prime, Price, MerchantName '
+                 'FROM ProductHistory WHERE Asin=? ORDER BY Timestamp ASC')
+
+    extend = QSqlQuery(db)
+    extend.prepare('UPDATE ProductHistory SET ValidUntil=? WHERE rowid=?')
+
+    remove = QSqlQuery(db)
+    remove.prepare('DELETE FROM ProductHistory WHERE rowid=?')
+
+    removed = 0
+
+    for start in range(0, len(asins), batchsize):
+        extendIds, extendTimes, removeIds = [], [], []
+
+        for asin in asins[start:start + batchsize]:
+            read.addBindValue(asin)
+            read.exec_()
+
+            # The current run: [rowid, values, ValidUntil as stored, ValidUntil after collapsing]
+            run = None
+            while read.next():
+                rowid = read.value(0)
+                until = read.value(2) or read.value(1)
+                values = [read.value(column) for column in range(3, 8)]
+
+                if run and values == run[1]:
+                    run[3] = max(run[3], until)
+                    removeIds.append(rowid)
+                    continue
+
+                if run and run[3] != run[2]:
+                    extendIds.append(run[0])
+                    extendTimes.append(run[3])
+
+                run = [rowid, values, read.value(2), until]
+
+            if run and run[3] != run[2]:
+                extendIds.append(run[0])
+                extendTimes.append(run[3])
+
+        db.transaction()
+
+        if extendIds:
+            extend.addBindValue(extendTimes)
+            extend.addBindValue(extendIds)
+            extend.execBatch()
+
+        if removeIds:
+            remove.addBindValue(removeIds)
+            remove.execBatch()
+
+        if not db.commit():
+            print('Could not compact history: ' + db.lastError().text())
+            db.rollback()
+            return removed
+
+        removed += len(removeIds)
+        print('Compacted {} of {} products, {:,} rows removed so far'.format(
+            min(start + batchsize, len(asins)), len(asins), removed))
+
+    return removed
+
+
+if __name__ == '__main__':
+    app = QCoreApplication(sys.argv)
+
+    # Open the database file. Don't run this while ProductFinder is writing to it.
+    database = QSqlDatabase.addDatabase('QSQLITE')
+    database.setDatabaseName(sys.argv[1] if len(sys.argv) > 1 else 'products.db')
+    database.open()
+
+    err = setupDatabaseTables()
+    if err.type() != QSqlError.NoError:
+        print('Unable to update database: ' + err.text())
+        sys.exit(1)
+
+    removed = compactHistory(database)
+    print('Done. {:,} duplicate history rows removed.'.format(removed))
+
+    if removed:
+        print('Reclaiming space...')
+        QSqlQuery('VACUUM', database)
+
+        # VACUUM may have renumbered the products, which the search index refers to by rowid
+        QSqlQuery("INSERT INTO ProductsSearch(ProductsSearch) VALUES('rebuild')", database)
+
+    app.exit()
@@ -0,0 +1,185 @@
+import numpy as np
+
+from PyQt5.QtCore import *
+from PyQt5.QtChart import *
+from PyQt5.QtGui import *
+from PyQt5.QtSql import *
+
+from downsample import MinMaxPyramid
+from historychart import ZoomableChart, toPoints
+from maintenance import ROLLUP_TABLES
+from productsmodel import readRows
+
+
+class ComparisonRequest(object):
+    """A request for the whole rank and price history of each of ``asins``, for ProductComparisonChart. It is loaded
+    by a HistoryLoader, which sends it back with a min/max pyramid of each product's ranks and prices."""
+
+    def __init__(self, generation, asins):
+        self.generation = generation
+        self.asins = list(asins)
+        self.titles = {}
+        self.ranks = {asin: MinMaxPyramid() for asin in self.asins}
+        self.prices = {asin: MinMaxPyramid() for asin in self.asins}
+
+    def load(self, db, store=None):
+        """Read the history of each product from the HistoryStore ``store`` for the times it covers, if it has the
+        product, and the rest with a single query of ``db`` covering the raw observations and the rollup tables."""
+        q = QSqlQuery(db)
+        q.setForwardOnly(True)
+        q.prepare('SELECT Asin, Title FROM Products WHERE Asin IN ({})'.format(', '.join('?' * len(self.asins))))
+        for asin in self.asins:
+            q.addBindValue(asin)
+        q.exec_()
+        self.titles = dict(readRows(q, 2))
+
+        # The store may have been started after the database, so history older than it's first run comes from the
+        # database
+        series = {asin: store.series(asin) if store is not None else None for asin in self.asins}
+        before = {asin: int(series[asin].time[0]) if series[asin] is not None else None for asin in self.asins}
+
+        self.loadDatabase(q, before)
+
+        for asin in self.asins:
+            if series[asin] is not None:
+                self.addRuns(asin, series[asin].time, series[asin].until, series[asin].rank, series[asin].price)
+
+    def loadDatabase(self, q, before):
+        """Read the history of each product in ``before`` from ProductHistory and the rollup tables, which hold
+        disjoint spans of time, in one query ordered by product and time. Only history older than the product's time
+        in ``before`` is read, or all of it if that is None."""
+        wanted = 'WITH Wanted(Asin, Before) AS (VALUES {}) '.format(', '.join(['(?, ?)'] * len(before)))
+        end = 'IFNULL(ValidUntil, Timestamp)'
+        selects = ['SELECT Asin, Timestamp, MIN({0}, IFNULL(Before, {0})), SalesRank, Price FROM ProductHistory '
+                   'JOIN Wanted USING (Asin) WHERE Before IS NULL OR Timestamp<Before'.format(end)]
+        selects += ['SELECT Asin, Bucket, Bucket, AvgRank, AvgPrice FROM {} JOIN Wanted USING (Asin) '
+                    'WHERE Before IS NULL OR Bucket<Before'.format(table) for table, size in ROLLUP_TABLES]
+
+        q.prepare(wanted + ' UNION ALL '.join(selects) + ' ORDER BY 1, 2')
+        for asin, time in before.items():
+            q.addBindValue(asin)
+            q.addBindValue(time)
+
+        if not q.exec_():
+            print('ComparisonRequest: Could not load product history: ' + q.lastError().text())
+            return
+
+        rows = readRows(q, 5)
+        if not rows:
+            return
+
+        # Split the rows where the ASIN changes, and load each product's share of the columns in one go
+        products = [row[0] for row in rows]
+        columns = np.array([row[1:] for row in rows], dtype=float)
+        starts = [0] + [i for i in range(1, len(products)) if products[i] != products[i - 1]] + [len(products)]
+
+        for first, last in zip(starts[:-1], starts[1:]):
+            self.addRuns(products[first], *columns[first:last].T)
+
+    def addRuns(self, asin, start, end, rank, price):
+        """Add runs of identical observations from ``start`` to ``end`` (seconds since the epoch, UTC, oldest first)
+        to the pyramids of ``asin``, with a point at each end of each run."""
+        start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+        keep = np.column_stack([np.ones(len(start), dtype=bool), end > start]).ravel()
+        times = np.column_stack([start, end]).ravel()[keep] * 1000
+
+        self.ranks[asin].extend(times, np.repeat(np.asarray(rank, dtype=float), 2)[keep])
+        self.prices[asin].extend(times, np.repeat(np.asarray(price, dtype=float), 2)[keep])
+
+
+class ProductComparisonChart(ZoomableChart):
+    """Overlays the sales rank and price history of several products, so a variation family or a set of competitors
+    can be compared. Each product has it's own colour, with rank as a solid line and price as a dashed one."""
+
+    def __init__(self, parent=None):
+        super(ProductComparisonChart, self).__init__(parent)
+
+        self.rankAxis = QValueAxis()
+        self.rankAxis.setLabelFormat('%\'i')
+        self.rankAxis.setTitleText('Sales Rank (solid)')
+        self.addAxis(self.rankAxis, Qt.AlignLeft)
+
+        self.priceAxis = QValueAxis()
+        self.priceAxis.setLabelFormat('$%.2f')
+        self.priceAxis.setTitleText('Price (dashed)')
+        self.addAxis(self.priceAxis, Qt.AlignRight)
+
+        self.legend().setAlignment(Qt.AlignBottom)
+
+        self.timeAxis.rangeChanged.connect(self.updateSeries)
+        self.plotAreaChanged.connect(self.updateSeries)
+
+        self.loader = None
+        self.generation = 0
+        self.asins = []
+        self.lines = []     # (rank line, price line) for each product
+        self.pyramids = []  # (rank pyramid, price pyramid) for each product
+
+    def setHistoryLoader(self, loader):
+        self.loader = loader
+        self.loader.ready.connect(self.historyLoaded)
+
+    def setProducts(self, asins):
+        """Show the history of ``asins``, which is loaded in the background."""
+        self.generation += 1
+        self.asins = list(asins)
+
+        self.removeAllSeries()
+        self.lines = []
+        self.pyramids = []
+        self.resetAxes()
+        self.showPlaceholder(True)
+
+        if self.asins:
+            self.loader.submit(ComparisonRequest(self.generation, self.asins))
+
+    @pyqtSlot(object)
+    def historyLoaded(self, request):
+        if request.generation != self.generation:
+            return
+
+        # Spread the colours around the hue circle, so neighbours stay distinct however many products there are
+        lines = []
+        for i, asin in enumerate(request.asins):
+            color = QColor.fromHsvF((i * 0.618034) % 1, 0.85, 0.85)
+
+            rankLine = QLineSeries()
+            rankLine.setName(request.titles.get(asin) or asin)
+            rankLine.setPen(QPen(color, 1.5))
+
+            priceLine = QLineSeries()
+            priceLine.setPen(QPen(color, 1.5, Qt.DashLine))
+
+            for line, axis in [(rankLine, self.rankAxis), (priceLine, self.priceAxis)]:
+                self.addSeries(line)
+                line.attachAxis(self.timeAxis)
+                line.attachAxis(axis)
+
+            # One legend entry per product
+            self.legend().markers(priceLine)[0].setVisible(False)
+            lines.append((rankLine, priceLine))
+
+        # Only draw the lines once they are all added and the axes fit them, rather than each time the legend grows or
+        # an axis changes
+        self.showPlaceholder(False)
+        self.pyramids = [(request.ranks[asin], request.prices[asin]) for asin in request.asins]
+        self.resetAxes()
+        self.lines = lines
+        self.updateSeries()
+
+    @pyqtSlot()
+    def updateSeries(self):
+        """Redraw each line with about as many points as the plot area is wide, from the pyramids."""
+        lo = self.timeAxis.min().toMSecsSinceEpoch()
+        hi = self.timeAxis.max().toMSecsSinceEpoch()
+        budget = self.pointBudget()
+
+        for (rankLine, priceLine), (ranks, prices) in zip(self.lines, self.pyramids):
+            for line, pyramid in [(rankLine, ranks), (priceLine, prices)]:
+                x, y = pyramid.points(lo, hi, budget)
+                visible = ~np.isnan(y)
+                line.replace(toPoints(x[visible], y[visible]))
+
+    def axisScales(self):
+        return [(self.rankAxis, [ranks for ranks, prices in self.pyramids], 1000, 1000),
+                (self.priceAxis, [prices for ranks, prices in self.pyramids], 5, 5)]
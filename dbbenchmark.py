@@ -0,0 +1,120 @@
+import sys
+import os
+import json
+import random
+import tempfile
+import argparse
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import setupDatabaseTables, applyDatabaseProfile, DEFAULT_DATABASE_PROFILE
+from dbwriter import DatabaseWriter
+from searchamazon import ListingData
+
+
+def randomListing(asin):
+    listing = ListingData()
+    listing.asin = asin
+    listing.productgroup = 'Group {}'.format(random.randint(1, 20))
+    listing.merchant = 'Merchant {}'.format(random.randint(1, 200))
+    listing.title = 'Benchmark product {}'.format(asin)
+    listing.make = 'Brand {}'.format(random.randint(1, 500))
+    listing.salesrank = random.randint(1, 1000000)
+    listing.offers = random.randint(0, 30)
+    listing.prime = random.random() < 0.5
+    listing.price = round(random.uniform(5, 200), 2)
+    return listing
+
+
+def benchmarkIngest(filename, profile, asins, batchsize):
+    """Write ``asins`` through a DatabaseWriter in batches of ``batchsize``. Returns listings per second."""
+    writer = DatabaseWriter(filename, connection='benchmark_writer', profile=profile)
+    writer.message.connect(print, Qt.DirectConnection)
+
+    timer = QElapsedTimer()
+    timer.start()
+
+    for start in range(0, len(asins), batchsize):
+        writer.write([randomListing(asin) for asin in asins[start:start + batchsize]])
+
+    writer.stop()
+    writer.wait()
+
+    return len(asins) / max(timer.elapsed(), 1) * 1000
+
+
+def benchmarkQueries(db, asins, repeat):
+    """Run some typical read queries ``repeat`` times each. Returns a dict of query name -> queries per second."""
+    queries = {
+        'filter by CRank and price': ('SELECT Asin FROM Products WHERE CRank <= ? AND Price >= ? ORDER BY CRank LIMIT 256',
+                                      lambda: [random.randint(1000, 100000), random.uniform(5, 50)]),
+        'tracked products': ('SELECT Asin FROM Products WHERE Tracking = ? ORDER BY Timestamp ASC',
+                             lambda: [1]),
+        'product history': ('SELECT * FROM ProductHistory WHERE Asin = ? ORDER BY Timestamp DESC',
+                            lambda: [random.choice(asins)]),
+    }
+
+    results = {}
+    q = QSqlQuery(db)
+    q.setForwardOnly(True)
+
+    for name, (statement, params) in queries.items():
+        q.prepare(statement)
+
+        timer = QElapsedTimer()
+        timer.start()
+
+        for i in range(repeat):
+            for value in params():
+                q.addBindValue(value)
+            q.exec_()
+            while q.next():
+                pass
+
+        results[name] = repeat / max(timer.elapsed(), 1) * 1000
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure ingest and query throughput for a database profile.')
+    parser.add_argument('--config', default='config.json', help='config file with an optional "database" section')
+    parser.add_argument('--listings', type=int, default=20000, help='number of distinct listings to write')
+    parser.add_argument('--batch', type=int, default=10, help='listings per batch')
+    parser.add_argument('--queries', type=int, default=500, help='repetitions of each read query')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+
+    profile = {}
+    if os.path.exists(args.config):
+        with open(args.config) as configfile:
+            profile = json.load(configfile).get('database', {})
+
+    settings = dict(DEFAULT_DATABASE_PROFILE)
+    settings.update(profile)
+    print('Profile: ' + ', '.join('{}={}'.format(k, v) for k, v in settings.items()))
+
+    # Benchmark against a scratch database, never the real one
+    filename = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+
+    database = QSqlDatabase.addDatabase('QSQLITE')
+    database.setDatabaseName(filename)
+    database.open()
+    applyDatabaseProfile(database, profile)
+    setupDatabaseTables()
+
+    asins = ['B{:09d}'.format(n) for n in range(args.listings)]
+
+    rate = benchmarkIngest(filename, profile, asins, args.batch)
+    print('{:<40}{:10,.0f} listings/s'.format('Ingest (new listings):', rate))
+
+    rate = benchmarkIngest(filename, profile, asins, args.batch)
+    print('{:<40}{:10,.0f} listings/s'.format('Ingest (updated listings):', rate))
+
+    for name, rate in benchmarkQueries(database, asins, args.queries).items():
+        print('{:<40}{:10,.0f} queries/s'.format('Query ({}):'.format(name), rate))
+
+    database.close()
+    app.exit()
@@ -0,0 +1,84 @@
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+
+class LookupCache(QObject):
+    """Write-through cache of the small lookup tables: product group and merchant names to their IDs, and product group
+    IDs to their category. It doesn't watch the tables itself, as notifications on a connection without an event loop
+    are never delivered. Instead MainWindow forwards ProductGroups and Categories notifications from the GUI connection
+    to DatabaseWriter.invalidateCaches(), which has the writer call invalidate() before it's next batch."""
+
+    def __init__(self, connection='qt_sql_default_connection', parent=None):
+        super(LookupCache, self).__init__(parent)
+        self.connection = connection
+        self.loaded = False
+
+        self.groups = {}            # ProductGroupName -> (ProductGroupId, CategoryId)
+        self.merchants = {}         # MerchantName -> MerchantId
+
+    def invalidate(self):
+        """Drop all cached values. They will be reloaded on the next lookup."""
+        self.loaded = False
+        self.groups.clear()
+        self.merchants.clear()
+
+    def load(self):
+        """Read the lookup tables into memory."""
+        db = QSqlDatabase.database(self.connection)
+
+        q = QSqlQuery('SELECT ProductGroupName, ProductGroupId, CategoryId FROM ProductGroups', db)
+        while q.next():
+            self.groups[q.value(0)] = (q.value(1), q.value(2))
+
+        q = QSqlQuery('SELECT MerchantName, MerchantId FROM Merchants', db)
+        while q.next():
+            self.merchants[q.value(0)] = q.value(1)
+
+        self.loaded = True
+
+    def productGroup(self, name):
+        """Return (ProductGroupId, CategoryId) for the product group called ``name``, adding it if necessary."""
+        if not self.loaded:
+            self.load()
+
+        if name not in self.groups:
+            db = QSqlDatabase.database(self.connection)
+            q = QSqlQuery(db)
+            q.prepare('INSERT OR IGNORE INTO ProductGroups(ProductGroupName) VALUES(?)')
+            q.addBindValue(name)
+            q.exec_()
+
+            q.prepare('SELECT ProductGroupId, CategoryId FROM ProductGroups WHERE ProductGroupName=?')
+            q.addBindValue(name)
+            q.exec_()
+            if not q.first():
+                print('Could not add product group: ' + q.lastError().text())
+                return None, None
+
+            self.groups[name] = (q.value(0), q.value(1))
+
+        return self.groups[name]
+
+    def merchantId(self, name):
+        """Return the MerchantId for ``name``, adding the merchant if necessary."""
+        if not self.loaded:
+            self.load()
+
+        if name not in self.merchants:
+            db = QSqlDatabase.database(self.connection)
+            q = QSqlQuery(db)
+            q.prepare('INSERT OR IGNORE INTO Merchants(MerchantName) VALUES(?)')
+            q.addBindValue(name)
+            q.exec_()
+
+            q.prepare('SELECT MerchantId FROM Merchants WHERE MerchantName=?')
+            q.addBindValue(name)
+            q.exec_()
+            if not q.first():
+                print('Could not add merchant: ' + q.lastError().text())
+                return None
+
+            self.merchants[name] = q.value(0)
+
+        return self.merchants[name]
+
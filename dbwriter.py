@@ -0,0 +1,178 @@
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from dbcache import LookupCache
+from initdb import applyDatabaseProfile
+from privatelabel import PrivateLabelClassifier
+from scoring import computeScores, writeScores
+
+
+class DatabaseWriter(QThread):
+    """Writes listings to the database on it's own thread and connection, so that slow commits don't block the GUI.
+    Batches that arrive while a commit is in progress are written together in the next transaction."""
+
+    committed = pyqtSignal(list)
+    message = pyqtSignal(str)
+
+    def __init__(self, filename, connection='writer', profile=None, store=None, parent=None):
+        super(DatabaseWriter, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.store = store
+        self.classifier = PrivateLabelClassifier()
+        self.connection = connection
+        self.quitting = False
+        self.stale = False
+        self.pending = []
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+
+    @pyqtSlot(list)
+    def write(self, listings):
+        """Queue a batch of listings to be written to the database. Safe to call from any thread."""
+        self.mutex.lock()
+        self.pending.append(listings)
+        self.mutex.unlock()
+
+        if not self.isRunning():
+            self.start()
+        else:
+            self.condition.wakeOne()
+
+    @pyqtSlot()
+    @pyqtSlot(str)
+    def invalidateCaches(self, name=None):
+        """Have the writer reload it's lookup tables before writing the next batch."""
+        self.mutex.lock()
+        self.stale = True
+        self.mutex.unlock()
+
+    def stop(self):
+        """Write any pending listings, then close the connection and end the thread."""
+        self.mutex.lock()
+        self.quitting = True
+        self.mutex.unlock()
+        self.condition.wakeOne()
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+        if not db.open():
+            self.message.emit('Database writer could not open database: ' + db.lastError().text())
+            return
+
+        applyDatabaseProfile(db, self.profile)
+        self.lookups = LookupCache(self.connection)
+
+        while True:
+            self.mutex.lock()
+            if not self.pending and not self.quitting:
+                self.condition.wait(self.mutex)
+
+            batches = self.pending
+            self.pending = []
+            stale, self.stale = self.stale, False
+            quitting = self.quitting
+            self.mutex.unlock()
+
+            if stale:
+                self.lookups.invalidate()
+
+            listings = [listing for batch in batches for listing in batch]
+            if listings:
+                self._ingest(db, listings)
+
+            if quitting:
+                break
+
+        del self.lookups
+        db.close()
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+    def _ingest(self, db, listings):
+        """Insert or update ``listings`` in a single transaction."""
+        db.transaction()
+
+        # Insert new products, or update the market data of existing ones in place. The values the user sets (Tracking,
+        # MyPrice, MyCost, FBAFees, MonthlyVolume) are left alone, and the History_* triggers record the new market
+        # data in ProductHistory. CRank is computed with the other scores once the batch is written.
+        upsert = QSqlQuery(db)
+        upsert.prepare(
+            'INSERT INTO Products(Tracking, CRank, Timestamp, Asin, ProductGroupId, CategoryId, SalesRank, Offers,'
+            'Prime, Price, MerchantId, Title, Url, PrivateLabel, Manufacturer, PartNumber, Weight, ItemLength,'
+            'ItemWidth, ItemHeight, MyPrice, MyCost, FBAFees, MonthlyVolume, UPC) '
+            'VALUES(0, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0, 0, ?) '
+            'ON CONFLICT(Asin) DO UPDATE SET '
+            'Timestamp=excluded.Timestamp, ProductGroupId=excluded.ProductGroupId, '
+            'CategoryId=excluded.CategoryId, SalesRank=excluded.SalesRank, Offers=excluded.Offers, '
+            'Prime=excluded.Prime, Price=excluded.Price, MerchantId=excluded.MerchantId, Title=excluded.Title, '
+            'Url=excluded.Url, PrivateLabel=excluded.PrivateLabel, Manufacturer=excluded.Manufacturer, '
+            'PartNumber=excluded.PartNumber, Weight=excluded.Weight, ItemLength=excluded.ItemLength, '
+            'ItemWidth=excluded.ItemWidth, ItemHeight=excluded.ItemHeight, UPC=excluded.UPC')
+
+        time = QDateTime.currentDateTimeUtc().toTime_t()
+        privatelabels = self.classifier.classify(listings)
+
+        for listing, privatelabel in zip(listings, privatelabels):
+            # Look up (or add) the product group, it's category association, and the merchant
+            productgroupId, categoryId = self.lookups.productGroup(listing.productgroup)
+            merchantId = self.lookups.merchantId(listing.merchant)
+
+            fields = [time, listing.asin, productgroupId, categoryId, listing.salesrank, listing.offers,
+                      listing.prime, listing.price, merchantId, listing.title, listing.url, privatelabel,
+                      listing.make, listing.model, listing.weight / 100, listing.length / 100,
+                      listing.width / 100, listing.height / 100, listing.upc]
+
+            for field in fields:
+                upsert.addBindValue(field)
+
+            if not upsert.exec_():
+                self.message.emit('Could not insert record: ' + upsert.lastError().text())
+
+        # Bring CRank and the other scores up to date with the new market data
+        catalog, scores, changed = computeScores(db, [listing.asin for listing in listings])
+        err = writeScores(db, catalog, scores, changed)
+        if err.type() != QSqlError.NoError:
+            self.message.emit('Could not update scores: ' + err.text())
+
+        # The History_* triggers decide where each product's runs start, and the history store follows them
+        newruns = self.newRuns(db, [listing.asin for listing in listings], time) if self.store is not None else None
+
+        if not db.commit():
+            self.message.emit('Could not commit listings: ' + db.lastError().text())
+            db.rollback()
+            self.lookups.invalidate()
+            return
+
+        # Keep the columnar history store, if there is one, in step with the database
+        if self.store is not None:
+            try:
+                self.store.appendListings(listings, time, newruns)
+            except OSError as e:
+                self.message.emit('Could not update history store: ' + str(e))
+
+        self.committed.emit([listing.asin for listing in listings])
+
+    def newRuns(self, db, asins, time, batchsize=500):
+        """Return the set of ``asins`` that a new ProductHistory row was started for at ``time``."""
+        q = QSqlQuery(db)
+        q.setForwardOnly(True)
+        asins = sorted(set(asins))
+        started = set()
+
+        for start in range(0, len(asins), batchsize):
+            batch = asins[start:start + batchsize]
+            q.prepare('SELECT Asin FROM ProductHistory WHERE Timestamp=? AND Asin IN ({})'.format(
+                ', '.join('?' * len(batch))))
+            q.addBindValue(time)
+            for asin in batch:
+                q.addBindValue(asin)
+            q.exec_()
+
+            while q.next():
+                started.add(q.value(0))
+
+        return started
@@ -0,0 +1,149 @@
+import numpy as np
+
+
+def steps(x, y):
+    """Return the corners of a step line through (x, y), where each value holds until the next point."""
+    if len(x) < 2:
+        return x, y
+    return np.repeat(x, 2)[1:], np.repeat(y, 2)[:-1]
+
+
+def firstMatches(extremes, values, times, starts):
+    """Return, for each run of ``values`` beginning at ``starts``, the time of the first value equal to the run's
+    extreme. Runs that are all NaN use their first time."""
+    if len(starts) == len(values):
+        return times
+
+    expected = np.repeat(extremes, np.diff(np.r_[starts, len(values)]))
+    hits = np.flatnonzero((values == expected) | np.isnan(expected))
+    runs = np.searchsorted(starts, hits, side='right')
+    return times[hits[np.r_[True, runs[1:] != runs[:-1]]]]
+
+
+def summarize(ids, tmin, vmin, tmax, vmax):
+    """Combine consecutive entries with the same bucket id, keeping the minimum and maximum of each bucket and when
+    they occurred. Returns (ids, tmin, vmin, tmax, vmax) with one entry per bucket."""
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+    lows = np.fmin.reduceat(vmin, starts)
+    highs = np.fmax.reduceat(vmax, starts)
+    return (ids[starts], firstMatches(lows, vmin, tmin, starts), lows,
+            firstMatches(highs, vmax, tmax, starts), highs)
+
+
+class MinMaxPyramid(object):
+    """A time series, with the minimum and maximum of it over buckets of ``width`` milliseconds, ``factor`` times
+    that, ``factor`` squared times that and so on up to a single bucket. Any range can be drawn with a bounded number
+    of points by picking the finest level that fits and slicing it, and peaks and troughs are never lost. Buckets are
+    aligned to the epoch, so the series can be extended at either end without rebuilding the levels."""
+
+    def __init__(self, width=60000, factor=4):
+        self.width = width
+        self.factor = factor
+        self.time = np.empty(0)
+        self.value = np.empty(0)
+        self.levels = []    # (ids, tmin, vmin, tmax, vmax) for buckets of width * factor**depth
+
+    def __len__(self):
+        return len(self.time)
+
+    def bucketWidth(self, depth):
+        return self.width * self.factor ** depth
+
+    def bucketIds(self, summary, depth):
+        """Return the bucket ids at ``depth`` of the entries of ``summary``, which is the level below it, or the raw
+        points as (time, time, value, time, value) when ``depth`` is 0."""
+        if depth:
+            return summary[0] // self.factor
+        return (summary[0] // self.width).astype(np.int64)
+
+    def extend(self, time, value):
+        """Add points that are all older, or all newer, than the ones already in the series. ``time`` must be
+        sorted."""
+        chunk = MinMaxPyramid(self.width, self.factor)
+        chunk.time = np.asarray(time, dtype=float)
+        chunk.value = np.asarray(value, dtype=float)
+        chunk.buildLevels()
+        self.join(chunk)
+
+    def copy(self):
+        """Return a pyramid sharing this one's arrays, which extend() and join() leave as they are, so the copy can be
+        extended on another thread while this one is in use."""
+        other = MinMaxPyramid(self.width, self.factor)
+        other.time, other.value, other.levels = self.time, self.value, list(self.levels)
+        return other
+
+    def join(self, other):
+        """Add the points of ``other``, a pyramid with the same bucket widths whose points are all older, or all newer,
+        than the ones in this one. Only the bucket the two share at each level is summarized again."""
+        if not len(other):
+            return
+        if not len(self):
+            self.time, self.value, self.levels = other.time, other.value, list(other.levels)
+            return
+
+        before = other.time[-1] <= self.time[0]
+        self.time = np.concatenate([other.time, self.time] if before else [self.time, other.time])
+        self.value = np.concatenate([other.value, self.value] if before else [self.value, other.value])
+
+        # The levels both pyramids have are joined. Any above those are built again from the whole of the level below.
+        self.levels = [self.merge(mine, theirs, before) for mine, theirs in zip(self.levels, other.levels)]
+        self.buildLevels(len(self.levels))
+
+    def buildLevels(self, depth=0):
+        """Summarize the level below each level from ``depth`` up, until there is only one bucket left."""
+        del self.levels[depth:]
+        if not len(self.time):
+            return
+
+        while not self.levels or len(self.levels[-1][0]) > 1:
+            below = self.levels[-1] if self.levels else (self.time, self.time, self.value, self.time, self.value)
+            self.levels.append(summarize(self.bucketIds(below, len(self.levels)), *below[1:]))
+
+    def merge(self, mine, theirs, before):
+        """Join the summaries ``mine`` and ``theirs`` of a level, combining the bucket they share, if any."""
+        first, second = (theirs, mine) if before else (mine, theirs)
+
+        if len(first[0]) and len(second[0]) and first[0][-1] == second[0][0]:
+            shared = summarize(*[np.r_[a[-1], b[0]] for a, b in zip(first, second)])
+            return tuple(np.concatenate([a[:-1], c, b[1:]]) for a, b, c in zip(first, second, shared))
+
+        return tuple(np.concatenate([a, b]) for a, b in zip(first, second))
+
+    def count(self, lo, hi):
+        """Return the number of points from ``lo`` to ``hi``."""
+        return int(np.searchsorted(self.time, hi, side='right') - np.searchsorted(self.time, lo))
+
+    def extent(self):
+        """Return the first and last times and the minimum and maximum values, or None if the series is empty."""
+        if not len(self.time):
+            return None
+
+        ids, tmin, vmin, tmax, vmax = self.levels[-1]
+        return self.time[0], self.time[-1], np.fmin.reduce(vmin), np.fmax.reduce(vmax)
+
+    def points(self, lo, hi, budget):
+        """Return (times, values) to draw the series from ``lo`` to ``hi`` with no more than about ``budget`` points:
+        the points themselves if there are few enough, otherwise the minimum and maximum of each bucket at the finest
+        level that fits. One point or bucket either side of the range is included, so lines run off the edges."""
+        first = int(np.searchsorted(self.time, lo))
+        last = int(np.searchsorted(self.time, hi, side='right'))
+        if last - first <= budget:
+            visible = slice(max(first - 1, 0), last + 1)
+            return self.time[visible], self.value[visible]
+
+        for depth, (ids, tmin, vmin, tmax, vmax) in enumerate(self.levels):
+            width = self.bucketWidth(depth)
+            first = int(np.searchsorted(ids, lo // width))
+            last = int(np.searchsorted(ids, hi // width, side='right'))
+            if 2 * (last - first) <= budget or depth == len(self.levels) - 1:
+                break
+
+        visible = slice(max(first - 1, 0), last + 1)
+        tmin, vmin, tmax, vmax = tmin[visible], vmin[visible], tmax[visible], vmax[visible]
+
+        # Put each bucket's minimum and maximum in the order they occurred
+        minfirst = tmin <= tmax
+        times = np.column_stack([np.where(minfirst, tmin, tmax), np.where(minfirst, tmax, tmin)]).ravel()
+        values = np.column_stack([np.where(minfirst, vmin, vmax), np.where(minfirst, vmax, vmin)]).ravel()
+        return times, values
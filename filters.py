@@ -0,0 +1,219 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import applyDatabaseProfile
+from productsmodel import readRows
+from textsearch import matchExpression
+
+
+# Choices in the filter panel's date box
+ALL_RESULTS, LAST_SEARCH, TODAY, TRACKED = range(4)
+
+
+class FilterCompiler(object):
+    """Turns the state of the filter panel into a WHERE clause on Products and the values to bind to it. Conditions
+    are written so that SQLite can use an index where there is one: dates are compared as epoch ranges, and merchants
+    and categories are excluded by ID lists that are looked up once per compile, instead of per row. Every value is
+    bound, so the same shape of filter always produces the same statement text, and FilterWorker can reuse the
+    statement it prepared for it."""
+
+    def __init__(self, db=None, debug=False):
+        self.db = db or QSqlDatabase.database()
+        self.debug = debug
+
+    def compile(self, state, order=''):
+        """Return (clause, values) for ``state``, a dict of filter panel settings. If debugging, the query plans of
+        counting and paging through the filtered products, sorted by ``order``, are printed."""
+        shape = []
+        values = []
+
+        date = state.get('date', ALL_RESULTS)
+        if date == LAST_SEARCH:
+            shape.append('Timestamp >= ?')
+            values.append(state.get('since', 0))
+        elif date == TODAY:
+            shape.append('Timestamp >= ?')
+            values.append(QDateTime(QDate.currentDate(), QTime(0, 0)).toTime_t())
+        elif date == TRACKED:
+            shape.append('Tracking > 0')
+
+        keywords = matchExpression(state.get('keywords', ''))
+        if keywords:
+            shape.append('rowid IN (SELECT rowid FROM ProductsSearch WHERE ProductsSearch MATCH ?)')
+            values.append(keywords)
+
+        keywords = matchExpression(state.get('excludeKeywords', ''), any=True)
+        if keywords:
+            shape.append('rowid NOT IN (SELECT rowid FROM ProductsSearch WHERE ProductsSearch MATCH ?)')
+            values.append(keywords)
+
+        if not state.get('prime', True):
+            shape.append('Prime = 0')
+
+        if not state.get('amazon', True):
+            ids = self.ids("SELECT MerchantId FROM Merchants WHERE INSTR(LOWER(MerchantName), 'amazon')")
+            if ids:
+                shape.append('MerchantId NOT IN ({})'.format(', '.join('?' * len(ids))))
+                values.extend(ids)
+
+        if not state.get('privateLabel', True):
+            shape.append('PrivateLabel = 0')
+
+        if not state.get('restricted', True):
+            ids = self.ids('SELECT CategoryId FROM Categories WHERE Restricted = 1')
+            if ids:
+                shape.append('CategoryId NOT IN ({})'.format(', '.join('?' * len(ids))))
+                values.extend(ids)
+
+        # CRank is never negative, so 'not zero' is a range on it's index
+        if not state.get('zeroes', True):
+            shape.append('CRank > 0')
+
+        for key, condition in [('maxOffers', 'Offers <= ?'), ('minPrice', 'Price >= ?'), ('maxPrice', 'Price <= ?'),
+                               ('maxRank', 'CRank <= ?')]:
+            if state.get(key, 0) > 0:
+                shape.append(condition)
+                values.append(state[key])
+
+        clause = ' AND '.join(shape)
+        if self.debug:
+            self.explain(clause, values, order)
+
+        return clause, values
+
+    def ids(self, statement):
+        q = QSqlQuery(statement, self.db)
+        ids = []
+        while q.next():
+            ids.append(q.value(0))
+        return ids
+
+    def explain(self, clause, values, order=''):
+        """Print the query plans for counting the products matching ``clause`` and for fetching the first page."""
+        where = ' WHERE ' + clause if clause else ''
+
+        for statement in ['SELECT COUNT(*) FROM Products' + where,
+                          'SELECT * FROM Products' + where + order + ' LIMIT 256']:
+            q = QSqlQuery(self.db)
+            q.prepare('EXPLAIN QUERY PLAN ' + statement)
+            for value in values:
+                q.addBindValue(value)
+            q.exec_()
+
+            plan = []
+            while q.next():
+                plan.append('  ' + q.value(3))
+
+            print('\n'.join(['Query plan for: ' + statement] + plan))
+
+
+class FilterWorker(QThread):
+    """Runs the queries for a new products filter on it's own connection, so typing in the filter panel never blocks
+    the GUI. Only the latest request matters: requests that are superseded before they start are dropped, and ones
+    that are superseded while running are abandoned between queries. Statements are prepared once per shape of filter
+    and reused with new values, keeping up to ``maxstatements`` of them."""
+
+    ready = pyqtSignal(int, int, list)
+    message = pyqtSignal(str)
+
+    def __init__(self, filename, profile=None, connection='filter', maxstatements=32, parent=None):
+        super(FilterWorker, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.connection = connection
+        self.maxstatements = maxstatements
+        self.statements = OrderedDict()     # Statement text -> prepared QSqlQuery, least recently used first
+        self.quitting = False
+        self.pending = None
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+
+    def submit(self, generation, countstatement, countvalues, pagestatement, pagevalues):
+        """Count the matching products and fetch the first page, as returned by
+        ProductsTableModel.prepareSelection(). The results are emitted by ``ready``."""
+        self.mutex.lock()
+        self.pending = (generation, countstatement, countvalues, pagestatement, pagevalues)
+        self.mutex.unlock()
+
+        if not self.isRunning():
+            self.start()
+        else:
+            self.condition.wakeOne()
+
+    def stop(self):
+        self.mutex.lock()
+        self.quitting = True
+        self.pending = None
+        self.mutex.unlock()
+        self.condition.wakeOne()
+
+    def superseded(self):
+        self.mutex.lock()
+        superseded = self.pending is not None or self.quitting
+        self.mutex.unlock()
+        return superseded
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+
+        if db.open():
+            applyDatabaseProfile(db, self.profile)
+
+            while True:
+                self.mutex.lock()
+                if self.pending is None and not self.quitting:
+                    self.condition.wait(self.mutex)
+
+                request, self.pending = self.pending, None
+                quitting = self.quitting
+                self.mutex.unlock()
+
+                if quitting:
+                    break
+                if request is not None:
+                    self._select(db, *request)
+
+            self.statements.clear()
+            db.close()
+        else:
+            self.message.emit('Could not open database to filter products: ' + db.lastError().text())
+
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+    def _select(self, db, generation, countstatement, countvalues, pagestatement, pagevalues):
+        results = []
+
+        for statement, values in [(countstatement, countvalues), (pagestatement, pagevalues)]:
+            q = self.statements.pop(statement, None)
+            if q is None:
+                q = QSqlQuery(db)
+                q.setForwardOnly(True)
+                if not q.prepare(statement):
+                    self.message.emit('Could not filter products: ' + q.lastError().text())
+                    return
+
+            self.statements[statement] = q
+            while len(self.statements) > self.maxstatements:
+                self.statements.popitem(last=False)
+
+            for value in values:
+                q.addBindValue(value)
+
+            if not q.exec_():
+                self.message.emit('Could not filter products: ' + q.lastError().text())
+                return
+
+            results.append(readRows(q, q.record().count()))
+            q.finish()
+
+            if self.superseded():
+                return
+
+        count, page = results
+        self.ready.emit(generation, int(count[0][0]) if count else 0, page)
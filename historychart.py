@@ -1,7 +1,56 @@
+import numpy as np
+
 from PyQt5.QtCore import *
 from PyQt5.QtChart import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
+from PyQt5.QtSql import *
+
+from downsample import MinMaxPyramid, steps
+from historymodel import HISTORY_COLUMNS, rowBefore, rowColumns
+from initdb import applyDatabaseProfile
+from maintenance import ROLLUP_TABLES
+from productsmodel import readRows
+
+
+def toPoints(x, y):
+    """Return arrays ``x`` and ``y`` as a list of QPointF, for QXYSeries.replace()."""
+    return [QPointF(a, b) for a, b in zip(x.tolist(), y.tolist())]
+
+
+def seriesExtents(pyramids):
+    """Return an array with a row of (first time, last time, minimum, maximum) for each of ``pyramids``, read from
+    their top levels. The rows of empty pyramids are NaN."""
+    nothing = (np.nan,) * 4
+    return np.array([pyramid.extent() or nothing for pyramid in pyramids], dtype=float).reshape(len(pyramids), 4)
+
+
+def timeRange(extents):
+    """Return the QDateTimes that span all the rows of ``extents``. A single point is given a day either side, and
+    no points at all a day either side of now."""
+    first = np.fmin.reduce(extents[:, 0], initial=np.nan)
+    last = np.fmax.reduce(extents[:, 1], initial=np.nan)
+
+    if np.isnan(first):
+        now = QDateTime.currentDateTime()
+        return now.addDays(-1), now.addDays(1)
+
+    tmin = QDateTime.fromMSecsSinceEpoch(int(first), Qt.LocalTime)
+    tmax = QDateTime.fromMSecsSinceEpoch(int(last), Qt.LocalTime)
+    if first == last:
+        return tmin.addDays(-1), tmax.addDays(1)
+    return tmin, tmax
+
+
+def friendlyRanges(lows, highs, minsteps, maxsteps):
+    """Round ``lows`` down to multiples of ``minsteps``, but not below zero, and ``highs`` up to multiples of
+    ``maxsteps``, for axis labels. NaNs count as zero. Returns lists of the mins and the maxes."""
+    lows, highs = np.nan_to_num(lows), np.nan_to_num(highs)
+    minsteps, maxsteps = np.asarray(minsteps, dtype=float), np.asarray(maxsteps, dtype=float)
+
+    mins = np.maximum((lows - minsteps / 2) // minsteps * minsteps, 0)
+    maxes = ((highs + maxsteps / 2) // maxsteps + 1) * maxsteps
+    return mins.tolist(), maxes.tolist()
 
 
 class Callout(QGraphicsItem):
@@ -33,21 +82,283 @@ class Callout(QGraphicsItem):
         painter.drawText(self.textrect, Qt.AlignCenter | Qt.AlignVCenter, self.text)
 
 
-class ProductHistoryChart(QChart):
+class HistoryRequest(object):
+    """A request for the points of a product's history chart from ``cutoff`` (in seconds since the epoch, UTC) to the
+    oldest point the chart already has, or from five days before the latest observation if ``cutoff`` is None. It
+    carries what the chart has loaded so far, and is sent back by HistoryLoader with copies of the chart's min/max
+    pyramids that the new points have been added to."""
+
+    def __init__(self, generation, asin, rows, cutoff=None, loadedrows=0, pyramids=None, series=None):
+        self.generation = generation
+        self.asin = asin
+        self.rows = rows                # The product's ProductHistoryModel rows, newest first
+        self.cutoff = cutoff
+        self.loadedrows = loadedrows
+        self.series = series
+
+        self.ranks, self.prices, self.offers = [pyramid.copy() for pyramid in pyramids] if pyramids else \
+                                               [MinMaxPyramid(), MinMaxPyramid(), MinMaxPyramid()]
+        self.earliest = int(self.ranks.time[0] // 1000) if len(self.ranks) else None
+
+    def load(self, db, store=None):
+        """Read the requested points from the HistoryStore ``store`` for the times it covers, if it has the product,
+        and from the rows and the rollup tables on ``db`` for anything older."""
+        if self.earliest is None and store is not None:
+            self.series = store.series(self.asin)
+
+        if self.cutoff is None:
+            if self.series is not None:
+                last = int(self.series.until[-1])
+            elif self.rows:
+                last = self.rows[0][HISTORY_COLUMNS.index('ValidUntil')] or \
+                       self.rows[0][HISTORY_COLUMNS.index('Timestamp')]
+            else:
+                return
+
+            self.cutoff = QDateTime.fromTime_t(last, Qt.LocalTime).addDays(-5).toTimeSpec(Qt.UTC).toTime_t()
+
+        if self.series is not None:
+            self.loadSeries()
+            if self.cutoff >= self.series.time[0]:
+                return
+
+            # The store may have been started after the database, so older history comes from the database
+            self.loadedrows = max(self.loadedrows, rowBefore(self.rows, int(self.series.time[0])))
+
+        self.loadRows()
+
+        # Raw observations only go back as far as the retention window. Anything older than that comes from the hourly
+        # and then the daily summaries.
+        if self.loadedrows >= len(self.rows):
+            self.loadRollups(db)
+
+    def oldest(self, default):
+        """Return the time of the oldest point loaded so far, in seconds, or ``default`` if there isn't one."""
+        if len(self.ranks):
+            return int(self.ranks.time[0] // 1000)
+        return default
+
+    def addPoints(self, times, ranks, prices, offers):
+        """Add points older than the ones already loaded, leaving out any that aren't. ``times`` are in seconds since
+        the epoch, UTC."""
+        times = np.asarray(times, dtype=float) * 1000
+        order = np.argsort(times, kind='stable')
+        if len(self.ranks):
+            order = order[times[order] < self.ranks.time[0]]
+        for pyramid, values in [(self.ranks, ranks), (self.prices, prices), (self.offers, offers)]:
+            pyramid.extend(times[order], np.asarray(values, dtype=float)[order])
+
+    def loadRows(self):
+        """Load the rows that start after the cutoff, and the one that spans it, if any."""
+        last = rowBefore(self.rows, self.cutoff)
+        if last < len(self.rows):
+            start, end = rowColumns(self.rows, ['Timestamp', 'ValidUntil'], last, last + 1)
+            if (start[0] if np.isnan(end[0]) else end[0]) >= self.cutoff:
+                last += 1
+
+        if last > self.loadedrows:
+            start, end, rank, price, offers = rowColumns(self.rows, ['Timestamp', 'ValidUntil', 'SalesRank', 'Price',
+                                                                     'Offers'], self.loadedrows, last)
+            end = np.where(np.isnan(end), start, end)
+
+            # Each row is a run of identical observations from Timestamp to ValidUntil, so add a point at each end
+            keep = np.column_stack([np.ones(len(start), dtype=bool), end > start])[::-1].ravel()
+            times = np.column_stack([start, end])[::-1].ravel()[keep]
+            self.addPoints(times, *(np.repeat(values[::-1], 2)[keep] for values in [rank, price, offers]))
+            self.loadedrows = last
+
+    def loadSeries(self):
+        """Load runs from the HistorySeries from between the cutoff and the oldest point already loaded."""
+        earliest = self.oldest(int(self.series.until[-1]) + 1)
+        runs = self.series.between(self.cutoff, earliest - 1)
+
+        # Add a point at each end of each run, oldest first, leaving out any that are already loaded
+        keep = np.column_stack([(runs.time < runs.until) & (runs.time < earliest), runs.until < earliest]).ravel()
+        times = np.column_stack([runs.time, runs.until]).ravel()[keep]
+        self.addPoints(times, *(np.repeat(values, 2)[keep] for values in [runs.rank, runs.price, runs.offers]))
+
+    def loadRollups(self, db):
+        """Load averaged summaries from between the cutoff and the oldest point already loaded."""
+        earliest = self.oldest(QDateTime.currentDateTimeUtc().toTime_t())
+
+        q = QSqlQuery(db)
+        for table, size in ROLLUP_TABLES:
+            if earliest <= self.cutoff:
+                break
 
-    def __init__(self, parent=None):
-        super(ProductHistoryChart, self).__init__(parent)
+            q.prepare('SELECT Bucket, AvgRank, AvgPrice, AvgOffers FROM {} '
+                      'WHERE Asin=? AND Bucket>=? AND Bucket<? ORDER BY Bucket'.format(table))
+            q.addBindValue(self.asin)
+            q.addBindValue(self.cutoff - self.cutoff % size)
+            q.addBindValue(earliest)
+            q.exec_()
+
+            rows = readRows(q, 4)
+            if rows:
+                self.addPoints(*zip(*rows))
+                earliest = rows[0][0]
+
+
+class HistoryLoader(QThread):
+    """Loads HistoryRequests for ProductHistoryChart, or ComparisonRequests for ProductComparisonChart, on it's own
+    thread and connection, so moving through the products table never waits for a chart. Only the latest request
+    matters: ones that are superseded before they are sent back are dropped."""
+
+    ready = pyqtSignal(object)
+    message = pyqtSignal(str)
+
+    def __init__(self, filename, profile=None, store=None, connection='historychart', parent=None):
+        super(HistoryLoader, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.store = store
+        self.connection = connection
+        self.quitting = False
+        self.pending = None
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+
+    def submit(self, request):
+        """Load ``request``, a HistoryRequest or ComparisonRequest. It is sent back by ``ready``."""
+        self.mutex.lock()
+        self.pending = request
+        self.mutex.unlock()
+
+        if not self.isRunning():
+            self.start()
+        else:
+            self.condition.wakeOne()
+
+    def stop(self):
+        self.mutex.lock()
+        self.quitting = True
+        self.pending = None
+        self.mutex.unlock()
+        self.condition.wakeOne()
+
+    def superseded(self):
+        self.mutex.lock()
+        superseded = self.pending is not None or self.quitting
+        self.mutex.unlock()
+        return superseded
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+
+        if db.open():
+            applyDatabaseProfile(db, self.profile)
+
+            while True:
+                self.mutex.lock()
+                if self.pending is None and not self.quitting:
+                    self.condition.wait(self.mutex)
+
+                request, self.pending = self.pending, None
+                quitting = self.quitting
+                self.mutex.unlock()
+
+                if quitting:
+                    break
+                if request is None:
+                    continue
+
+                try:
+                    request.load(db, self.store)
+                except OSError as e:
+                    self.message.emit('Could not load product history: ' + str(e))
+                    continue
+
+                if not self.superseded():
+                    self.ready.emit(request)
+
+            db.close()
+        else:
+            self.message.emit('Could not open database to chart product history: ' + db.lastError().text())
 
-        rcolor = QColor(50, 130, 220)
-        pcolor = QColor(0, 200, 0)
-        ocolor = QColor(255, 175, 0)
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+
+class ZoomableChart(QChart):
+    """A chart of series over time that zooms with the mouse wheel, pans by dragging and goes back to resetAxes() on a
+    double click, with a placeholder message for while it's data is loading. Subclasses add their value axes and
+    describe them with axisScales()."""
+
+    def __init__(self, parent=None):
+        super(ZoomableChart, self).__init__(parent)
 
-        # Create the axes and add them to the chart
         self.timeAxis = QDateTimeAxis()
         self.timeAxis.setFormat('M/dd hh:mm')
         self.timeAxis.setTitleText('Date/Time')
         self.addAxis(self.timeAxis, Qt.AlignBottom)
 
+        self.placeholder = QGraphicsSimpleTextItem('Loading history...', self)
+        self.placeholder.setZValue(11)
+        self.placeholder.hide()
+
+    def showPlaceholder(self, show):
+        if show:
+            self.placeholder.setPos(self.plotArea().center() - self.placeholder.boundingRect().center())
+        self.placeholder.setVisible(show)
+
+    def pointBudget(self):
+        """Return how many points to draw each line with: about one per pixel across the plot area."""
+        return max(int(self.plotArea().width()), 100)
+
+    def axisScales(self):
+        """Return (axis, pyramids, step for the minimum, step for the maximum) for each value axis, for resetAxes().
+        There are none by default."""
+        return []
+
+    def resetAxes(self):
+        """Scale the time axis to fit every series, and each value axis to the minimum and maximum of it's series,
+        rounded to it's steps."""
+        scales = self.axisScales()
+        extents = seriesExtents([pyramid for axis, pyramids, minstep, maxstep in scales for pyramid in pyramids])
+
+        # Each axis has a run of rows of the extents
+        ends = np.cumsum([len(pyramids) for axis, pyramids, minstep, maxstep in scales], dtype=int)
+        starts = ends - [len(pyramids) for axis, pyramids, minstep, maxstep in scales]
+        lows = [np.fmin.reduce(extents[start:end, 2], initial=np.nan) for start, end in zip(starts, ends)]
+        highs = [np.fmax.reduce(extents[start:end, 3], initial=np.nan) for start, end in zip(starts, ends)]
+        mins, maxes = friendlyRanges(lows, highs, [scale[2] for scale in scales], [scale[3] for scale in scales])
+
+        self.timeAxis.setRange(*timeRange(extents))
+        for (axis, pyramids, minstep, maxstep), lo, hi in zip(scales, mins, maxes):
+            axis.setRange(lo, hi)
+
+    def sceneEvent(self, event):
+        if event.type() == QEvent.GraphicsSceneWheel and event.orientation() == Qt.Vertical:
+            factor = 0.95 if event.delta() < 0 else 1.05
+            self.zoom(factor)
+            return True
+
+        if event.type() == QEvent.GraphicsSceneMouseDoubleClick:
+            self.zoomReset()
+            self.resetAxes()
+            return True
+
+        if event.type() == QEvent.GraphicsSceneMouseMove:
+            delta = event.pos() - event.lastPos()
+            self.scroll(-delta.x(), delta.y())
+            return True
+
+        return super(ZoomableChart, self).sceneEvent(event)
+
+
+class ProductHistoryChart(ZoomableChart):
+
+    def __init__(self, parent=None):
+        super(ProductHistoryChart, self).__init__(parent)
+
+        rcolor = QColor(50, 130, 220)
+        pcolor = QColor(0, 200, 0)
+        ocolor = QColor(255, 175, 0)
+
+        # Create the value axes and add them to the chart
         self.rankAxis = QValueAxis()
         self.rankAxis.setLabelFormat('%\'i')
         self.rankAxis.setTitleText('Sales Rank')
@@ -125,32 +436,34 @@ class ProductHistoryChart(QChart):
         self.offerPoints.hovered.connect(self.seriesHovered)
 
         self.timeAxis.minChanged.connect(self.loadHistoryAfter)
+        self.timeAxis.rangeChanged.connect(self.updateSeries)
+        self.plotAreaChanged.connect(self.updateSeries)
 
         self.callout = Callout(self)
-        self.avgpointspan = 0
+
         self.maxpointsshown = 100
         self.model = None
+        self.loader = None
+        self.generation = 0
+        self.requested = False
+        self.wantedafter = None
+        self.loadedrows = 0
+        self.loadedafter = None
+        self.series = None
+
+        # The loaded history, in a min/max pyramid per series. Only the visible part of it is put in the series.
+        self.rankData = MinMaxPyramid()
+        self.priceData = MinMaxPyramid()
+        self.offerData = MinMaxPyramid()
 
     def setMaxPointsShown(self, num):
-        """Set the approximate maximum number of points to show on the chart."""
+        """Set the maximum number of data points to mark on the chart. Wider ranges are shown as lines only."""
         self.maxpointsshown = num
 
-    def maybeShowPoints(self, min, max):
-        """Show or hide the data points, based on the span of the time axis and self.maxpointsshown."""
-        if self.avgpointspan and min.msecsTo(max) > self.avgpointspan * self.maxpointsshown:
-            self.rankPoints.setVisible(False)
-            self.pricePoints.setVisible(False)
-            self.offerPoints.setVisible(False)
-            self.callout.hide()
-        else:
-            self.rankPoints.setVisible(True)
-            self.pricePoints.setVisible(True)
-            self.offerPoints.setVisible(True)
-
     def seriesHovered(self, point, show):
         """Show or hide the data point callout."""
         if show:
-            timestamp = QDateTime.fromMSecsSinceEpoch(point.x()).toString('M/d H:mm')
+            timestamp = QDateTime.fromMSecsSinceEpoch(int(point.x())).toString('M/d H:mm')
 
             series = self.sender()
             if series is self.rankPoints:
@@ -169,6 +482,11 @@ class ProductHistoryChart(QChart):
         else:
             self.callout.hide()
 
+    def setHistoryLoader(self, loader):
+        """Set the HistoryLoader that reads and prepares the chart's points. This must be done before setModel()."""
+        self.loader = loader
+        self.loader.ready.connect(self.historyLoaded)
+
     def setModel(self, model):
         """Set the data model."""
         self.model = model
@@ -177,143 +495,94 @@ class ProductHistoryChart(QChart):
         self.model.modelReset.connect(self.modelReset)
 
     def modelReset(self):
-        """Clear the series and load 5 days of data from the model."""
-        self.rankLine.clear()
-        self.rankPoints.clear()
-        self.priceLine.clear()
-        self.pricePoints.clear()
-        self.offerLine.clear()
-        self.offerPoints.clear()
-
-        last = self.model.record(0).value('Timestamp')
-        if last:
-            time = QDateTime.fromTime_t(last, Qt.LocalTime).addDays(-5)
-            self.loadHistoryAfter(time)
-
-        self.resetAxes()
+        """Clear the series, and have 5 days of data loaded once the model has the product's history."""
+        self.generation += 1
+        self.requested = False
+        self.wantedafter = None
+        self.rankData = MinMaxPyramid()
+        self.priceData = MinMaxPyramid()
+        self.offerData = MinMaxPyramid()
+        self.loadedrows = 0
+        self.loadedafter = None
+        self.series = None
+
+        self.updateSeries()
+        self.showPlaceholder(True)
+
+        if not self.model.loading:
+            self.requestHistory(None)
+
+    def requestHistory(self, cutoff):
+        self.requested = True
+        self.loader.submit(HistoryRequest(self.generation, self.model.productId, self.model.rows, cutoff,
+                                          self.loadedrows, (self.rankData, self.priceData, self.offerData),
+                                          self.series))
 
     def loadHistoryAfter(self, cutoff=QDateTime.fromTime_t(0, Qt.UTC)):
-        """Load data from the model from between cutoff and the current date."""
-        if not self.model.rowCount():
-            self.avgpointspan = 0
-            return
-
-        # Get the timestamp of the last data point in the series
-        if self.rankPoints.count():
-            last = self.rankPoints.at(self.rankPoints.count() - 1).x()
-        else:
-            last = QDateTime.currentDateTime().toMSecsSinceEpoch()
-
-        # Calculate the earliest timestamp already in the series, in seconds
-        earliest = QDateTime.fromMSecsSinceEpoch(last, Qt.LocalTime)
-        earliest = earliest.toTimeSpec(Qt.UTC)
-        earliest = earliest.toTime_t()
-
-        # Calculate the cutoff timestamp in seconds
-        cutoff = cutoff.toTimeSpec(Qt.UTC)
-        cutoff = cutoff.toTime_t()
-
-        # Assume that we have already added all the data later than "earliest"
-        for row in range(self.rankPoints.count(), self.model.rowCount()):
-            record = self.model.record(row)
-
-            time = record.value('Timestamp')
-            if time < cutoff:
-                break
-
-            time = QDateTime.fromTime_t(time, Qt.UTC)
-            time.toTimeSpec(Qt.LocalTime)
-            time = time.toMSecsSinceEpoch()
-
-            self.rankPoints.append(time, record.value('SalesRank'))
-            self.rankLine.append(time, record.value('SalesRank'))
-            self.pricePoints.append(time, record.value('Price'))
-            self.priceLine.append(time, record.value('Price'))
-            self.offerPoints.append(time, record.value('Offers'))
-
-            if self.offerLine.count() > 1:
-                prev = self.offerLine.at(self.offerLine.count() - 1)
-                self.offerLine.append(prev.x(), record.value('Offers'))
-
-            self.offerLine.append(time, record.value('Offers'))
-
-        # Calculate the average span of time between each data point
-        points = self.rankPoints.pointsVector()
-        total = 0
-        for row in range(1, len(points)):
-            total += points[row-1].x() - points[row].x()
-
-        self.avgpointspan = total / len(points)
+        """Have the data from between cutoff and the oldest point loaded so far loaded in the background."""
+        cutoff = cutoff.toTimeSpec(Qt.UTC).toTime_t()
 
-    def resetAxes(self):
-        """Scale the axes to fit the minimum and maximum values in each series."""
-        r = self.rankPoints.pointsVector()
-        p = self.pricePoints.pointsVector()
-        o = self.offerPoints.pointsVector()
-
-        # If there is only one data point, set the min and max to the day before and the day after.
-        if len(r) == 1:
-            tmin = QDateTime.fromMSecsSinceEpoch(r[0].x(), Qt.LocalTime).addDays(-1)
-            tmax = QDateTime.fromMSecsSinceEpoch(r[0].x(), Qt.LocalTime).addDays(1)
-        else:
-            tmin = min(r, key=lambda pt: pt.x(), default=QPointF(QDateTime.currentDateTime().addDays(-1).toMSecsSinceEpoch(), 0)).x()
-            tmax = max(r, key=lambda pt: pt.x(), default=QPointF(QDateTime.currentDateTime().addDays(1).toMSecsSinceEpoch(), 0)).x()
-            tmin = QDateTime.fromMSecsSinceEpoch(tmin, Qt.LocalTime)
-            tmax = QDateTime.fromMSecsSinceEpoch(tmax, Qt.LocalTime)
-
-        self.timeAxis.setMin(tmin)
-        self.timeAxis.setMax(tmax)
-
-        # Find the minimum and maximum values in each series
-        srmin = min(r, key=lambda pt: pt.y(), default=QPointF(0, 0))
-        srmax = max(r, key=lambda pt: pt.y(), default=QPointF(0, 0))
-
-        pmin = min(p, key=lambda pt: pt.y(), default=QPointF(0, 0))
-        pmax = max(p, key=lambda pt: pt.y(), default=QPointF(0, 0))
-
-        omin = min(o, key=lambda pt: pt.y(), default=QPointF(0, 0))
-        omax = max(o, key=lambda pt: pt.y(), default=QPointF(0, 0))
-
-        # Scale the mins and maxes to 'friendly' values for the axes
-        scalemin = lambda v, step: ((v - step / 2) // step) * step
-        scalemax = lambda v, step: ((v + step / 2) // step + 1) * step
-        onlypositive = lambda v: v if v >= 0 else 0
-
-        srmin = onlypositive(scalemin(srmin.y(), 1000))
-        srmax = scalemax(srmax.y(), 1000)
-
-        pmin = onlypositive(scalemin(pmin.y(), 5))
-        pmax = scalemax(pmax.y(), 5)
+        # Everything after the earliest cutoff so far is already loaded. Until the first 5 days are, there's nothing to
+        # extend.
+        if self.loadedafter is None or cutoff >= self.loadedafter:
+            return
 
-        omin = onlypositive(scalemin(omin.y(), 2))
-        omax = scalemax(omax.y(), 5)
+        if self.requested:
+            self.wantedafter = cutoff if self.wantedafter is None else min(self.wantedafter, cutoff)
+            return
 
-        # Set the axes' mins and maxes
-        self.rankAxis.setMin(srmin)
-        self.rankAxis.setMax(srmax)
+        self.requestHistory(cutoff)
 
-        self.priceAxis.setMin(pmin)
-        self.priceAxis.setMax(pmax)
+    @pyqtSlot(object)
+    def historyLoaded(self, request):
+        """Add the points of a HistoryRequest sent back by the loader, unless the chart has moved on since."""
+        if request.generation != self.generation:
+            return
 
-        self.offersAxis.setMin(omin)
-        self.offersAxis.setMax(omax)
+        first = self.loadedafter is None
+        self.requested = False
+        self.loadedrows = request.loadedrows
+        self.loadedafter = request.cutoff
+        self.series = request.series
 
-    def sceneEvent(self, event):
-        if event.type() == QEvent.GraphicsSceneWheel and event.orientation() == Qt.Vertical:
-            factor = 0.95 if event.delta() < 0 else 1.05
-            self.zoom(factor)
-            self.maybeShowPoints(self.timeAxis.min(), self.timeAxis.max())
-            return True
+        self.rankData = request.ranks
+        self.priceData = request.prices
+        self.offerData = request.offers
 
-        if event.type() == QEvent.GraphicsSceneMouseDoubleClick:
-            self.zoomReset()
+        if first:
+            self.showPlaceholder(False)
             self.resetAxes()
-            self.maybeShowPoints(self.timeAxis.min(), self.timeAxis.max())
-            return True
-
-        if event.type() == QEvent.GraphicsSceneMouseMove:
-            delta = event.pos() - event.lastPos()
-            self.scroll(-delta.x(), delta.y())
-            return True
+        self.updateSeries()
+
+        # Go further back if the user scrolled or zoomed out while this was loading
+        if self.wantedafter is not None and self.loadedafter is not None and self.wantedafter < self.loadedafter:
+            cutoff, self.wantedafter = self.wantedafter, None
+            self.requestHistory(cutoff)
+
+    @pyqtSlot()
+    def updateSeries(self):
+        """Put the visible part of the history in the series. Lines are drawn from the finest pyramid level that has no
+        more than about one point per pixel of the plot area, and the data points are only marked when there are no
+        more than ``maxpointsshown`` of them."""
+
+        lo = self.timeAxis.min().toMSecsSinceEpoch()
+        hi = self.timeAxis.max().toMSecsSinceEpoch()
+        budget = self.pointBudget()
+
+        for line, pyramid, step in [(self.rankLine, self.rankData, False), (self.priceLine, self.priceData, False),
+                                    (self.offerLine, self.offerData, True)]:
+            x, y = pyramid.points(lo, hi, budget)
+            line.replace(toPoints(*(steps(x, y) if step else (x, y))))
+
+        show = self.rankData.count(lo, hi) <= self.maxpointsshown
+        for points, pyramid in [(self.rankPoints, self.rankData), (self.pricePoints, self.priceData),
+                                (self.offerPoints, self.offerData)]:
+            points.replace(toPoints(*pyramid.points(lo, hi, self.maxpointsshown)) if show else [])
+            points.setVisible(show)
+
+        if not show:
+            self.callout.hide()
 
-        return super(ProductHistoryChart, self).sceneEvent(event)
+    def axisScales(self):
+        return [(self.rankAxis, [self.rankData], 1000, 1000), (self.priceAxis, [self.priceData], 5, 5),
+                (self.offersAxis, [self.offerData], 2, 5)]
@@ -1,30 +1,287 @@
+from collections import OrderedDict
+from operator import itemgetter
+
+import numpy as np
+
+from PyQt5.QtCore import *
 from PyQt5.QtSql import *
 
+from initdb import applyDatabaseProfile
+from productsmodel import readRows
+
+
+HISTORY_COLUMNS = ['Asin', 'Timestamp', 'SalesRank', 'Offers', 'Prime', 'Price', 'MerchantName', 'ValidUntil']
+HISTORY_QUERY = 'SELECT {} FROM ProductHistory WHERE Asin=? ORDER BY Timestamp DESC'.format(', '.join(HISTORY_COLUMNS))
+
+
+def rowBefore(rows, time):
+    """Return the index of the first (newest) of the history ``rows`` with a Timestamp before ``time``, or len(rows)
+    if there isn't one."""
+    column = HISTORY_COLUMNS.index('Timestamp')
+    lo, hi = 0, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if rows[mid][column] < time:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def rowColumns(rows, names, first=0, last=None):
+    """Return columns ``names`` of history ``rows`` from ``first`` up to ``last`` as a list of float arrays, with NULLs
+    as NaN."""
+    get = itemgetter(*map(HISTORY_COLUMNS.index, names))
+    rows = rows[first:last]
+    values = np.array([get(row) for row in rows], dtype=float).reshape(len(rows), len(names))
+    return list(values.T)
+
+
+class HistoryPrefetcher(QThread):
+    """Reads product history on it's own connection, for HistoryCache.prefetch(). Only the latest request matters:
+    products from an earlier request that haven't been read yet are dropped."""
+
+    loaded = pyqtSignal(int, str, list)
+    message = pyqtSignal(str)
+
+    def __init__(self, filename, profile=None, connection='history', parent=None):
+        super(HistoryPrefetcher, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.connection = connection
+        self.quitting = False
+        self.pending = None
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+
+    def submit(self, requests):
+        """Read the history of each (serial, asin) in ``requests``. Each one is emitted by ``loaded``."""
+        self.mutex.lock()
+        self.pending = list(requests)
+        self.mutex.unlock()
+
+        if not self.isRunning():
+            self.start()
+        else:
+            self.condition.wakeOne()
+
+    def stop(self):
+        self.mutex.lock()
+        self.quitting = True
+        self.pending = None
+        self.mutex.unlock()
+        self.condition.wakeOne()
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+
+        if db.open():
+            applyDatabaseProfile(db, self.profile)
+
+            q = QSqlQuery(db)
+            q.setForwardOnly(True)
+            q.prepare(HISTORY_QUERY)
+
+            while True:
+                self.mutex.lock()
+                if not self.pending and not self.quitting:
+                    self.condition.wait(self.mutex)
+
+                # Take one product at a time, so a new request replaces the rest of the old one
+                request = self.pending.pop(0) if self.pending else None
+                quitting = self.quitting
+                self.mutex.unlock()
+
+                if quitting:
+                    break
+                if request is None:
+                    continue
+
+                serial, asin = request
+                q.addBindValue(asin)
+                if not q.exec_():
+                    self.message.emit('Could not read product history: ' + q.lastError().text())
+                    continue
+
+                rows = readRows(q, len(HISTORY_COLUMNS))
+                q.finish()
+                self.loaded.emit(serial, asin, rows)
+
+            del q
+            db.close()
+        else:
+            self.message.emit('Could not open database to read product history: ' + db.lastError().text())
+
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+
+class HistoryCache(QObject):
+    """The history rows of recently viewed products, newest first, kept in memory so going back to a product doesn't
+    go to the database. The least recently used products are evicted once there are more than ``maxproducts`` of them
+    or more than ``maxrows`` rows in total. Products are read on a worker thread, and ``loaded`` is emitted when one
+    arrives. invalidate() drops products that new observations have been written for."""
 
-class ProductHistoryModel(QSqlTableModel):
+    loaded = pyqtSignal(str)
+    message = pyqtSignal(str)
 
-    def __init__(self, parent = None, asin = ''):
+    def __init__(self, filename, profile=None, maxproducts=100, maxrows=250000, parent=None):
+        super(HistoryCache, self).__init__(parent)
+
+        self.maxproducts = maxproducts
+        self.maxrows = maxrows
+        self.histories = OrderedDict()  # Asin -> rows, least recently used first
+        self.size = 0                   # Total number of cached rows
+        self.serial = 0
+        self.inflight = {}              # Asin -> serial of the prefetch request that will fill it
+        self.wanted = None              # The product last asked for with request(), until it arrives
+        self.neighbours = []
+
+        self.prefetcher = HistoryPrefetcher(filename, profile=profile, parent=self)
+        self.prefetcher.loaded.connect(self.prefetched)
+        self.prefetcher.message.connect(self.message)
+
+    def request(self, asin):
+        """Return the history rows of ``asin`` if they are cached. Otherwise return None, and read them ahead of any
+        prefetches; ``loaded`` is emitted when they arrive."""
+        rows = self.histories.get(asin)
+        if rows is not None:
+            self.histories.move_to_end(asin)
+            return rows
+
+        self.wanted = asin
+        self.prefetch(self.neighbours)
+        return None
+
+    def insert(self, asin, rows):
+        self.histories[asin] = rows
+        self.size += len(rows)
+
+        # Evict the least recently used products, but always keep the one just added
+        while len(self.histories) > 1 and (len(self.histories) > self.maxproducts or self.size > self.maxrows):
+            asin, rows = self.histories.popitem(last=False)
+            self.size -= len(rows)
+
+    def prefetch(self, asins):
+        """Read the history of ``asins`` into the cache on the worker thread, after the product last asked for with
+        request(). Replaces any earlier prefetch that hasn't finished yet."""
+        self.serial += 1
+        self.neighbours = list(asins)
+
+        requests = [(self.inflight.get(asin, self.serial), asin) for asin in [self.wanted] + self.neighbours
+                    if asin and asin not in self.histories]
+        self.inflight = {asin: serial for serial, asin in requests}
+
+        if requests:
+            self.prefetcher.submit(requests)
+
+    @pyqtSlot(int, str, list)
+    def prefetched(self, serial, asin, rows):
+        # Results for products that have been invalidated or dropped from the prefetch since they were requested could
+        # be stale
+        if self.inflight.get(asin) != serial or asin in self.histories:
+            return
+
+        del self.inflight[asin]
+        if asin == self.wanted:
+            self.wanted = None
+
+        self.insert(asin, rows)
+        self.loaded.emit(asin)
+
+    @pyqtSlot(list)
+    def invalidate(self, asins):
+        """Forget the history of ``asins``. It will be read again the next time it is needed."""
+        for asin in asins:
+            rows = self.histories.pop(asin, None)
+            if rows is not None:
+                self.size -= len(rows)
+            self.inflight.pop(asin, None)
+
+        # Read the product that is waited for again, in case the copy on it's way is out of date
+        if self.wanted in asins:
+            self.prefetch(self.neighbours)
+
+    @pyqtSlot()
+    def clear(self):
+        """Forget everything, e.g. after old history has been rolled up."""
+        self.histories.clear()
+        self.inflight.clear()
+        self.size = 0
+
+        if self.wanted is not None:
+            self.prefetch(self.neighbours)
+
+    def stop(self):
+        self.prefetcher.stop()
+
+    def wait(self):
+        return self.prefetcher.wait()
+
+
+class ProductHistoryModel(QAbstractTableModel):
+    """The history of a single product, newest first, as read from a HistoryCache. If the product isn't cached the
+    model is empty, with ``loading`` set, until the cache has read it."""
+
+    def __init__(self, cache, parent=None, asin=''):
         super(ProductHistoryModel, self).__init__(parent)
-        self.setTable('ProductHistory')
-        self.modelReset.connect(self.fetchAll)
+        self.cache = cache
+        self.rows = []
+        self.loading = False
+        self.cache.loaded.connect(self.historyLoaded)
         self.setProduct(asin)
 
+    def fieldIndex(self, name):
+        try:
+            return HISTORY_COLUMNS.index(name)
+        except ValueError:
+            return -1
+
     def setProduct(self, asin):
         """Populate the model with the history data of the specified ASIN."""
+        rows = self.cache.request(asin) if asin else []
+
+        self.beginResetModel()
         self.productId = asin
-        self.setFilter('Asin=\'{}\''.format(asin))
-        if not self.rowCount():
-            self.select()
+        self.loading = rows is None
+        self.rows = rows or []
+        self.endResetModel()
+        return True
 
-        if self.lastError().type() != QSqlError.NoError:
-            print('ProductHistoryModel: Could not set product.')
-            return False
+    @pyqtSlot(str)
+    def historyLoaded(self, asin):
+        if self.loading and asin == self.productId:
+            self.setProduct(asin)
 
-        return True
+    def value(self, row, name):
+        """Return the value of column ``name`` in ``row``, or None if there is no such row."""
+        if not 0 <= row < len(self.rows):
+            return None
+        return self.rows[row][HISTORY_COLUMNS.index(name)]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HISTORY_COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and 0 <= section < len(HISTORY_COLUMNS):
+            return HISTORY_COLUMNS[section]
+        return super(ProductHistoryModel, self).headerData(section, orientation, role)
 
-    def fetchAll(self):
-        while self.canFetchMore():
-            self.fetchMore()
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
 
+        row = self.rows[index.row()]
+        value = row[index.column()]
 
+        # A row without a ValidUntil is a single observation, valid only at it's Timestamp
+        if value is None and index.column() == self.fieldIndex('ValidUntil'):
+            return row[self.fieldIndex('Timestamp')]
 
+        return value
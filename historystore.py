@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+
+# Column name and type of each file in an ASIN's directory. A row is one run of identical observations, from 'time' to
+# 'until' (seconds since the epoch, UTC), in the same way as the ProductHistory table.
+COLUMNS = [
+    ('time', np.int64),
+    ('until', np.int64),
+    ('rank', np.int64),
+    ('price', np.float64),
+    ('offers', np.int32),
+]
+
+
+class HistorySeries(object):
+    """The history of one product as contiguous NumPy arrays, in ascending order of time. When loaded from a
+    HistoryStore the arrays are read-only views of memory-mapped files."""
+
+    def __init__(self, time, until, rank, price, offers):
+        self.time = time
+        self.until = until
+        self.rank = rank
+        self.price = price
+        self.offers = offers
+
+    def __len__(self):
+        return len(self.time)
+
+    def between(self, start, end):
+        """Return the runs that overlap the time span from ``start`` to ``end``, in seconds, as views of this series."""
+        first = np.searchsorted(self.until, start, 'left')
+        last = np.searchsorted(self.time, end, 'right')
+        return HistorySeries(self.time[first:last], self.until[first:last], self.rank[first:last],
+                             self.price[first:last], self.offers[first:last])
+
+
+class HistoryStore(object):
+    """A directory of per-ASIN columnar history files. Each column is a flat file of it's type from COLUMNS, appended
+    to by the ingest path and memory-mapped for reading. Readers only ever see whole rows, so they can map the files
+    while the writer thread is appending."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def directory(self, asin):
+        return os.path.join(self.root, asin[-2:], asin)
+
+    def length(self, asin):
+        """Return the number of complete rows stored for ``asin``."""
+        directory = self.directory(asin)
+        lengths = []
+
+        for name, dtype in COLUMNS:
+            path = os.path.join(directory, name)
+            lengths.append(os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0)
+
+        return min(lengths)
+
+    def series(self, asin):
+        """Return the stored history of ``asin`` as a HistorySeries, or None if there isn't any."""
+        length = self.length(asin)
+        if not length:
+            return None
+
+        directory = self.directory(asin)
+        columns = [np.memmap(os.path.join(directory, name), dtype=dtype, mode='r', shape=(length,))
+                   for name, dtype in COLUMNS]
+
+        return HistorySeries(*columns)
+
+    def append(self, asin, time, rank, price, offers, extend=False):
+        """Record an observation of ``asin``. If ``extend`` is set nothing changed since the last one, so it's run is
+        extended instead, as the History_Extend trigger does in the database."""
+        directory = self.directory(asin)
+        length = self.length(asin)
+
+        if length and extend:
+            with open(os.path.join(directory, 'until'), 'r+b') as file:
+                file.seek((length - 1) * np.dtype(np.int64).itemsize)
+                file.write(np.array([time], dtype=np.int64).tobytes())
+            return
+
+        if not length:
+            os.makedirs(directory, exist_ok=True)
+
+        values = {'time': time, 'until': time, 'rank': rank, 'price': price, 'offers': offers}
+        for name, dtype in COLUMNS:
+            path = os.path.join(directory, name)
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+                # Drop any partial row left by an interrupted append
+                file.seek(length * np.dtype(dtype).itemsize)
+                file.truncate()
+                file.write(np.array([values[name]], dtype=dtype).tobytes())
+
+    def appendListings(self, listings, time, newruns):
+        """Record an observation of each of ``listings`` made at ``time``. Runs are started for the ASINs in
+        ``newruns``, which ProductHistory started a new row for, and extended for the rest, so both stores split runs
+        in the same places."""
+        recorded = set()
+        for listing in listings:
+            # Like ProductHistory, only keep the first of a product's listings in a batch
+            if listing.asin in recorded:
+                continue
+            recorded.add(listing.asin)
+
+            self.append(listing.asin, time, listing.salesrank, listing.price, listing.offers,
+                        extend=listing.asin not in newruns)
+
+    def importFromDatabase(self, db):
+        """Fill the store from the ProductHistory table, replacing whatever it held. Returns the number of ASINs."""
+        q = QSqlQuery(db)
+        q.setForwardOnly(True)
+        q.exec_('SELECT Asin, Timestamp, COALESCE(ValidUntil, Timestamp), SalesRank, Price, Offers '
+                'FROM ProductHistory ORDER BY Asin, Timestamp')
+
+        count = 0
+        asin, rows = None, []
+
+        while True:
+            more = q.next()
+            if rows and (not more or q.value(0) != asin):
+                self.write(asin, rows)
+                count += 1
+                rows = []
+
+            if not more:
+                break
+
+            asin = q.value(0)
+            rows.append([q.value(column) or 0 for column in range(1, 6)])
+
+        return count
+
+    def write(self, asin, rows):
+        """Replace the history of ``asin`` with ``rows`` of (time, until, rank, price, offers)."""
+        directory = self.directory(asin)
+        os.makedirs(directory, exist_ok=True)
+
+        columns = list(zip(*rows))
+        for (name, dtype), values in zip(COLUMNS, columns):
+            np.array(values, dtype=dtype).tofile(os.path.join(directory, name))
+
+
+if __name__ == '__main__':
+    # Build the store from an existing database: historystore.py [database] [store directory]
+    app = QCoreApplication(sys.argv)
+
+    database = QSqlDatabase.addDatabase('QSQLITE')
+    database.setDatabaseName(sys.argv[1] if len(sys.argv) > 1 else 'products.db')
+    database.open()
+
+    store = HistoryStore(sys.argv[2] if len(sys.argv) > 2 else 'history')
+    print('Imported the history of {:,} products.'.format(store.importFromDatabase(database)))
+
+    app.exit()
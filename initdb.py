@@ -1,14 +1,95 @@
 import logging
 from PyQt5.QtSql import *
 
+from scoring import ensureScoreColumns
+
+
+# Connection settings used when config.json doesn't have a 'database' section. Negative cache sizes are in KiB.
+DEFAULT_DATABASE_PROFILE = {
+    'page_size': 4096,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+
+def applyDatabaseProfile(db, profile=None):
+    """Apply the PRAGMA settings in ``profile`` to the open connection ``db``. Settings missing from ``profile`` are
+    taken from DEFAULT_DATABASE_PROFILE. page_size only takes effect on a new database (or after a VACUUM in rollback
+    journal mode), so it is applied first. Returns False if any setting was rejected."""
+    settings = dict(DEFAULT_DATABASE_PROFILE)
+    settings.update(profile or {})
+
+    ok = True
+    q = QSqlQuery(db)
+    for pragma in ['page_size', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store']:
+        value = str(settings[pragma])
+        if not value.lstrip('-').isalnum():
+            logging.warning('Ignoring invalid database setting {}={}'.format(pragma, value))
+            ok = False
+            continue
+
+        if not q.exec_('PRAGMA {}={}'.format(pragma, value)):
+            logging.warning('Could not set {}: {}'.format(pragma, q.lastError().text()))
+            ok = False
+
+    return ok
+
+
+class MigrationError(Exception):
+
+    def __init__(self, error):
+        super(MigrationError, self).__init__(error.text())
+        self.error = error
+
+
+def execute(q, statement, values=()):
+    """Run ``statement`` with the given bind values, raising MigrationError if it fails."""
+    q.prepare(statement)
+    for value in values:
+        q.addBindValue(value)
+
+    if not q.exec_():
+        raise MigrationError(q.lastError())
+
+    return q
+
+
+def tableColumns(q, table):
+    """Return a dict of column name -> (declared type, primary key flag) for ``table``."""
+    execute(q, 'PRAGMA table_info({})'.format(table))
+
+    columns = {}
+    while q.next():
+        columns[q.value(1)] = (q.value(2).upper(), bool(q.value(5)))
+
+    return columns
+
+
+def tableExists(q, name):
+    execute(q, "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [name])
+    return q.first()
+
+
+def copyInBatches(q, statement, source, batchsize=50000):
+    """Run ``statement`` once for each range of ``batchsize`` rowids in ``source``. The statement must take the first
+    and last rowid of the range as it's two bind values."""
+    execute(q, 'SELECT MIN(rowid), MAX(rowid) FROM {}'.format(source))
+    q.first()
+    if q.value(0) is None or q.value(0) == '':
+        return
+
+    first, last = int(q.value(0)), int(q.value(1))
+    for start in range(first, last + 1, batchsize):
+        execute(q, statement, [start, start + batchsize - 1])
+        logging.info('Copied {} rows {}-{} of {}'.format(source, start, min(start + batchsize - 1, last), last))
 
-def setupDatabaseTables():
-    db = QSqlDatabase.database()
-    db.transaction()
 
-    # Create the tables
-    q = QSqlQuery()
-    q.exec_('CREATE TABLE IF NOT EXISTS Products('
+def createTables(q):
+    """Create the base tables, the default category, and the Update_Categories trigger."""
+    execute(q, 'CREATE TABLE IF NOT EXISTS Products('
                'Tracking INT DEFAULT 0, '
                'CRank INT, '
                'Timestamp INT, '
@@ -35,54 +116,314 @@ def setupDatabaseTables():
                'ItemWidth FLOAT DEFAULT 0, '
                'ItemHeight FLOAT DEFAULT 0)')
 
-    q.exec_('CREATE TABLE IF NOT EXISTS Categories('
+    execute(q, 'CREATE TABLE IF NOT EXISTS Categories('
                'CategoryId INTEGER PRIMARY KEY, '
                'CategoryName VARCHAR UNIQUE, '
                'MaxRank INT DEFAULT 0, '
                'Restricted BOOL, '
                'FtkToken VARCHAR)')
 
-    q.exec_('CREATE TABLE IF NOT EXISTS ProductGroups('
+    execute(q, 'CREATE TABLE IF NOT EXISTS ProductGroups('
                'ProductGroupId INTEGER PRIMARY KEY, '
                'ProductGroupName VARCHAR UNIQUE, '
                'CategoryId INT DEFAULT 1)')
 
-    q.exec_('CREATE TABLE IF NOT EXISTS Merchants('
-            'MerchantId INT PRIMARY KEY, '
-            'MerchantName VARCHAR UNIQUE NOT NULL)')
+    execute(q, 'CREATE TABLE IF NOT EXISTS Merchants('
+               'MerchantId INTEGER PRIMARY KEY, '
+               'MerchantName VARCHAR UNIQUE NOT NULL)')
 
-    q.exec_('CREATE TABLE IF NOT EXISTS Observations('
+    execute(q, 'CREATE TABLE IF NOT EXISTS Observations('
                'Asin VARCHAR, '
                'Timestamp INT, '
                'SalesRank INT, '
                'Offers INT, '
                'Prime BOOL, '
-               'MerchantId'
+               'MerchantId INT, '
                'Price FLOAT, '
                'FOREIGN KEY(Asin) REFERENCES Products(Asin) ON DELETE CASCADE)')
 
-    # Create a view for accessing product history
-    q.exec_('CREATE VIEW IF NOT EXITS ProductHistory AS '
-            'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
-            'FROM Products LEFT OUTER JOIN Merchants ON Products.MerchantId = Merchants.MerchantId '
-            'UNION '
-            'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
-            'FROM Observations LEFT OUTER JOIN Merchants ON Observations.MerchantId = Merchants.MerchantId '
-            'ORDER BY Timestamp DESC')
-
     # Insert a default category
-    q.prepare('INSERT OR IGNORE INTO Categories(CategoryName) VALUES("Unknown")')
+    execute(q, "INSERT OR IGNORE INTO Categories(CategoryName) VALUES('Unknown')")
 
     # Create a trigger to update a product's category when it's product group association is changed
-    q.exec_('DROP TRIGGER IF EXISTS Update_Categories')
-    q.exec_('CREATE TRIGGER Update_Categories AFTER UPDATE ON ProductGroups '
-            'BEGIN '
-            'UPDATE Products SET CategoryId=NEW.CategoryId WHERE ProductGroupId=OLD.ProductGroupId; '
-            'END')
-
-    if not db.commit():
-        logging.debug('Table setup failed: ' + db.lastError().text())
-        db.rollback()
-        return db.lastError()
+    execute(q, 'DROP TRIGGER IF EXISTS Update_Categories')
+    execute(q, 'CREATE TRIGGER Update_Categories AFTER UPDATE ON ProductGroups '
+               'BEGIN '
+               'UPDATE Products SET CategoryId=NEW.CategoryId WHERE ProductGroupId=OLD.ProductGroupId; '
+               'END')
+
+
+def fixObservationColumns(q):
+    """Older databases were created with 'MerchantId' and 'Price FLOAT' run together into a single MerchantIdPrice
+    column. Rebuild the table with the proper columns, copying the old rows across in batches."""
+    columns = tableColumns(q, 'Observations')
+    if 'MerchantIdPrice' not in columns:
+        return
+
+    execute(q, 'DROP VIEW IF EXISTS ProductHistory')
+    execute(q, 'CREATE TABLE Observations_new('
+               'Asin VARCHAR, '
+               'Timestamp INT, '
+               'SalesRank INT, '
+               'Offers INT, '
+               'Prime BOOL, '
+               'MerchantId INT, '
+               'Price FLOAT, '
+               'FOREIGN KEY(Asin) REFERENCES Products(Asin) ON DELETE CASCADE)')
+
+    copyInBatches(q, 'INSERT INTO Observations_new(Asin, Timestamp, SalesRank, Offers, Prime, Price) '
+                     'SELECT Asin, Timestamp, SalesRank, Offers, Prime, MerchantIdPrice FROM Observations '
+                     'WHERE rowid BETWEEN ? AND ?', 'Observations')
+
+    execute(q, 'DROP TABLE Observations')
+    execute(q, 'ALTER TABLE Observations_new RENAME TO Observations')
+
+
+def fixMerchantIds(q):
+    """Older databases declared MerchantId as INT PRIMARY KEY, which isn't an alias for the rowid, so new merchants got
+    a NULL MerchantId. Rebuild the table so IDs are assigned, and point products without a merchant at 'N/A'. Also
+    fills in MerchantId from the legacy Products.Merchant column (this used to be done by convertmerchnames.py)."""
+    columns = tableColumns(q, 'Merchants')
+    if columns['MerchantId'][0] != 'INTEGER':
+        execute(q, 'DROP VIEW IF EXISTS ProductHistory')
+        execute(q, 'CREATE TABLE Merchants_new('
+                   'MerchantId INTEGER PRIMARY KEY, '
+                   'MerchantName VARCHAR UNIQUE NOT NULL)')
+        execute(q, 'INSERT INTO Merchants_new(MerchantId, MerchantName) '
+                   'SELECT MerchantId, MerchantName FROM Merchants WHERE MerchantId IS NOT NULL')
+        execute(q, 'INSERT OR IGNORE INTO Merchants_new(MerchantName) '
+                   'SELECT MerchantName FROM Merchants WHERE MerchantId IS NULL')
+        execute(q, 'DROP TABLE Merchants')
+        execute(q, 'ALTER TABLE Merchants_new RENAME TO Merchants')
+
+    if 'Merchant' in tableColumns(q, 'Products'):
+        execute(q, 'INSERT OR IGNORE INTO Merchants(MerchantName) '
+                   'SELECT DISTINCT Merchant FROM Products WHERE Merchant IS NOT NULL')
+        execute(q, 'UPDATE Products SET MerchantId=(SELECT MerchantId FROM Merchants WHERE MerchantName=Products.Merchant) '
+                   'WHERE Merchant IS NOT NULL')
+
+    execute(q, "INSERT OR IGNORE INTO Merchants(MerchantName) VALUES('N/A')")
+    execute(q, "UPDATE Products SET MerchantId=(SELECT MerchantId FROM Merchants WHERE MerchantName='N/A') "
+               "WHERE MerchantId IS NULL OR MerchantId=''")
+
+
+def mergeOldProducts(q):
+    """Copy in any rows left in a Products_old table by a manual rebuild of Products (the old 'sqlqueries' script)."""
+    if not tableExists(q, 'Products_old'):
+        return
+
+    columns = ', '.join(column for column in tableColumns(q, 'Products') if column in tableColumns(q, 'Products_old'))
+
+    copyInBatches(q, 'INSERT OR IGNORE INTO Products({0}) SELECT {0} FROM Products_old WHERE rowid BETWEEN ? AND ?'
+                     .format(columns), 'Products_old')
+
+    execute(q, 'DROP TABLE Products_old')
+
+
+def createHistoryView(q):
+    """Create a view for accessing product history."""
+    execute(q, 'DROP VIEW IF EXISTS ProductHistory')
+    execute(q, 'CREATE VIEW ProductHistory AS '
+               'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
+               'FROM Products LEFT OUTER JOIN Merchants ON Products.MerchantId = Merchants.MerchantId '
+               'UNION '
+               'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
+               'FROM Observations LEFT OUTER JOIN Merchants ON Observations.MerchantId = Merchants.MerchantId '
+               'ORDER BY Timestamp DESC')
+
+
+def createIndexes(q):
+    """Add indexes for tracking updates, the filter panel, category changes, and product history lookups."""
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_Tracking ON Products(Tracking, Timestamp, Asin)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_Timestamp ON Products(Timestamp)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_CRank ON Products(CRank)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_Price ON Products(Price)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_Offers ON Products(Offers)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Products_ProductGroupId ON Products(ProductGroupId)')
+    execute(q, 'CREATE INDEX IF NOT EXISTS Observations_Asin ON Observations(Asin, Timestamp)')
+
+
+def createArchiveTrigger(q):
+    """Move a product's previous market data into Observations whenever the ingest path updates it in place."""
+    execute(q, 'DROP TRIGGER IF EXISTS Archive_Observation')
+    execute(q, 'CREATE TRIGGER Archive_Observation AFTER UPDATE OF Timestamp ON Products '
+               'WHEN OLD.Timestamp IS NOT NEW.Timestamp '
+               'BEGIN '
+               'INSERT INTO Observations(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantId) '
+               'VALUES(OLD.Asin, OLD.Timestamp, OLD.SalesRank, OLD.Offers, OLD.Prime, OLD.Price, OLD.MerchantId); '
+               'END')
+
+
+def materializeProductHistory(q):
+    """Replace the ProductHistory view with a table holding every observation of every product, including the current
+    one, indexed by (Asin, Timestamp). Triggers on Products keep it up to date, so it takes over from Observations,
+    which is copied in and dropped."""
+    execute(q, 'DROP VIEW IF EXISTS ProductHistory')
+    execute(q, 'DROP TRIGGER IF EXISTS Archive_Observation')
+
+    execute(q, 'CREATE TABLE ProductHistory('
+               'Asin VARCHAR, '
+               'Timestamp INT, '
+               'SalesRank INT, '
+               'Offers INT, '
+               'Prime BOOL, '
+               'Price FLOAT, '
+               'MerchantName VARCHAR)')
+
+    copyInBatches(q, 'INSERT INTO ProductHistory(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantName) '
+                     'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
+                     'FROM Observations LEFT OUTER JOIN Merchants ON Observations.MerchantId = Merchants.MerchantId '
+                     'WHERE Observations.rowid BETWEEN ? AND ?', 'Observations')
+    copyInBatches(q, 'INSERT INTO ProductHistory(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantName) '
+                     'SELECT Asin, Timestamp, SalesRank, Offers, Prime, Price, Merchants.MerchantName '
+                     'FROM Products LEFT OUTER JOIN Merchants ON Products.MerchantId = Merchants.MerchantId '
+                     'WHERE Products.rowid BETWEEN ? AND ? AND Timestamp IS NOT NULL', 'Products')
+
+    execute(q, 'DROP TABLE Observations')
+    execute(q, 'CREATE INDEX ProductHistory_Asin ON ProductHistory(Asin, Timestamp)')
+
+    history = ('INSERT INTO ProductHistory(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantName) '
+               'VALUES(NEW.Asin, NEW.Timestamp, NEW.SalesRank, NEW.Offers, NEW.Prime, NEW.Price, '
+               '(SELECT MerchantName FROM Merchants WHERE MerchantId = NEW.MerchantId)); ')
+
+    execute(q, 'CREATE TRIGGER History_Insert AFTER INSERT ON Products '
+               'BEGIN ' + history + 'END')
+    execute(q, 'CREATE TRIGGER History_Update AFTER UPDATE OF Timestamp ON Products '
+               'WHEN OLD.Timestamp IS NOT NEW.Timestamp '
+               'BEGIN ' + history + 'END')
+
+
+def collapseUnchangedHistory(q):
+    """Store product history as runs: a new ProductHistory row is only added when the rank, offers, Prime, price or
+    merchant change. Otherwise the ValidUntil of the product's latest row is moved forward. A NULL ValidUntil means the
+    row is a single observation; compacthistory.py collapses rows recorded before this change."""
+    execute(q, 'ALTER TABLE ProductHistory ADD COLUMN ValidUntil INT')
+
+    execute(q, 'DROP TRIGGER IF EXISTS History_Insert')
+    execute(q, 'DROP TRIGGER IF EXISTS History_Update')
+
+    history = ('INSERT INTO ProductHistory(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantName, ValidUntil) '
+               'VALUES(NEW.Asin, NEW.Timestamp, NEW.SalesRank, NEW.Offers, NEW.Prime, NEW.Price, '
+               '(SELECT MerchantName FROM Merchants WHERE MerchantId = NEW.MerchantId), NEW.Timestamp); ')
+
+    unchanged = ('NEW.SalesRank IS OLD.SalesRank AND NEW.Offers IS OLD.Offers AND NEW.Prime IS OLD.Prime '
+                 'AND NEW.Price IS OLD.Price AND NEW.MerchantId IS OLD.MerchantId')
+
+    execute(q, 'CREATE TRIGGER History_Insert AFTER INSERT ON Products '
+               'BEGIN ' + history + 'END')
+    execute(q, 'CREATE TRIGGER History_Update AFTER UPDATE OF Timestamp ON Products '
+               'WHEN OLD.Timestamp IS NOT NEW.Timestamp AND NOT (' + unchanged + ') '
+               'BEGIN ' + history + 'END')
+    execute(q, 'CREATE TRIGGER History_Extend AFTER UPDATE OF Timestamp ON Products '
+               'WHEN OLD.Timestamp IS NOT NEW.Timestamp AND ' + unchanged + ' '
+               'BEGIN '
+               'UPDATE ProductHistory SET ValidUntil = NEW.Timestamp WHERE rowid = '
+               '(SELECT rowid FROM ProductHistory WHERE Asin = NEW.Asin ORDER BY Timestamp DESC LIMIT 1); '
+               'END')
+
+
+def createHistoryRollups(q):
+    """Create the hourly and daily aggregate tables that old ProductHistory rows are rolled up into."""
+    for table in ['ProductHistoryHourly', 'ProductHistoryDaily']:
+        execute(q, 'CREATE TABLE {}('
+                   'Asin VARCHAR, '
+                   'Bucket INT, '
+                   'MinRank INT, '
+                   'MaxRank INT, '
+                   'AvgRank FLOAT, '
+                   'MinPrice FLOAT, '
+                   'MaxPrice FLOAT, '
+                   'AvgPrice FLOAT, '
+                   'MinOffers INT, '
+                   'MaxOffers INT, '
+                   'AvgOffers FLOAT, '
+                   'Samples INT, '
+                   'PRIMARY KEY(Asin, Bucket)) WITHOUT ROWID'.format(table))
+
+
+def addScoreColumns(q):
+    """Add indexed columns for the registered scores (see scoring.py). They are left empty: ScoreUpdater fills them in
+    when the application starts, so the scores are only ever defined in one place."""
+    ensureScoreColumns(QSqlDatabase.database())
+
+
+def createSearchIndex(q):
+    """Add a full-text index over the title, manufacturer and part number of every product, for the keyword filters.
+    ProductsSearch takes it's content from Products by rowid and is kept up to date by triggers. VACUUM can renumber
+    the rowids of Products, so the index has to be rebuilt after one (see compacthistory.py)."""
+    execute(q, "CREATE VIRTUAL TABLE ProductsSearch USING fts5(Title, Manufacturer, PartNumber, "
+               "content='Products', content_rowid='rowid', prefix='2 3')")
+
+    insert = ('INSERT INTO ProductsSearch(rowid, Title, Manufacturer, PartNumber) '
+              'VALUES(NEW.rowid, NEW.Title, NEW.Manufacturer, NEW.PartNumber); ')
+    delete = ("INSERT INTO ProductsSearch(ProductsSearch, rowid, Title, Manufacturer, PartNumber) "
+              "VALUES('delete', OLD.rowid, OLD.Title, OLD.Manufacturer, OLD.PartNumber); ")
+
+    execute(q, 'CREATE TRIGGER Search_Insert AFTER INSERT ON Products '
+               'BEGIN ' + insert + 'END')
+    execute(q, 'CREATE TRIGGER Search_Delete AFTER DELETE ON Products '
+               'BEGIN ' + delete + 'END')
+    execute(q, 'CREATE TRIGGER Search_Update AFTER UPDATE OF Title, Manufacturer, PartNumber ON Products '
+               'WHEN NEW.Title IS NOT OLD.Title OR NEW.Manufacturer IS NOT OLD.Manufacturer '
+               'OR NEW.PartNumber IS NOT OLD.PartNumber '
+               'BEGIN ' + delete + insert + 'END')
+
+    execute(q, "INSERT INTO ProductsSearch(ProductsSearch) VALUES('rebuild')")
+
+
+# Schema migrations, in order. A database at schema version N has had the first N of these applied. Never change or
+# reorder a migration once it has been released; add a new one to the end instead.
+MIGRATIONS = [
+    createTables,
+    mergeOldProducts,
+    fixObservationColumns,
+    fixMerchantIds,
+    createHistoryView,
+    createIndexes,
+    createArchiveTrigger,
+    materializeProductHistory,
+    collapseUnchangedHistory,
+    createHistoryRollups,
+    addScoreColumns,
+    createSearchIndex,
+]
+
+
+def schemaVersion(db=None):
+    """Return the number of migrations that have been applied to the database."""
+    q = QSqlQuery(db or QSqlDatabase.database())
+    q.exec_('SELECT MAX(version) FROM schema_version')
+    return int(q.value(0) or 0) if q.first() else 0
+
+
+def setupDatabaseTables():
+    """Bring the database schema up to date by applying any outstanding migrations, each in it's own transaction."""
+    db = QSqlDatabase.database()
+    q = QSqlQuery(db)
+
+    if not q.exec_('CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, applied INT)'):
+        return q.lastError()
+
+    current = schemaVersion(db)
+
+    for version, migration in enumerate(MIGRATIONS, 1):
+        if version <= current:
+            continue
+
+        logging.info('Applying schema migration {}: {}'.format(version, migration.__name__))
+        db.transaction()
+
+        try:
+            migration(q)
+            execute(q, "INSERT INTO schema_version(version, applied) VALUES(?, strftime('%s', 'now'))", [version])
+        except MigrationError as e:
+            logging.debug('Schema migration {} failed: {}'.format(version, e.error.text()))
+            db.rollback()
+            return e.error
+
+        if not db.commit():
+            logging.debug('Schema migration {} failed: {}'.format(version, db.lastError().text()))
+            db.rollback()
+            return db.lastError()
 
     return QSqlError()
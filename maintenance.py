@@ -0,0 +1,202 @@
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import applyDatabaseProfile
+
+
+# How long to keep each resolution of product history, and how much work to do per transaction. Used when config.json
+# doesn't have a 'retention' section.
+DEFAULT_RETENTION = {
+    'raw_days': 7,
+    'hourly_days': 90,
+    'batch_size': 5000,
+    'interval_minutes': 60,
+}
+
+# Aggregate tables and their bucket sizes in seconds, finest first
+ROLLUP_TABLES = [
+    ('ProductHistoryHourly', 3600),
+    ('ProductHistoryDaily', 86400),
+]
+
+
+def rollupColumns():
+    return ', '.join(column for column in ['MinRank', 'MaxRank', 'AvgRank', 'MinPrice', 'MaxPrice',
+                                                     'AvgPrice', 'MinOffers', 'MaxOffers', 'AvgOffers', 'Samples'])
+
+
+def mergeRollup(table):
+    """Return the ON CONFLICT clause that merges new aggregates into an existing bucket of ``table``. A bucket's
+    Samples is the number of seconds it's values were observed for, which weights the averages."""
+    merges = []
+    for value in ['Rank', 'Price', 'Offers']:
+        merges.append('Min{0}=MIN(Min{0}, excluded.Min{0})'.format(value))
+        merges.append('Max{0}=MAX(Max{0}, excluded.Max{0})'.format(value))
+        merges.append('Avg{0}=CASE WHEN Avg{0} IS NULL THEN excluded.Avg{0} WHEN excluded.Avg{0} IS NULL THEN Avg{0} '
+                      'ELSE (Avg{0} * Samples + excluded.Avg{0} * excluded.Samples) / (Samples + excluded.Samples) END'
+                      .format(value))
+
+    return 'ON CONFLICT(Asin, Bucket) DO UPDATE SET ' + ', '.join(merges) + ', Samples=Samples + excluded.Samples'
+
+
+class HistoryMaintenance(QThread):
+    """Rolls old ProductHistory rows up into hourly aggregates, and old hourly aggregates up into daily ones. Each run
+    works through the backlog in transactions of at most ``batch_size`` rows, so the writer thread is never locked out
+    for long."""
+
+    message = pyqtSignal(str)
+
+    def __init__(self, filename, retention=None, profile=None, connection='maintenance', parent=None):
+        super(HistoryMaintenance, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.connection = connection
+        self.abort = False
+
+        self.retention = dict(DEFAULT_RETENTION)
+        self.retention.update(retention or {})
+
+    def interval(self):
+        """Return the time between maintenance runs, in milliseconds."""
+        return int(self.retention['interval_minutes'] * 60 * 1000)
+
+    @pyqtSlot()
+    def runMaintenance(self):
+        """Start a maintenance run in the background, unless one is already in progress."""
+        if not self.isRunning():
+            self.abort = False
+            self.start(self.LowPriority)
+
+    def stop(self):
+        """Stop after the current batch."""
+        self.abort = True
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+
+        if db.open():
+            applyDatabaseProfile(db, self.profile)
+            self._maintain(db)
+            db.close()
+        else:
+            self.message.emit('History maintenance could not open database: ' + db.lastError().text())
+
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+    def _maintain(self, db):
+        now = QDateTime.currentDateTimeUtc().toTime_t()
+        rawcutoff = now - self.retention['raw_days'] * 86400
+        hourlycutoff = now - self.retention['hourly_days'] * 86400
+
+        raw = self._rollupRaw(db, rawcutoff)
+        hourly = self._rollupHourly(db, hourlycutoff)
+
+        if raw or hourly:
+            self.message.emit('History maintenance: {:,} observations and {:,} hourly summaries rolled up.'
+                              .format(raw, hourly))
+
+    def _rollupRaw(self, db, cutoff):
+        """Move observations that ended before ``cutoff`` into the hourly table. The latest row of each product is kept,
+        since the ingest triggers extend it. Returns the number of rows rolled up.
+
+        Each row is a run of identical observations from Timestamp to ValidUntil, so it's split into the hours it
+        overlaps, and weighted by the seconds it spends in each. A single observation counts for one second."""
+        q = QSqlQuery(db)
+        q.exec_('CREATE TEMP TABLE IF NOT EXISTS RollupBatch(id INTEGER PRIMARY KEY)')
+
+        table, size = ROLLUP_TABLES[0]
+        total = 0
+
+        while not self.abort:
+            db.transaction()
+
+            q.exec_('DELETE FROM RollupBatch')
+            q.prepare('INSERT INTO RollupBatch(id) '
+                      'SELECT rowid FROM ProductHistory AS h '
+                      'WHERE Timestamp < ? AND COALESCE(ValidUntil, Timestamp) < ? AND rowid <> '
+                      '(SELECT rowid FROM ProductHistory WHERE Asin = h.Asin ORDER BY Timestamp DESC LIMIT 1) '
+                      'LIMIT ?')
+            q.addBindValue(cutoff)
+            q.addBindValue(cutoff)
+            q.addBindValue(self.retention['batch_size'])
+            q.exec_()
+
+            count = q.numRowsAffected()
+            if count <= 0:
+                db.rollback()
+                break
+
+            averages = ['SUM({0} * Seconds) * 1.0 / SUM(CASE WHEN {0} IS NOT NULL THEN Seconds END)'.format(value)
+                        for value in ['SalesRank', 'Price', 'Offers']]
+            q.prepare('WITH RECURSIVE Pieces(Asin, Bucket, Start, Finish, SalesRank, Price, Offers) AS ('
+                      'SELECT Asin, Timestamp / {2} * {2}, Timestamp, COALESCE(ValidUntil, Timestamp), SalesRank, '
+                      'Price, Offers FROM ProductHistory WHERE rowid IN (SELECT id FROM RollupBatch) '
+                      'UNION ALL SELECT Asin, Bucket + {2}, Start, Finish, SalesRank, Price, Offers FROM Pieces '
+                      'WHERE Bucket + {2} < Finish), '
+                      'Weighted AS (SELECT Asin, Bucket, SalesRank, Price, Offers, CASE WHEN Finish > Start '
+                      'THEN MIN(Finish, Bucket + {2}) - MAX(Start, Bucket) ELSE 1 END AS Seconds FROM Pieces) '
+                      'INSERT INTO {0}(Asin, Bucket, {1}) '
+                      'SELECT Asin, Bucket, MIN(SalesRank), MAX(SalesRank), {4}, MIN(Price), MAX(Price), {5}, '
+                      'MIN(Offers), MAX(Offers), {6}, SUM(Seconds) '
+                      'FROM Weighted WHERE true GROUP BY Asin, Bucket {3}'.format(table, rollupColumns(), size,
+                                                                                  mergeRollup(table), *averages))
+            ok = q.exec_()
+            ok = ok and q.exec_('DELETE FROM ProductHistory WHERE rowid IN (SELECT id FROM RollupBatch)')
+
+            if not ok or not db.commit():
+                self.message.emit('History maintenance failed: ' + (q.lastError().text() if not ok else db.lastError().text()))
+                db.rollback()
+                break
+
+            total += count
+            self.msleep(50)
+
+        return total
+
+    def _rollupHourly(self, db, cutoff):
+        """Merge hourly summaries from before ``cutoff`` into the daily table. Returns the number of rows rolled up."""
+        q = QSqlQuery(db)
+        source = ROLLUP_TABLES[0][0]
+        target, size = ROLLUP_TABLES[1]
+        total = 0
+
+        while not self.abort:
+            db.transaction()
+
+            q.exec_('DROP TABLE IF EXISTS temp.HourlyBatch')
+            q.prepare('CREATE TEMP TABLE HourlyBatch AS SELECT * FROM {} WHERE Bucket < ? LIMIT ?'.format(source))
+            q.addBindValue(cutoff)
+            q.addBindValue(self.retention['batch_size'])
+            q.exec_()
+
+            q.exec_('SELECT COUNT(*) FROM HourlyBatch')
+            count = int(q.value(0)) if q.first() else 0
+            if count <= 0:
+                db.rollback()
+                break
+
+            averages = ['SUM(Avg{0} * Samples) / SUM(CASE WHEN Avg{0} IS NOT NULL THEN Samples END)'.format(value)
+                        for value in ['Rank', 'Price', 'Offers']]
+            q.prepare('INSERT INTO {0}(Asin, Bucket, {1}) '
+                      'SELECT Asin, Bucket / {2} * {2} AS Day, MIN(MinRank), MAX(MaxRank), {4}, '
+                      'MIN(MinPrice), MAX(MaxPrice), {5}, MIN(MinOffers), MAX(MaxOffers), {6}, SUM(Samples) '
+                      'FROM HourlyBatch WHERE true GROUP BY Asin, Day {3}'.format(target, rollupColumns(), size,
+                                                                                  mergeRollup(target), *averages))
+            ok = q.exec_()
+            ok = ok and q.exec_('DELETE FROM {} WHERE (Asin, Bucket) IN (SELECT Asin, Bucket FROM HourlyBatch)'
+                                .format(source))
+
+            if not ok or not db.commit():
+                self.message.emit('History maintenance failed: ' + (q.lastError().text() if not ok else db.lastError().text()))
+                db.rollback()
+                break
+
+            total += count
+            self.msleep(50)
+
+        q.exec_('DROP TABLE IF EXISTS temp.HourlyBatch')
+        return total
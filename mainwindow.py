@@ -7,12 +7,19 @@ from PyQt5.QtGui import *
 
 from mainwindow_ui import *
 from categoriesdialog import *
-from productsmodel import ProductsTableModel
-from historymodel import ProductHistoryModel
-from historychart import ProductHistoryChart
+from productsmodel import ProductsTableModel, ProductDetailModel
+from historymodel import ProductHistoryModel, HistoryCache
+from historychart import ProductHistoryChart, HistoryLoader
+from comparisonchart import ProductComparisonChart
 from delegates import *
-from searchamazon import AmazonSearchEngine, ListingData
+from searchamazon import AmazonSearchEngine
+from dbwriter import DatabaseWriter
+from maintenance import HistoryMaintenance
+from historystore import HistoryStore
+from rerank import ScoreUpdater
+from scoring import SCORES, ensureScoreColumns
 from initdb import *
+from filters import FilterCompiler, FilterWorker
 
 
 class MainWindow(QMainWindow, Ui_MainWindow):
@@ -30,6 +37,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         # Initialize the various components
         self.initDatabase()
+        self.initDatabaseWriter()
+        self.initHistoryMaintenance()
+        self.initScoreUpdater()
         self.initAmazonSearchEngine()
         self.initProductsModelView()
         self.initDataWidgetMapper()
@@ -37,6 +47,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.initHistoryChart()
         self.initCategoriesDialog()
 
+        # Fill in any new score columns only once the models showing scores are connected to the score updater, so
+        # they don't miss the results
+        if self.newScores:
+            self.scores.rescoreAll()
+
         # Set up UI connections
         self.keywordsLine.returnPressed.connect(self.newSearch)
         self.searchButton.clicked.connect(self.newSearch)
@@ -45,6 +60,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.applyFiltersButton.clicked.connect(self.applyFilters)
         self.revertFiltersButton.clicked.connect(self.revertFilters)
+
+        for line in [self.withKeywordsLine, self.withoutKeywordsLine]:
+            line.textEdited.connect(self.scheduleFilters)
+        for box in [self.primeCheck, self.amazonCheck, self.privateLabelCheck, self.restrictedCheck, self.zeroesCheck]:
+            box.stateChanged.connect(self.scheduleFilters)
+        for box in [self.offersFilterBox, self.minPriceFilterBox, self.maxPriceFilterBox, self.rankFilterBox]:
+            box.valueChanged.connect(self.scheduleFilters)
+        self.filterDateBox.currentIndexChanged.connect(self.scheduleFilters)
         self.updateButton.clicked.connect(self.updateProductInfo)
         self.openAmazonButton.clicked.connect(self.openAmazon)
         self.getFBAFeesButton.clicked.connect(self.getFBAFees)
@@ -56,6 +79,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.actionEdit_Categories.triggered.connect(self.editProductGroups)
         self.actionShow_Table.triggered.connect(self.showHistoryTable)
         self.actionShow_Graph.triggered.connect(self.showHistoryGraph)
+        self.actionCompare_History.triggered.connect(self.compareHistory)
 
         # Initialize the view
         self.productsTable.selectRow(0)
@@ -91,13 +115,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # Open the database
         self.database = QSqlDatabase.addDatabase('QSQLITE')
         self.database.setDatabaseName('products.db')
+        self.database.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
         if not self.database.open():
             msg = 'Database could not be opened: ' + self.database.lastError().text()
             logging.critical(msg)
             QMessageBox.critical(self, 'Database Error', msg)
             return False
 
-        # Initialize the tables and triggers
+        # Apply the performance settings. The default profile uses write-ahead logging, so that the GUI can keep
+        # reading while the writer thread commits.
+        if not applyDatabaseProfile(self.database, self.config.get('database')):
+            self.statusMessage('Some database settings could not be applied. See the log for details.')
+
+        # Initialize the tables and triggers. The score columns are filled in by the score updater, so a database that
+        # is only now getting them has to be scored once it has been set up.
+        scored = schemaVersion(self.database) > MIGRATIONS.index(addScoreColumns)
         err = setupDatabaseTables()
         if err.type() != QSqlError.NoError:
             msg = 'Unable to initialize database: ' + err.text()
@@ -105,31 +137,89 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             QMessageBox.critical(self, 'Database error', msg)
             return False
 
+        # Add columns for any scores registered since the database was last opened. They're filled in once the score
+        # updater has been set up.
+        self.newScores = ensureScoreColumns(self.database)
+        if not scored:
+            self.newScores = [score.column for score in SCORES]
+
         return True
 
+    def initDatabaseWriter(self):
+        # Optionally keep a columnar copy of each product's history for fast charting
+        storeconfig = self.config.get('history_store', {})
+        self.historyStore = HistoryStore(storeconfig.get('path', 'history')) if storeconfig.get('enabled') else None
+
+        self.writer = DatabaseWriter(self.database.databaseName(), profile=self.config.get('database'),
+                                     store=self.historyStore, parent=self)
+        self.writer.message.connect(self.statusMessage)
+
+        # The writer keeps it's own copy of the lookup tables, which go stale when they're edited from the GUI
+        driver = self.database.driver()
+        for table in ['ProductGroups', 'Categories']:
+            if table not in driver.subscribedToNotifications():
+                driver.subscribeToNotification(table)
+        driver.notification.connect(self.writer.invalidateCaches)
+
+    def initHistoryMaintenance(self):
+        self.maintenance = HistoryMaintenance(self.database.databaseName(), retention=self.config.get('retention'),
+                                              profile=self.config.get('database'), parent=self)
+        self.maintenance.message.connect(self.statusMessage)
+
+        # Roll up old history in the background, shortly after start-up and then periodically
+        self.maintenanceTimer = QTimer(self)
+        self.maintenanceTimer.timeout.connect(self.maintenance.runMaintenance)
+        self.maintenanceTimer.start(self.maintenance.interval())
+        QTimer.singleShot(60 * 1000, self.maintenance.runMaintenance)
+
+    def initScoreUpdater(self):
+        self.scores = ScoreUpdater(self.database.databaseName(), profile=self.config.get('database'), parent=self)
+        self.scores.message.connect(self.statusMessage)
+        self.scores.progress.connect(self.scoreProgress)
+
     def initAmazonSearchEngine(self):
         self.amazon = AmazonSearchEngine(config=self.config['amz'])
         self.amazon.message.connect(self.statusMessage)
 
+        # Listings go straight from the search thread to the writer thread
+        self.amazon.listingsReady.connect(self.writer.write, Qt.DirectConnection)
+
         self.lastSearchTime = QDateTime.currentDateTimeUtc().toTime_t()
 
     def initProductsModelView(self):
         # Initialize the model
         self.productsModel = ProductsTableModel(self)
-        self.productsModel.setEditStrategy(QSqlTableModel.OnFieldChange)
+        self.filterCompiler = FilterCompiler(debug=self.config.get('debug_filters', False))
+
+        # Filters are applied as the user types, once they pause, and queried in the background
+        self.filterWorker = FilterWorker(self.database.databaseName(), profile=self.config.get('database'), parent=self)
+        self.filterWorker.message.connect(self.statusMessage)
+        self.filterWorker.ready.connect(self.productsModel.applySelection)
+
+        self.filterTimer = QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(self.config.get('filter_delay', 300))
+        self.filterTimer.timeout.connect(self.applyFilters)
+        self.productsModel.setMaxRefreshRate(self.config.get('max_refresh_rate', 1))
 
         # Make connections
-        self.amazon.listingReady.connect(self.productsModel.update)
+        self.writer.committed.connect(self.productsModel.refreshListings)
+        self.scores.scored.connect(self.productsModel.refreshListings)
+        self.scores.catalogScored.connect(self.productsModel.select)
 
         # Set up the table view
         self.productsTable.setModel(self.productsModel)
-        self.productsTable.setItemDelegate(QSqlRelationalDelegate(self))
-        self.productsTable.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.productsTable.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.productsTable.setSortingEnabled(True)
         self.productsTable.horizontalHeader().setSectionsMovable(True)
         self.productsTable.sortByColumn(self.productsModel.fieldIndex('CRank'), Qt.AscendingOrder)
         self.productsTable.resizeColumnsToContents()
 
+        # Keep the selection and scroll position when the model is re-selected. These have to be connected after
+        # setModel(), so that they run after the view and selection model have handled the reset.
+        self.productsModel.modelAboutToBeReset.connect(self.saveProductsViewState)
+        self.productsModel.modelReset.connect(self.restoreProductsViewState)
+
         # Install delegates
         numbers = NumberDelegate(self)
         currency = CurrencyDelegate(self)
@@ -141,7 +231,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         for column in map(self.productsModel.fieldIndex, ['CRank', 'SalesRank', 'Offers']):
             self.productsTable.setItemDelegateForColumn(column, numbers)
 
-        for column in [self.productsModel.fieldIndex('Price')]:
+        for column in map(self.productsModel.fieldIndex, ['Price', 'Profit']):
             self.productsTable.setItemDelegateForColumn(column, currency)
 
         for column in map(self.productsModel.fieldIndex, ['Prime', 'PrivateLabel']):
@@ -159,8 +249,16 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.productsTable.horizontalHeader().setSectionHidden(column, True)
 
     def initHistoryModelView(self):
+        # Keep the history of recently viewed products in memory. It goes stale when new observations are written, and
+        # when old ones are rolled up.
+        self.historyCache = HistoryCache(self.database.databaseName(), profile=self.config.get('database'),
+                                         maxrows=self.config.get('history_cache_rows', 250000), parent=self)
+        self.historyCache.message.connect(self.statusMessage)
+        self.writer.committed.connect(self.historyCache.invalidate)
+        self.maintenance.finished.connect(self.historyCache.clear)
+
         # Initialize the model
-        self.historyModel = ProductHistoryModel(self)
+        self.historyModel = ProductHistoryModel(self.historyCache, self)
 
         # Set up the table view
         self.historyTable.setModel(self.historyModel)
@@ -180,6 +278,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.historyTable.setItemDelegateForColumn(self.historyModel.fieldIndex('Price'), currency)
         self.historyTable.setItemDelegateForColumn(self.historyModel.fieldIndex('Prime'), yesno)
         self.historyTable.setItemDelegateForColumn(self.historyModel.fieldIndex('Timestamp'), tolocaltime)
+        self.historyTable.setItemDelegateForColumn(self.historyModel.fieldIndex('ValidUntil'), tolocaltime)
 
         # Make connections
         self.productsTable.selectionModel().currentRowChanged.connect(self.updateHistoryView)
@@ -198,20 +297,36 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         # Set up the dialog
         self.categoriesDialog = CategoriesDialog(self, groupsModel, categoriesModel)
+        self.categoriesDialog.accepted.connect(self.writer.invalidateCaches)
         self.categoriesDialog.accepted.connect(self.productsModel.select)
+        self.categoriesDialog.accepted.connect(self.detailCategories.select)
+
+        # Changing a category's MaxRank or a group's category makes existing CRanks stale, so recompute them all
+        self.categoriesDialog.accepted.connect(self.scores.rescoreAll)
 
     def initDataWidgetMapper(self):
         self.mapper = QDataWidgetMapper(self)
-        detailModel = ProductsTableModel(self)
+        self.detailModel = ProductDetailModel(self.productsModel, self)
+        detailModel = self.detailModel
         self.mapper.setModel(detailModel)
-        self.mapper.setItemDelegate(QSqlRelationalDelegate(self))
         self.mapper.setSubmitPolicy(QDataWidgetMapper.AutoSubmit)
         self.productsTable.selectionModel().currentRowChanged.connect(self.updateDetailModel)
 
+        # Keep the detail panel and the products table in step with each other and with new listings
+        detailModel.edited.connect(self.productsModel.refreshListings)
+        detailModel.edited.connect(self.scores.rescore)
+        self.productsModel.edited.connect(detailModel.invalidate)
+        self.productsModel.edited.connect(self.scores.rescore)
+        self.writer.committed.connect(detailModel.invalidate)
+        self.scores.scored.connect(detailModel.invalidate)
+
+        # The category box is mapped by it's current text, which is the category name
         catindex = detailModel.fieldIndex('CategoryName')
-        catmodel = detailModel.relationModel(catindex)
-        self.prodCategoryBox.setModel(catmodel)
-        self.prodCategoryBox.setModelColumn(catmodel.fieldIndex('CategoryName'))
+        self.detailCategories = QSqlTableModel(self)
+        self.detailCategories.setTable('Categories')
+        self.detailCategories.select()
+        self.prodCategoryBox.setModel(self.detailCategories)
+        self.prodCategoryBox.setModelColumn(self.detailCategories.fieldIndex('CategoryName'))
         self.prodCategoryBox.currentIndexChanged.connect(self.mapper.submit)
 
         self.mapper.addMapping(self.prodTitleLine, detailModel.fieldIndex('Title'))
@@ -246,17 +361,82 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.historyChartView.setRenderHint(QPainter.Antialiasing)
         self.historyChartView.setContextMenuPolicy(Qt.CustomContextMenu)
 
+        # Read and prepare the chart's points in the background, from the history store if it has the product
+        self.historyLoader = HistoryLoader(self.database.databaseName(), profile=self.config.get('database'),
+                                           store=self.historyStore, parent=self)
+        self.historyLoader.message.connect(self.statusMessage)
+
         self.historyChart = ProductHistoryChart()
+        self.historyChart.setHistoryLoader(self.historyLoader)
         self.historyChart.setModel(self.historyModel)
         self.historyChartView.setChart(self.historyChart)
 
         self.historyChartView.customContextMenuRequested.connect(self.chooseHistoryViewMenu)
 
+        # The products selected in the table can be compared in a chart of their own, in a separate window
+        self.comparisonLoader = HistoryLoader(self.database.databaseName(), profile=self.config.get('database'),
+                                              store=self.historyStore, connection='comparison', parent=self)
+        self.comparisonLoader.message.connect(self.statusMessage)
+
+        self.comparisonChart = ProductComparisonChart()
+        self.comparisonChart.setHistoryLoader(self.comparisonLoader)
+
+        self.comparisonView = QChartView(self.comparisonChart)
+        self.comparisonView.setRenderHint(QPainter.Antialiasing)
+        self.comparisonView.setWindowTitle('Compare History')
+        self.comparisonView.resize(1000, 600)
+
+        self.actionCompare_History = QAction('Compare History...', self)
+        self.menuActions.addAction(self.actionCompare_History)
+
+    def closeEvent(self, event):
+        # Let the writer finish any pending listings before the application exits
+        self.maintenance.stop()
+        self.writer.stop()
+        self.filterWorker.stop()
+        self.historyCache.stop()
+        self.historyLoader.stop()
+        self.comparisonLoader.stop()
+        self.maintenance.wait()
+        self.writer.wait()
+        self.scores.wait()
+        self.filterWorker.wait()
+        self.historyCache.wait()
+        self.historyLoader.wait()
+        self.comparisonLoader.wait()
+        self.comparisonView.close()
+
+        super(MainWindow, self).closeEvent(event)
+
+    @pyqtSlot()
+    def saveProductsViewState(self):
+        """Remember the selected product and scroll position so they survive a re-select of the products model."""
+        current = self.productsTable.currentIndex()
+        self.savedAsin = self.productsModel.data(self.productsModel.index(current.row(), self.productsModel.fieldIndex('Asin'))) \
+            if current.isValid() else None
+        self.savedColumn = max(current.column(), 0)
+        self.savedScroll = self.productsTable.verticalScrollBar().value()
+
+    @pyqtSlot()
+    def restoreProductsViewState(self):
+        """Re-select the product and scroll position saved by saveProductsViewState()."""
+        asin = getattr(self, 'savedAsin', None)
+        if asin is None:
+            return
+
+        row = self.productsModel.rowForAsin(asin)
+        if row >= 0:
+            self.productsTable.setCurrentIndex(self.productsModel.index(row, self.savedColumn))
+
+        self.productsTable.verticalScrollBar().setValue(self.savedScroll)
+
     @pyqtSlot(QModelIndex, QModelIndex)
     def updateDetailModel(self, current, previous):
         asin = self.productsModel.data(self.productsModel.index(current.row(), self.productsModel.fieldIndex('Asin')), Qt.DisplayRole)
-        self.mapper.model().setFilter("Asin='{}'".format(asin))
-        self.mapper.model().select()
+        if asin == self.prodASINLine.text():
+            return
+
+        self.detailModel.setProduct(asin)
         self.mapper.toFirst()
 
     @pyqtSlot(QPoint)
@@ -284,6 +464,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.actionShow_Graph.setChecked(False)
         self.historyStack.setCurrentIndex(0)
 
+    @pyqtSlot()
+    def compareHistory(self):
+        """Chart the history of the products selected in the table against each other."""
+        rows = sorted(index.row() for index in self.productsTable.selectionModel().selectedRows())
+        maxproducts = self.config.get('max_compared_products', 48)
+        if len(rows) > maxproducts:
+            self.statusMessage('Comparing the first {} of {} selected products.'.format(maxproducts, len(rows)))
+
+        column = self.productsModel.fieldIndex('Asin')
+        asins = [self.productsModel.data(self.productsModel.index(row, column)) for row in rows[:maxproducts]]
+        if not asins:
+            self.statusMessage('Select the products to compare in the products table.')
+            return
+
+        self.comparisonChart.setProducts(asins)
+        self.comparisonView.show()
+        self.comparisonView.raise_()
+
     @pyqtSlot()
     def calculateProfits(self):
         myprice = self.myPriceBox.value()
@@ -405,53 +603,33 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     @pyqtSlot()
     def applyFilters(self):
-        conditions = []
-
-        if self.filterDateBox.currentIndex() == 0:      # All results
-            pass
-        elif self.filterDateBox.currentIndex() == 1:    # Last search only
-            conditions.append("Timestamp >= {}".format(self.lastSearchTime))
-        elif self.filterDateBox.currentIndex() == 2:    # Today only
-            conditions.append("DATE(Timestamp)=DATE('now')")
-        elif self.filterDateBox.currentIndex() == 3:    # Tracked products only
-            conditions.append('Tracking > 0')
-
-        if self.withKeywordsLine.text():
-            conditions.append("INSTR(LOWER(Title), LOWER('{}'))".format(self.withKeywordsLine.text()))
-
-        if self.withoutKeywordsLine.text():
-            conditions.append("NOT INSTR(LOWER(Title), LOWER('{}'))".format(self.withoutKeywordsLine.text()))
-
-        if self.primeCheck.checkState() == Qt.Unchecked:
-            conditions.append('Prime=0')
+        self.filterTimer.stop()
 
-        if self.amazonCheck.checkState() == Qt.Unchecked:
-            conditions.append("NOT INSTR(LOWER(Merchant), 'amazon')")
+        clause, values = self.filterCompiler.compile(self.filterState(), self.productsModel.orderClause())
+        self.filterWorker.submit(*self.productsModel.prepareSelection(clause, values))
 
-        if self.privateLabelCheck.checkState() == Qt.Unchecked:
-            conditions.append("PrivateLabel=0")
-
-        if self.restrictedCheck.checkState() == Qt.Unchecked:
-            conditions.append("CategoryName NOT IN (SELECT CategoryName FROM Categories WHERE Restricted=1)")
-
-        if self.zeroesCheck.checkState() == Qt.Unchecked:
-            conditions.append("CRank <> 0")
-
-        if self.offersFilterBox.value() > 0:
-            conditions.append("Offers <= {}".format(self.offersFilterBox.value()))
-
-        if self.minPriceFilterBox.value() > 0:
-            conditions.append("Price >= {}".format(self.minPriceFilterBox.value()))
-        if self.maxPriceFilterBox.value() > 0:
-            conditions.append("Price <= {}".format(self.maxPriceFilterBox.value()))
-
-        if self.rankFilterBox.value() > 0:
-            conditions.append("CRank <= {}".format(self.rankFilterBox.value()))
-
-        bigfilter = ' AND '.join(conditions)
-
-        self.productsModel.setFilter(bigfilter)
-        self.productsModel.select()
+    @pyqtSlot()
+    def scheduleFilters(self):
+        """Apply the filters once the user has stopped changing them for a moment."""
+        self.filterTimer.start()
+
+    def filterState(self):
+        """Return the settings of the filter panel, for the filter compiler."""
+        return {
+            'date': self.filterDateBox.currentIndex(),
+            'since': getattr(self, 'lastSearchTime', 0),
+            'keywords': self.withKeywordsLine.text(),
+            'excludeKeywords': self.withoutKeywordsLine.text(),
+            'prime': self.primeCheck.checkState() != Qt.Unchecked,
+            'amazon': self.amazonCheck.checkState() != Qt.Unchecked,
+            'privateLabel': self.privateLabelCheck.checkState() != Qt.Unchecked,
+            'restricted': self.restrictedCheck.checkState() != Qt.Unchecked,
+            'zeroes': self.zeroesCheck.checkState() != Qt.Unchecked,
+            'maxOffers': self.offersFilterBox.value(),
+            'minPrice': self.minPriceFilterBox.value(),
+            'maxPrice': self.maxPriceFilterBox.value(),
+            'maxRank': self.rankFilterBox.value(),
+        }
 
     @pyqtSlot()
     def revertFilters(self):
@@ -489,7 +667,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.searchStatusList.addItem(message)
         self.searchStatusList.scrollToBottom()
 
+    @pyqtSlot(int, int)
+    def scoreProgress(self, done, total):
+        if total and done < total:
+            self.statusMessage('Updating scores: {:,} of {:,} products...'.format(done, total))
+
     def updateHistoryView(self, index=QModelIndex()):
         asin = self.prodASINLine.text()
 
         self.historyModel.setProduct(asin)
+
+        # Read the neighbouring products' history in the background, ready for when the user moves on
+        column = self.productsModel.fieldIndex('Asin')
+        self.historyCache.prefetch([self.productsModel.data(self.productsModel.index(row, column))
+                                    for row in [index.row() - 1, index.row() + 1] if row >= 0])
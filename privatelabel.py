@@ -0,0 +1,118 @@
+import sys
+from collections import Counter, OrderedDict
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from fuzzywuzzy import fuzz
+
+
+def couldMatch(a, b, threshold=80):
+    """Quickly rule out pairs whose partial_ratio can't exceed ``threshold``. A ratio is at most 2M/(n+M) for a shorter
+    string of length n and M matching characters, and M can't exceed the characters the two strings have in common."""
+    if a == b:
+        return True
+
+    shorter, longer = (a, b) if len(a) <= len(b) else (b, a)
+    if not shorter:
+        return False
+
+    common = sum((Counter(shorter) & Counter(longer)).values())
+    return 200 * common / (len(shorter) + common) > threshold
+
+
+def normalize(text):
+    """Return ``text`` as it is compared: lower case, without surrounding whitespace, and '' for None."""
+    return (text or '').strip().lower()
+
+
+class PrivateLabelClassifier(object):
+    """Decides whether a listing is a private label product, ie. the merchant's name closely matches the title or make.
+    Merchants and makes repeat a lot, so their fuzzy match results are kept in an LRU cache of ``cachesize`` pairs.
+    Titles are nearly all unique, so they are matched every time rather than pushing makes out of the cache."""
+
+    def __init__(self, cachesize=50000, threshold=80):
+        self.cachesize = cachesize
+        self.threshold = threshold
+        self.cache = OrderedDict()
+
+    def fuzzyMatch(self, merchant, text):
+        """Return True if ``merchant`` partially matches ``text``, ignoring case and surrounding whitespace."""
+        return self.normalizedMatch(normalize(merchant), normalize(text))
+
+    def normalizedMatch(self, merchant, text):
+        return couldMatch(merchant, text, threshold=self.threshold) and \
+            fuzz.partial_ratio(merchant, text) > self.threshold
+
+    def makeMatches(self, merchant, make):
+        """Return True if ``merchant`` partially matches ``make``, ignoring case and surrounding whitespace, caching
+        the result under the normalized pair."""
+        key = (normalize(merchant), normalize(make))
+
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        match = self.normalizedMatch(*key)
+
+        self.cache[key] = match
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+        return match
+
+    def isPrivateLabel(self, merchant, title, make):
+        return self.makeMatches(merchant, make) or self.fuzzyMatch(merchant, title)
+
+    def classify(self, listings):
+        """Return a list with the private label status of each of ``listings``."""
+        return [self.isPrivateLabel(listing.merchant, listing.title, listing.make) for listing in listings]
+
+
+def reclassifyCatalog(db, classifier=None, batchsize=5000):
+    """Recompute the PrivateLabel column of every product, writing back only the changes in transactions of
+    ``batchsize`` rows. Returns the number of products changed."""
+    classifier = classifier or PrivateLabelClassifier()
+
+    q = QSqlQuery(db)
+    q.setForwardOnly(True)
+    q.exec_('SELECT Products.rowid, PrivateLabel, MerchantName, Title, Manufacturer '
+            'FROM Products LEFT OUTER JOIN Merchants ON Products.MerchantId = Merchants.MerchantId')
+
+    rowids, labels = [], []
+    while q.next():
+        privatelabel = classifier.isPrivateLabel(q.value(2), q.value(3), q.value(4))
+        if privatelabel != bool(q.value(1)):
+            rowids.append(q.value(0))
+            labels.append(privatelabel)
+
+    update = QSqlQuery(db)
+    update.prepare('UPDATE Products SET PrivateLabel=? WHERE rowid=?')
+
+    for start in range(0, len(rowids), batchsize):
+        db.transaction()
+        update.addBindValue(labels[start:start + batchsize])
+        update.addBindValue(rowids[start:start + batchsize])
+        update.execBatch()
+
+        if not db.commit():
+            print('Could not update private label status: ' + db.lastError().text())
+            db.rollback()
+            return start
+
+    return len(rowids)
+
+
+if __name__ == '__main__':
+    app = QCoreApplication(sys.argv)
+
+    database = QSqlDatabase.addDatabase('QSQLITE')
+    database.setDatabaseName(sys.argv[1] if len(sys.argv) > 1 else 'products.db')
+    database.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+    database.open()
+
+    print('Done. Private label status changed for {:,} products.'.format(reclassifyCatalog(database)))
+
+    app.exit()
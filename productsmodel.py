@@ -1,144 +1,541 @@
-import re
+from collections import OrderedDict
 
 from PyQt5.QtCore import *
 from PyQt5.QtSql import *
 
-from fuzzywuzzy import fuzz
 
+def readRows(q, width):
+    """Read the remaining rows of ``q`` as lists of ``width`` values, with NULLs as None."""
+    rows = []
+    while q.next():
+        rows.append([None if q.isNull(i) else q.value(i) for i in range(width)])
+    return rows
 
-class ProductsTableModel(QSqlRelationalTableModel):
 
-    def __init__(self, parent=None):
-        super(ProductsTableModel, self).__init__(parent)
+def sameValue(old, new):
+    """Return whether editing ``old`` to ``new`` would leave it as it is. Editors hand back numbers as text or floats
+    whatever their column's type, and NULLs as empty strings."""
+    old = '' if old is None else old
+    new = '' if new is None else new
+    try:
+        return float(old) == float(new)
+    except (TypeError, ValueError):
+        return str(old) == str(new)
+
+
+class ProductsTableModel(QAbstractTableModel):
+    """A read-mostly view of the Products table that only keeps a window of rows in memory, so it stays fast with
+    millions of products. Rows are fetched a page at a time, by keyset on the sort column where a neighbouring page is
+    loaded. Category, product group and merchant names are resolved from dictionaries instead of by joining."""
+
+    edited = pyqtSignal(list)
+
+    # Foreign key columns, and the lookup table and name column they are shown as
+    RELATIONS = {
+        'CategoryId': ('Categories', 'CategoryName'),
+        'ProductGroupId': ('ProductGroups', 'ProductGroupName'),
+        'MerchantId': ('Merchants', 'MerchantName'),
+    }
 
-        self.setTable('Products')
-        self.setEditStrategy(QSqlTableModel.OnRowChange)
+    def __init__(self, parent=None, pagesize=256, maxpages=64, maxstatements=32):
+        super(ProductsTableModel, self).__init__(parent)
 
-        # Set up relations
-        self.setRelation(self.fieldIndex('CategoryId'), QSqlRelation('Categories', 'CategoryId', 'CategoryName'))
-        self.setRelation(self.fieldIndex('ProductGroupId'), QSqlRelation('ProductGroups', 'ProductGroupId', 'ProductGroupName'))
-        self.setRelation(self.fieldIndex('MerchantId'), QSqlRelation('Merchants', 'MerchantId', 'MerchantName'))
+        self.pagesize = pagesize
+        self.maxpages = maxpages
+        self.maxstatements = maxstatements
+        self.statements = OrderedDict()     # Statement text -> prepared QSqlQuery, least recently used first
+
+        # Columns as stored, and as shown
+        record = QSqlDatabase.database().record('Products')
+        self.columns = [record.fieldName(i) for i in range(record.count())]
+        self.headers = [self.RELATIONS[name][1] if name in self.RELATIONS else name for name in self.columns]
+
+        self.names = {column: {} for column in self.RELATIONS}
+        self.loadNames()
+
+        self.filter = ''
+        self.filterValues = []
+        self.pendingFilter = None       # (filter, values) of the selection being prepared in the background
+        self.generation = 0
+        self.sortColumn = 'CRank'
+        self.sortOrder = Qt.AscendingOrder
+        self.count = 0
+        self.pages = OrderedDict()      # Page number -> list of rows, each a list of column values plus the rowid
+        self.asinRows = None            # Asin -> row number, for the loaded pages
+
+        # Lookup tables edited in the GUI change the names shown
+        driver = QSqlDatabase.database().driver()
+        driver.notification.connect(self.reloadNames)
+
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.timeout.connect(self.select)
+        self.setMaxRefreshRate(1)
 
         # Populate the model
         self.select()
 
+    def fieldIndex(self, name):
+        return self.headers.index(name) if name in self.headers else -1
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+
+        return super(ProductsTableModel, self).headerData(section, orientation, role)
+
     def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
 
         if role == Qt.TextAlignmentRole:
             if index.column() in [self.fieldIndex('CRank'), self.fieldIndex('SalesRank'), self.fieldIndex('Price'),
-                                  self.fieldIndex('Offers')]:
+                                  self.fieldIndex('Offers'), self.fieldIndex('Profit'), self.fieldIndex('Velocity')]:
                 return Qt.AlignRight | Qt.AlignVCenter
 
-        return super(ProductsTableModel, self).data(index, role)
+        if role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
 
-    def getListingRank(self, categoryId, salesrank, offers, prime):
-        """Return a rank value based on the category, sales rank, number of offers, and Prime availability."""
-        q = QSqlQuery("SELECT MaxRank FROM Categories WHERE CategoryId={}".format(categoryId))
-        if q.lastError().type() != QSqlError.NoError:
-            print("Could not fetch MaxRank from Categories: " + q.lastError().text())
+        row = self.fetchRow(index.row())
+        if row is None:
+            return None
 
-        q.first()
-        maxrank = int(q.value(0)) if q.value(0) is not None else 0
+        column = self.columns[index.column()]
+        value = row[index.column()]
+        if column in self.RELATIONS:
+            return self.names[column].get(value)
 
-        if maxrank > 0:
-            crank = salesrank * 100000 / maxrank
+        return value
 
-            if prime:
-                crank *= offers + 1
-            else:
-                crank *= 1.25 ** offers
+    def flags(self, index):
+        flags = super(ProductsTableModel, self).flags(index)
+        if self.columns[index.column()] not in ['Asin', 'ProductGroupId', 'MerchantId']:
+            flags |= Qt.ItemIsEditable
 
-            return int(crank)
-        else:
-            return 0
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Write an edit straight to the database. Categories are edited by name."""
+        row = self.fetchRow(index.row())
+        if role != Qt.EditRole or row is None:
+            return False
+
+        column = self.columns[index.column()]
+        if column == 'CategoryId':
+            ids = [id for id, name in self.names[column].items() if name == value]
+            if not ids:
+                return False
+            value = ids[0]
+
+        if sameValue(row[index.column()], value):
+            return True
 
-    def update(self, listing):
-        """Insert a listing into the database, or update an existing entry."""
         q = QSqlQuery()
+        q.prepare('UPDATE Products SET {}=? WHERE rowid=?'.format(column))
+        q.addBindValue(value)
+        q.addBindValue(row[-1])
+        if not q.exec_():
+            print('ProductsTableModel: Could not update {}: {}'.format(column, q.lastError().text()))
+            return False
+
+        row[index.column()] = value
+        self.dataChanged.emit(index, index)
+        self.edited.emit([row[self.columns.index('Asin')]])
+        return True
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort on ``column``. Name columns are sorted by ID, which keeps their products together."""
+        self.sortColumn = self.columns[column] if 0 <= column < len(self.columns) else 'rowid'
+        self.sortOrder = order
+
+        # A selection prepared in the background is in the old order, so select it here instead
+        if self.pendingFilter is not None:
+            self.setFilter(*self.pendingFilter)
+            self.pendingFilter = None
+            self.generation += 1
+
+        self.select()
 
-        # Add the product group if it isn't there already
-        q.exec_("INSERT OR IGNORE INTO ProductGroups(ProductGroupName) VALUES('{}')".format(listing.productgroup))
-        q.exec_("SELECT ProductGroupId FROM ProductGroups WHERE ProductGroupName='{}'".format(listing.productgroup))
-        q.first()
-
-        productgroupId = q.value(0)
-
-        # Get the category association
-        q.exec_("SELECT CategoryId FROM ProductGroups WHERE ProductGroupId={}".format(productgroupId))
-        q.first()
-
-        categoryId = q.value(0)
-
-        # Add the merchant name
-        merchname = re.sub(r"'", "\'\'", listing.merchant)                      # SQL uses two single quotes to escape a single quote...
-        q.exec_("INSERT OR IGNORE INTO Merchants(MerchantName) VALUES('{}')".format(merchname))
-        q.exec_("SELECT MerchantId FROM Merchants WHERE MerchantName='{}'".format(merchname))
-        q.first()
-
-        merchantId = q.value(0)
-
-        tracking = 0
-        myprice = 0
-        mycost = 0
-        fbafees = 0
-        monthlyvolume = 0
-
-        # Check if the listing has already been added to the database
-        q.exec_("SELECT * FROM Products WHERE Asin='{}'".format(listing.asin))
-        q.first()
-        if q.isValid():
-            record = q.record()
-            # The listing is already in the database. Add it's current values to the observation table
-            q.prepare("INSERT INTO Observations(Asin, Timestamp, SalesRank, Offers, Prime, Price, MerchantId) "
-                       "VALUES(?, ?, ?, ?, ?, ?, ?)")
-            q.addBindValue(record.value('Asin'))
-            q.addBindValue(record.value('Timestamp'))
-            q.addBindValue(record.value('SalesRank'))
-            q.addBindValue(record.value('Offers'))
-            q.addBindValue(record.value('Prime'))
-            q.addBindValue(record.value('Price'))
-            q.addBindValue(record.value('MerchantId'))
-            q.exec_()
-
-            # Grab values that we don't want to overwrite
-            q.exec_("SELECT Tracking, MyPrice, MyCost, FBAFees, MonthlyVolume FROM Products WHERE Asin='{}'".format(
-                listing.asin))
-            q.first()
-            tracking = q.value(0)
-            myprice = q.value(1)
-            mycost = q.value(2)
-            fbafees = q.value(3)
-            monthlyvolume = q.value(4)
-
-        # Calculate the CRank
-        crank = self.getListingRank(categoryId, listing.salesrank, listing.offers, listing.prime)
-
-        # Determine if it is a private label product
-        if (fuzz.partial_ratio(listing.merchant.lower(), listing.title.lower()) > 80) or \
-                (fuzz.partial_ratio(listing.merchant.lower(), listing.make.lower()) > 80):
-            privatelabel = True
+    def setFilter(self, filter, values=()):
+        """Set a WHERE clause on the Products table's own columns, with ``values`` bound to it's placeholders. Takes
+        effect on the next select()."""
+        self.filter = filter
+        self.filterValues = list(values)
+
+    def select(self):
+        """Re-count the rows matching the filter and drop all loaded pages."""
+        self.refreshTimer.stop()
+        self.beginResetModel()
+
+        self.pages.clear()
+        self.asinRows = None
+
+        rows = self.query('SELECT COUNT(*) FROM Products' + self.whereClause(), self.filterValues, 1)
+        self.count = int(rows[0][0]) if rows else 0
+
+        self.endResetModel()
+        return bool(rows)
+
+    def prepareSelection(self, filter, values=()):
+        """Return the statements and values to select the products matching ``filter`` in another thread, as
+        (generation, count statement, values, page statement, values). Pass the results to applySelection()."""
+        self.generation += 1
+        self.pendingFilter = (filter, list(values))
+
+        where = self.whereClause(filter=filter)
+        page = 'SELECT {}, rowid FROM Products'.format(', '.join(self.columns)) + where + self.orderClause()
+        return (self.generation, 'SELECT COUNT(*) FROM Products' + where, list(values),
+                page + ' LIMIT ? OFFSET ?', list(values) + [self.pagesize, 0])
+
+    @pyqtSlot(int, int, list)
+    def applySelection(self, generation, count, rows):
+        """Switch to a selection made in the background, with it's row count and first page. Results for anything but
+        the latest prepareSelection() are ignored."""
+        if generation != self.generation or self.pendingFilter is None:
+            return
+
+        self.refreshTimer.stop()
+        self.beginResetModel()
+
+        self.setFilter(*self.pendingFilter)
+        self.pendingFilter = None
+
+        self.pages.clear()
+        self.asinRows = None
+        self.count = count
+        if rows:
+            self.checkNames(rows)
+            self.pages[0] = rows
+
+        self.endResetModel()
+
+    def setMaxRefreshRate(self, rate):
+        """Set the maximum number of times per second the model will be re-selected while listings are coming in."""
+        self.refreshTimer.setInterval(int(1000 / rate) if rate > 0 else 0)
+
+    @pyqtSlot()
+    def scheduleRefresh(self):
+        """Re-select the model once the refresh timer runs out. Further requests until then are coalesced."""
+        if not self.refreshTimer.isActive():
+            self.refreshTimer.start()
+
+    @pyqtSlot()
+    @pyqtSlot(str)
+    def reloadNames(self, table=None):
+        self.loadNames()
+        if self.count:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.count - 1, len(self.columns) - 1))
+
+    def loadNames(self):
+        """Read the names of all categories, product groups and merchants."""
+        for column, (table, name) in self.RELATIONS.items():
+            names = {}
+            q = QSqlQuery('SELECT {}, {} FROM {}'.format(column, name, table))
+            while q.next():
+                names[q.value(0)] = q.value(1)
+            self.names[column] = names
+
+    def whereClause(self, *conditions, filter=None):
+        filter = self.filter if filter is None else filter
+        conditions = ['({})'.format(c) for c in (filter,) + conditions if c]
+        return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    def orderClause(self, reverse=False):
+        descending = (self.sortOrder == Qt.DescendingOrder) != reverse
+        direction = ' DESC' if descending else ''
+        if self.sortColumn == 'rowid':
+            return ' ORDER BY rowid' + direction
+
+        return ' ORDER BY {0}{1}, rowid{1}'.format(self.sortColumn, direction)
+
+    def fetchRow(self, row):
+        """Return the values of ``row``, loading it's page if necessary."""
+        if not 0 <= row < self.count:
+            return None
+
+        number, offset = divmod(row, self.pagesize)
+        page = self.pages.get(number)
+        if page is None:
+            page = self.fetchPage(number)
+        else:
+            self.pages.move_to_end(number)
+
+        return page[offset] if offset < len(page) else None
+
+    def fetchPage(self, number):
+        """Load page ``number``. If the page before or after it is loaded, continue from it's first or last row on the
+        sort column's index instead of counting rows from the start."""
+        select = 'SELECT {}, rowid FROM Products'.format(', '.join(self.columns))
+        expected = min(self.pagesize, self.count - number * self.pagesize)
+        sortindex = -1 if self.sortColumn == 'rowid' else self.columns.index(self.sortColumn)
+        ascending = self.sortOrder == Qt.AscendingOrder
+        rows = None
+
+        for neighbour, forward in [(number - 1, True), (number + 1, False)]:
+            page = self.pages.get(neighbour)
+            if not page:
+                continue
+
+            key = page[-1] if forward else page[0]
+            if key[sortindex] is None:
+                continue
+
+            # Rows with a NULL sort value aren't matched, so fall back on an offset if they would have been needed
+            after = '>' if ascending == forward else '<'
+            if self.sortColumn == 'rowid':
+                condition = 'rowid {} ?'.format(after)
+                values = [key[-1]]
+            else:
+                condition = '({}, rowid) {} (?, ?)'.format(self.sortColumn, after)
+                values = [key[sortindex], key[-1]]
+
+            rows = self.query(select + self.whereClause(condition) + self.orderClause(not forward) + ' LIMIT ?',
+                              self.filterValues + values + [self.pagesize])
+            if len(rows) == expected:
+                if not forward:
+                    rows.reverse()
+                break
+
+            rows = None
+
+        if rows is None:
+            rows = self.query(select + self.whereClause() + self.orderClause() + ' LIMIT ? OFFSET ?',
+                              self.filterValues + [self.pagesize, number * self.pagesize])
+
+        self.checkNames(rows)
+
+        self.pages[number] = rows
+        while len(self.pages) > self.maxpages:
+            self.pages.popitem(last=False)
+        self.asinRows = None
+
+        return rows
+
+    def checkNames(self, rows):
+        """Pick up any merchants or product groups added since the names were loaded."""
+        for column in self.RELATIONS:
+            index = self.columns.index(column)
+            if any(row[index] is not None and row[index] not in self.names[column] for row in rows):
+                self.loadNames()
+                break
+
+    def query(self, statement, values, width=None):
+        """Run ``statement`` and return it's rows as lists. Rows are ``width`` values long, by default a full row of
+        Products plus the rowid."""
+        # Statements are prepared once and reused; the filter and sort only change between selects
+        q = self.statements.pop(statement, None)
+        if q is None:
+            q = QSqlQuery()
+            q.setForwardOnly(True)
+            if not q.prepare(statement):
+                print('ProductsTableModel: Could not prepare query: ' + q.lastError().text())
+                return []
+
+        self.statements[statement] = q
+        while len(self.statements) > self.maxstatements:
+            self.statements.popitem(last=False)
+
+        for value in values:
+            q.addBindValue(value)
+
+        if not q.exec_():
+            print('ProductsTableModel: Could not fetch products: ' + q.lastError().text())
+
+        rows = readRows(q, width or len(self.columns) + 1)
+
+        q.finish()
+        return rows
+
+    def loadedRow(self, asin):
+        """Return the row number and values of ``asin`` if it's on a loaded page, or (-1, None)."""
+        if self.asinRows is None:
+            column = self.columns.index('Asin')
+            self.asinRows = {values[column]: number * self.pagesize + offset
+                             for number, page in self.pages.items() for offset, values in enumerate(page)}
+
+        row = self.asinRows.get(asin, -1)
+        if row < 0:
+            return -1, None
+
+        number, offset = divmod(row, self.pagesize)
+        return row, self.pages[number][offset]
+
+    def rowForAsin(self, asin):
+        """Return the row holding ``asin``, or -1 if it doesn't match the filter."""
+        row, values = self.loadedRow(asin)
+        if row >= 0:
+            return row
+
+        rows = self.query('SELECT {}, rowid FROM Products'.format(self.sortColumn) + self.whereClause('Asin=?'),
+                          self.filterValues + [asin], 2)
+        if not rows:
+            return -1
+
+        value, rowid = rows[0]
+        ascending = self.sortOrder == Qt.AscendingOrder
+
+        # Count the rows sorted before it. NULLs sort before everything else.
+        if self.sortColumn == 'rowid':
+            condition, values = 'rowid {} ?'.format('<' if ascending else '>'), [rowid]
+        elif value is None:
+            condition = '{0} IS NULL AND rowid < ?' if ascending else '{0} IS NOT NULL OR rowid > ?'
+            condition, values = condition.format(self.sortColumn), [rowid]
         else:
-            privatelabel = False
+            condition = '{0} IS NULL OR ({0}, rowid) < (?, ?)' if ascending else '({0}, rowid) > (?, ?)'
+            condition, values = condition.format(self.sortColumn), [value, rowid]
+
+        rows = self.query('SELECT COUNT(*) FROM Products' + self.whereClause(condition), self.filterValues + values, 1)
+        return rows[0][0] if rows else -1
+
+    @pyqtSlot(list)
+    def refreshListings(self, asins, batchsize=500):
+        """Update the loaded rows for ``asins`` in place, reading them ``batchsize`` at a time. If any of them aren't
+        loaded, schedule a full refresh."""
+        loaded = {}
+        for asin in asins:
+            row, values = self.loadedRow(asin)
+            if row < 0:
+                self.scheduleRefresh()
+            else:
+                loaded[asin] = (row, values)
 
-        time = QDateTime.currentDateTimeUtc().toTime_t()
+        if not loaded:
+            return
 
-        q.prepare(
-            'INSERT OR REPLACE INTO Products(Tracking, CRank, Timestamp, Asin, ProductGroupId, CategoryId, SalesRank, Offers,'
-            'Prime, Price, MerchantId, Title, Url, PrivateLabel, Manufacturer, PartNumber, Weight, ItemLength,'
-            'ItemWidth, ItemHeight, MyPrice, MyCost, FBAFees, MonthlyVolume, UPC) '
-            'VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        column = self.columns.index('Asin')
+        asins = list(loaded)
 
-        fields = [tracking, crank, time, listing.asin, productgroupId, categoryId, listing.salesrank, listing.offers,
-                  listing.prime, listing.price, merchantId, listing.title, listing.url, privatelabel,
-                  listing.make, listing.model, listing.weight / 100, listing.length / 100,
-                  listing.width / 100, listing.height / 100, myprice, mycost, fbafees, monthlyvolume, listing.upc]
+        for start in range(0, len(asins), batchsize):
+            batch = asins[start:start + batchsize]
+            rows = self.query('SELECT {}, rowid FROM Products WHERE Asin IN ({})'.format(
+                ', '.join(self.columns), ', '.join('?' * len(batch))), batch)
 
-        for field in fields:
-            q.addBindValue(field)
+            for values in rows:
+                row, old = loaded[values[column]]
+                old[:] = values
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.columns) - 1))
 
-        q.exec_()
 
-        if q.lastError().type() != QSqlError.NoError:
-            print('Could not insert record: ' + q.lastError().text())
+class ProductDetailModel(QAbstractTableModel):
+    """A single product, for the detail panel. Products on the pages ``products``, a ProductsTableModel, has loaded
+    are copied from there, and any others are read with one prepared query. Either way they are kept in an LRU cache
+    of ``cachesize`` records, so moving back and forth through the products table doesn't go to the database. Columns
+    and names are shared with ``products``."""
 
-        self.select()
+    edited = pyqtSignal(list)
+
+    def __init__(self, products, parent=None, cachesize=256):
+        super(ProductDetailModel, self).__init__(parent)
+
+        self.products = products
+        self.cachesize = cachesize
+        self.records = OrderedDict()    # Asin -> values, least recently used first
+        self.asin = None
+        self.values = [None] * (len(products.columns) + 1)
+
+        self.fetchQuery = QSqlQuery()
+        self.fetchQuery.setForwardOnly(True)
+        self.fetchQuery.prepare('SELECT {}, rowid FROM Products WHERE Asin=?'.format(', '.join(products.columns)))
+
+    def fieldIndex(self, name):
+        return self.products.fieldIndex(name)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.products.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+
+        column = self.products.columns[index.column()]
+        value = self.values[index.column()]
+        if column in self.products.RELATIONS:
+            return self.products.names[column].get(value)
+
+        return value
+
+    def flags(self, index):
+        return super(ProductDetailModel, self).flags(index) | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Write an edit to the database, unless it doesn't change anything. Categories are edited by name."""
+        if role != Qt.EditRole or self.asin is None:
+            return False
+
+        column = self.products.columns[index.column()]
+        if column == 'CategoryId':
+            ids = [id for id, name in self.products.names[column].items() if name == value]
+            if not ids:
+                return False
+            value = ids[0]
+        elif column in self.products.RELATIONS or column == 'Asin':
+            return False
+
+        if sameValue(self.values[index.column()], value):
+            return True
+
+        q = QSqlQuery()
+        q.prepare('UPDATE Products SET {}=? WHERE Asin=?'.format(column))
+        q.addBindValue(value)
+        q.addBindValue(self.asin)
+        if not q.exec_():
+            print('ProductDetailModel: Could not update {}: {}'.format(column, q.lastError().text()))
+            return False
+
+        self.values[index.column()] = value
+        self.dataChanged.emit(index, index)
+        self.edited.emit([self.asin])
+        return True
+
+    def fetch(self, asin):
+        """Return the values of ``asin``, from the cache or the products table's loaded pages if possible."""
+        values = self.records.pop(asin, None)
+
+        if values is None:
+            row, values = self.products.loadedRow(asin)
+            values = list(values) if values is not None else None
+
+        if values is None:
+            self.fetchQuery.addBindValue(asin)
+            if not self.fetchQuery.exec_():
+                print('ProductDetailModel: Could not fetch product: ' + self.fetchQuery.lastError().text())
+
+            rows = readRows(self.fetchQuery, len(self.products.columns) + 1)
+            self.fetchQuery.finish()
+            if not rows:
+                return None
+
+            self.products.checkNames(rows)
+            values = rows[0]
+
+        self.records[asin] = values
+        while len(self.records) > self.cachesize:
+            self.records.popitem(last=False)
+
+        return values
+
+    def setProduct(self, asin):
+        """Show the product ``asin``."""
+        values = self.fetch(asin) if asin else None
+        self.asin = asin if values is not None else None
+        self.values = list(values) if values is not None else [None] * (len(self.products.columns) + 1)
+
+        self.dataChanged.emit(self.index(0, 0), self.index(0, len(self.products.columns) - 1))
+
+    @pyqtSlot(list)
+    def invalidate(self, asins):
+        """Drop cached records for ``asins``. If the product being shown is among them, show it again."""
+        for asin in asins:
+            self.records.pop(asin, None)
+
+        if self.asin in asins:
+            self.setProduct(self.asin)
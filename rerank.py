@@ -0,0 +1,110 @@
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import applyDatabaseProfile
+from scoring import computeScores, writeScores
+
+
+class ScoreUpdater(QThread):
+    """Recomputes the registered scores in the background. A full pass is needed after a category's MaxRank or a
+    product group's category has changed, or a score has been added; single products are rescored after the user edits
+    their price, cost, fees or volume. Only the rows whose scores actually changed are written back, in chunks."""
+
+    progress = pyqtSignal(int, int)
+    message = pyqtSignal(str)
+    scored = pyqtSignal(list)
+    catalogScored = pyqtSignal()
+
+    def __init__(self, filename, profile=None, connection='rerank', chunksize=20000, parent=None):
+        super(ScoreUpdater, self).__init__(parent)
+
+        self.filename = filename
+        self.profile = profile
+        self.connection = connection
+        self.chunksize = chunksize
+        self.everything = False
+        self.pending = set()
+        self.mutex = QMutex()
+
+        # Pick up any requests that came in while the connection was being closed
+        self.finished.connect(self._start)
+
+    @pyqtSlot()
+    def rescoreAll(self):
+        """Rescore every product. If a pass is already running, run another one after it."""
+        self.mutex.lock()
+        self.everything = True
+        self.mutex.unlock()
+        self._start()
+
+    @pyqtSlot(list)
+    def rescore(self, asins):
+        """Rescore ``asins`` in the background."""
+        self.mutex.lock()
+        self.pending.update(asins)
+        self.mutex.unlock()
+        self._start()
+
+    @pyqtSlot()
+    def _start(self):
+        self.mutex.lock()
+        waiting = self.everything or bool(self.pending)
+        self.mutex.unlock()
+
+        if waiting and not self.isRunning():
+            self.start(self.LowPriority)
+
+    def run(self):
+        db = QSqlDatabase.addDatabase('QSQLITE', self.connection)
+        db.setDatabaseName(self.filename)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT=5000')
+
+        if db.open():
+            applyDatabaseProfile(db, self.profile)
+
+            while True:
+                self.mutex.lock()
+                everything, self.everything = self.everything, False
+                asins, self.pending = self.pending, set()
+                self.mutex.unlock()
+
+                if everything:
+                    self._rescore(db, None)
+                    self.catalogScored.emit()
+                elif asins:
+                    self._rescore(db, sorted(asins))
+                else:
+                    break
+
+            db.close()
+        else:
+            self.message.emit('Could not open database to update scores: ' + db.lastError().text())
+
+        del db
+        QSqlDatabase.removeDatabase(self.connection)
+
+    def _rescore(self, db, asins):
+        catalog, scores, changed = computeScores(db, asins)
+
+        total = len(changed)
+        if asins is None:
+            self.progress.emit(0, total)
+
+        for start in range(0, total, self.chunksize):
+            rows = changed[start:start + self.chunksize]
+
+            db.transaction()
+            err = writeScores(db, catalog, scores, rows)
+
+            if err.type() != QSqlError.NoError or not db.commit():
+                self.message.emit('Could not update scores: ' + (err.text() or db.lastError().text()))
+                db.rollback()
+                return
+
+            if asins is None:
+                self.progress.emit(min(start + self.chunksize, total), total)
+
+        if asins is None:
+            self.message.emit('Scores updated for {:,} products.'.format(total))
+        elif total:
+            self.scored.emit([catalog['Asin'][row] for row in changed])
@@ -0,0 +1,162 @@
+import numpy as np
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+
+class Score(object):
+    """A named score, stored in it's own indexed column of Products. ``function`` is called with one NumPy array per
+    name in ``inputs`` (columns of Products, or the category's MaxRank) and returns an array of scores."""
+
+    def __init__(self, name, column, function, inputs, sqltype='FLOAT'):
+        self.name = name
+        self.column = column
+        self.function = function
+        self.inputs = inputs
+        self.sqltype = sqltype
+
+
+# The registered scores, in the order they are computed
+SCORES = []
+
+
+def registerScore(name, column, function, inputs, sqltype='FLOAT'):
+    """Add a score to be computed for every product. Replaces any score already stored in ``column``."""
+    SCORES[:] = [score for score in SCORES if score.column != column]
+    SCORES.append(Score(name, column, function, inputs, sqltype))
+
+
+def listingRanks(maxrank, salesrank, offers, prime):
+    """Return an int64 array of ranks based on the category's MaxRank, sales rank, number of offers, and Prime
+    availability."""
+    maxrank = np.asarray(maxrank, dtype=np.float64)
+    offers = np.asarray(offers, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crank = np.asarray(salesrank, dtype=np.float64) * 100000 / maxrank
+        crank *= np.where(np.asarray(prime, dtype=bool), offers + 1, 1.25 ** offers)
+
+    return np.where(maxrank > 0, crank, 0).astype(np.int64)
+
+
+def listingProfits(price, myprice, mycost, fees):
+    """Profit per unit sold, at the user's price if one is set and otherwise at the current price."""
+    return np.where(myprice > 0, myprice, price) - mycost - fees
+
+
+def listingVelocities(volume, offers):
+    """Monthly sales volume per seller, including ourselves."""
+    return volume / (offers + 1)
+
+
+registerScore('CRank', 'CRank', listingRanks, ['MaxRank', 'SalesRank', 'Offers', 'Prime'], 'INT')
+registerScore('Profit', 'Profit', listingProfits, ['Price', 'MyPrice', 'MyCost', 'FBAFees'])
+registerScore('Velocity', 'Velocity', listingVelocities, ['MonthlyVolume', 'Offers'])
+
+
+def ensureScoreColumns(db):
+    """Add a column and index for any registered score that doesn't have them yet. Returns the columns added."""
+    q = QSqlQuery(db)
+    record = db.record('Products')
+    added = []
+
+    for score in SCORES:
+        if record.indexOf(score.column) < 0:
+            q.exec_('ALTER TABLE Products ADD COLUMN {} {}'.format(score.column, score.sqltype))
+            added.append(score.column)
+
+        q.exec_('CREATE INDEX IF NOT EXISTS Products_{0} ON Products({0})'.format(score.column))
+
+    return added
+
+
+def readCatalog(db, asins=None, batchsize=500, chunksize=100000):
+    """Read the score inputs and current scores of ``asins``, or of every product. Returns a dict of column name ->
+    NumPy array, plus 'Asin' as a list. NULLs are read as 0, except for a NULL Timestamp, which is read as NaN.
+
+    Each column of up to ``chunksize`` products is read as a single comma-separated string with group_concat(), so the
+    cost per product is in SQLite and NumPy rather than in a QSqlQuery.value() call per cell."""
+    columns = ['rowid', 'Timestamp']
+    for score in SCORES:
+        columns += [name for name in score.inputs + [score.column] if name not in columns]
+
+    # group_concat() skips NULLs, so every column needs a value in every row to keep them lined up
+    expressions = ['Products.rowid'] + ["IFNULL(Timestamp, 'nan')"] + \
+                  ['IFNULL({}, 0)'.format(name) for name in columns[2:]]
+    inner = 'SELECT Asin, {} FROM Products LEFT OUTER JOIN (SELECT CategoryId, MaxRank FROM Categories) ' \
+            'USING (CategoryId) WHERE Products.rowid>?{{}} ORDER BY Products.rowid LIMIT ?'.format(
+                ', '.join('{} AS c{}'.format(expression, i) for i, expression in enumerate(expressions)))
+    select = 'SELECT count(*), group_concat(Asin), {} FROM ({})'.format(
+        ', '.join('group_concat(c{})'.format(i) for i in range(len(columns))), inner)
+
+    q = QSqlQuery(db)
+    q.setForwardOnly(True)
+
+    if asins is None:
+        batches = [[]]
+    else:
+        batches = [asins[start:start + batchsize] for start in range(0, len(asins), batchsize)]
+
+    names, chunks = [], []
+    for batch in batches:
+        q.prepare(select.format(' AND Asin IN ({})'.format(', '.join('?' * len(batch))) if batch else ''))
+        last = -2 ** 63
+
+        while True:
+            q.addBindValue(last)
+            for asin in batch:
+                q.addBindValue(asin)
+            q.addBindValue(chunksize)
+            q.exec_()
+
+            if not q.next() or not q.value(0):
+                break
+
+            names += q.value(1).split(',')
+            chunks.append(np.array([q.value(column).split(',') for column in range(2, len(columns) + 2)],
+                                   dtype=np.float64))
+            q.finish()
+
+            last = int(chunks[-1][0][-1])
+            if chunks[-1].shape[1] < chunksize:
+                break
+
+    values = np.concatenate(chunks, axis=1) if chunks else np.empty((len(columns), 0))
+    catalog = dict(zip(columns, values))
+    catalog['Asin'] = names
+    return catalog
+
+
+def computeScores(db, asins=None):
+    """Compute every registered score for ``asins``, or for every product. Returns the catalog as read by
+    readCatalog(), a dict of column -> new scores, and the indices of the products whose scores changed."""
+    catalog = readCatalog(db, asins)
+    scores = {}
+    changed = np.zeros(len(catalog['Asin']), dtype=bool)
+
+    for score in SCORES:
+        values = np.asarray(score.function(*[catalog[name] for name in score.inputs]))
+        scores[score.column] = values
+        # Stored floats come back through text, so only count differences beyond the last couple of digits
+        changed |= ~np.isclose(values, catalog[score.column], rtol=1e-12, atol=0)
+
+    return catalog, scores, np.flatnonzero(changed)
+
+
+def writeScores(db, catalog, scores, rows):
+    """Store the new ``scores`` of the products at indices ``rows`` of ``catalog``. A product that has been updated
+    since the catalog was read is skipped, as it's scores were recomputed when it was written. Returns a QSqlError."""
+    if not len(rows):
+        return QSqlError()
+
+    q = QSqlQuery(db)
+    q.prepare('UPDATE Products SET {} WHERE rowid=? AND Timestamp IS ?'.format(
+        ', '.join('{}=?'.format(score.column) for score in SCORES)))
+
+    for score in SCORES:
+        q.addBindValue(scores[score.column][rows].tolist())
+    q.addBindValue(catalog['rowid'][rows].astype(np.int64).tolist())
+    q.addBindValue([None if np.isnan(time) else int(time) for time in catalog['Timestamp'][rows].tolist()])
+
+    q.execBatch()
+    return q.lastError()
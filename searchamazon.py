@@ -53,7 +53,7 @@ class AmzLookupRequest:
 
 class AmazonSearchEngine(QThread):
 
-    listingReady = pyqtSignal(ListingData)
+    listingsReady = pyqtSignal(list)
     finished = pyqtSignal()
     message = pyqtSignal(str)
 
@@ -67,6 +67,7 @@ class AmazonSearchEngine(QThread):
         self.mutex = QMutex()
         self.condition = QWaitCondition()
         self.responsegroups = 'ItemAttributes,OfferFull,SalesRank,Variations'
+        self.lookupbatchsize = 10                               # ItemLookup accepts up to 10 ItemIds per request
         self.bottlenose = bottlenose.Amazon(config['access_key'], config['secret_key'], config['associate_tag'],
                                             Parser=objectify.fromstring, MaxQPS=0.9)
 
@@ -122,23 +123,35 @@ class AmazonSearchEngine(QThread):
                 self.finished.emit()
 
 
-    def _item_lookup(self, op, parent=None):
-        for asin in op.asins:
+    def _item_lookup(self, op, parents=None):
+        """Look up the ASINs in ``op`` in batches of up to ``self.lookupbatchsize`` items per request. ``parents``
+        optionally maps an ASIN to the parent item it is a variation of."""
+        asins = list(op.asins)
+
+        for start in range(0, len(asins), self.lookupbatchsize):
             if self.abort:
                 return
 
-            self.message.emit('Looking up {}...'.format(asin))
+            batch = asins[start:start + self.lookupbatchsize]
+            self.message.emit('Looking up {}...'.format(', '.join(batch)))
 
             try:
-                response = self.bottlenose.ItemLookup(ErrorHandler=self._bottlenose_error_handler, ItemId=asin, ResponseGroup=self.responsegroups)
+                response = self.bottlenose.ItemLookup(ErrorHandler=self._bottlenose_error_handler, ItemId=','.join(batch),
+                                                      ResponseGroup=self.responsegroups)
             except Exception as e:
                 self.message.emit(repr(e))
                 continue
 
-            if not self._validate(response):
+            # Errors in a batched lookup usually refer to a single ItemId, so keep whatever items did come back
+            if not self._validate(response, partial=True):
                 continue
 
-            self._process(response, parent)
+            returned = {str(item.ASIN) for item in getattr(response.Items, 'Item', [])}
+            for asin in batch:
+                if asin not in returned:
+                    self.message.emit('No data returned for {}.'.format(asin))
+
+            self._process(response, parents)
 
     def _item_search(self, op):
         for index in op.searchindexes:
@@ -173,7 +186,9 @@ class AmazonSearchEngine(QThread):
                 self._process(response)
 
 
-    def _validate(self, response):
+    def _validate(self, response, partial=False):
+        """Report any errors in ``response``. If ``partial`` is True, a response that has errors but still
+        contains some items is considered valid."""
         if response is None:
             return False
 
@@ -181,24 +196,37 @@ class AmazonSearchEngine(QThread):
         if errors:
             for error in errors:
                 self.message.emit(error.Code + ': ' + error.Message)
-            return False
+
+            if not (partial and hasattr(getattr(response, 'Items', None), 'Item')):
+                return False
 
         return True
 
-    def _process(self, response, parent=None):
+    def _process(self, response, parents=None):
+        listings = []
+        children = {}
+
         for item in response.Items.Item:
             if self.abort:
-                return
+                break
 
-            # Check if this is actually a parent listing. If so, do a sub-search to get the children
+            # Check if this is actually a parent listing. If so, collect it's children for a batched sub-search
             parentASIN = str(getattr(item, 'ParentASIN', None))
             if parentASIN == item.ASIN:
-                children = [str(asin) for asin in item.xpath('./aws:Variations/aws:Item/aws:ASIN', namespaces={'aws': item.nsmap.get(None)})]
-                self._item_lookup(AmzLookupRequest(children), item)
+                for asin in item.xpath('./aws:Variations/aws:Item/aws:ASIN', namespaces={'aws': item.nsmap.get(None)}):
+                    children[str(asin)] = item
             else:
+                parent = parents.get(str(item.ASIN)) if parents else None
                 data = self._dataFromXml(item, parent)
                 if data:
-                    self.listingReady.emit(data)
+                    listings.append(data)
+
+        # Hand off everything from this response as one batch
+        if listings:
+            self.listingsReady.emit(listings)
+
+        if children and not self.abort:
+            self._item_lookup(AmzLookupRequest(list(children)), children)
 
     def _dataFromXml(self, item, parent=None):
         self.scanned += 1
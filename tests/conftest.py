@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def db(app, tmp_path):
+    """An empty database file, open on the default connection."""
+    database = QSqlDatabase.addDatabase('QSQLITE')
+    database.setDatabaseName(str(tmp_path / 'products.db'))
+    assert database.open(), database.lastError().text()
+
+    yield database
+
+    name = database.connectionName()
+    database.close()
+    del database
+    QSqlDatabase.removeDatabase(name)
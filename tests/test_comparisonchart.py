@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from PyQt5.QtSql import *
+
+from comparisonchart import ComparisonRequest
+from historystore import HistoryStore
+from initdb import setupDatabaseTables
+
+
+@pytest.fixture
+def history(db):
+    """A migrated database where A1 has two runs of observations and a single one, and A2 has one run."""
+    assert not setupDatabaseTables().isValid()
+
+    q = QSqlQuery(db)
+    q.prepare('INSERT INTO ProductHistory(Asin, Timestamp, ValidUntil, SalesRank, Price) VALUES(?, ?, ?, ?, ?)')
+    for values in [('A1', 1000, 500000, 10, 9.5), ('A1', 600000, 900000, 20, 8.0), ('A1', 950000, None, 30, 7.0),
+                   ('A2', 2000, 3000, 5, 1.0)]:
+        for value in values:
+            q.addBindValue(value)
+        assert q.exec_(), q.lastError().text()
+
+    return db
+
+
+def test_runs(history):
+    """Each run gives a point at it's start and one at it's end, and a single observation just one point."""
+    request = ComparisonRequest(1, ['A1', 'A2'])
+    request.load(history)
+
+    assert list(request.ranks['A1'].time) == [1000000, 500000000, 600000000, 900000000, 950000000]
+    assert list(request.ranks['A1'].value) == [10, 10, 20, 20, 30]
+    assert list(request.prices['A1'].value) == [9.5, 9.5, 8.0, 8.0, 7.0]
+    assert list(request.ranks['A2'].time) == [2000000, 3000000]
+
+
+def test_store(history, tmp_path):
+    """History older than the store comes from the database, with the run that reaches into the store cut short."""
+    store = HistoryStore(str(tmp_path / 'history'))
+    store.append('A1', 700000, 20, 8.0, 1)
+    store.append('A1', 950000, 30, 7.0, 1)
+
+    request = ComparisonRequest(1, ['A1', 'A2'])
+    request.load(history, store)
+
+    assert list(request.ranks['A1'].time) == [1000000, 500000000, 600000000, 700000000, 700000000, 950000000]
+    assert np.all(np.diff(request.ranks['A1'].time) >= 0)
+    assert list(request.ranks['A2'].time) == [2000000, 3000000]
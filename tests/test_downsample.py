@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from downsample import MinMaxPyramid
+
+
+def bruteForce(time, value, width):
+    """Return (ids, tmin, vmin, tmax, vmax) for buckets of ``width``, computed one bucket at a time."""
+    ids = (time // width).astype(np.int64)
+    summary = []
+    for bucket in np.unique(ids):
+        t, v = time[ids == bucket], value[ids == bucket]
+        if np.isnan(v).all():
+            summary.append((bucket, t[0], np.nan, t[0], np.nan))
+        else:
+            low, high = np.nanmin(v), np.nanmax(v)
+            summary.append((bucket, t[v == low][0], low, t[v == high][0], high))
+    return tuple(np.array(column) for column in zip(*summary))
+
+
+def series(seed, n=3000):
+    rng = np.random.RandomState(seed)
+    time = np.cumsum(rng.randint(1, 90000, n)).astype(float) + 1.6e12
+    value = rng.randint(0, 50, n).astype(float)
+    value[rng.rand(n) < 0.1] = np.nan
+    return time, value
+
+
+def assertMatchesBruteForce(pyramid, time, value):
+    assert np.array_equal(pyramid.time, time)
+    assert np.array_equal(pyramid.value, value, equal_nan=True)
+    assert len(pyramid.levels[-1][0]) == 1
+
+    for depth, level in enumerate(pyramid.levels):
+        expected = bruteForce(time, value, pyramid.bucketWidth(depth))
+        for actual, wanted in zip(level, expected):
+            assert np.array_equal(actual, wanted, equal_nan=True), 'level {}'.format(depth)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_buildLevels(seed):
+    time, value = series(seed)
+    pyramid = MinMaxPyramid()
+    pyramid.extend(time, value)
+    assertMatchesBruteForce(pyramid, time, value)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_join(seed):
+    """Chunks added at either end, including ones sharing a bucket with the series, give the same levels as building
+    from the whole series at once."""
+    time, value = series(seed)
+    cuts = np.sort(np.random.RandomState(seed).choice(np.arange(1, len(time)), 12, replace=False))
+    chunks = np.split(np.arange(len(time)), cuts)
+
+    pyramid = MinMaxPyramid()
+    middle = len(chunks) // 2
+    pyramid.extend(time[chunks[middle]], value[chunks[middle]])
+    for older, newer in zip(chunks[middle - 1::-1], chunks[middle + 1:]):
+        pyramid.extend(time[older], value[older])
+        pyramid.extend(time[newer], value[newer])
+
+    assertMatchesBruteForce(pyramid, time, value)
+
+
+def test_join_leaves_copy_alone():
+    time, value = series(0)
+    pyramid = MinMaxPyramid()
+    pyramid.extend(time[1000:], value[1000:])
+
+    copy = pyramid.copy()
+    copy.extend(time[:1000], value[:1000])
+
+    assertMatchesBruteForce(pyramid, time[1000:], value[1000:])
+    assertMatchesBruteForce(copy, time, value)
+
+
+def test_extent():
+    time, value = series(1)
+    pyramid = MinMaxPyramid()
+    assert pyramid.extent() is None
+
+    pyramid.extend(time, value)
+    assert pyramid.extent() == (time[0], time[-1], np.nanmin(value), np.nanmax(value))
+
+
+@pytest.mark.parametrize('budget', [50, 200, 1000, 5000])
+def test_points(budget):
+    """Points stay within about the budget, are in time order, and keep the extremes of the range. Buckets at the ends
+    of the range may have their extremes outside it, so those are compared with all the points returned."""
+    time, value = series(2)
+    pyramid = MinMaxPyramid()
+    pyramid.extend(time, value)
+
+    lo, hi = time[500], time[2500]
+    x, y = pyramid.points(lo, hi, budget)
+    assert len(x) <= budget + 4
+    assert np.all(np.diff(x) >= 0)
+
+    inside = (time >= lo) & (time <= hi)
+    assert np.nanmin(y) <= np.nanmin(value[inside])
+    assert np.nanmax(y) >= np.nanmax(value[inside])
+
+    if pyramid.count(lo, hi) <= budget:
+        assert np.array_equal(x[1:-1], time[inside])
@@ -0,0 +1,97 @@
+import pytest
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from filters import ALL_RESULTS, LAST_SEARCH, TRACKED, FilterCompiler
+from initdb import setupDatabaseTables
+
+
+# Asin, title, merchant, category, timestamp, tracking, prime, private label, CRank, offers, price
+PRODUCTS = [
+    ('A1', 'Stainless garlic press', 'Acme', 'Kitchen', 100, 0, 1, 0, 5, 2, 9.5),
+    ('A2', 'Garlic peeler', 'Amazon.com', 'Kitchen', 200, 1, 1, 0, 0, 8, 3.0),
+    ('A3', 'Lemon squeezer', 'Acme', 'Grocery', 300, 0, 0, 1, 12, 1, 4.25),
+    ('A4', 'Garlic keeper jar', 'Widgets Inc', 'Grocery', 400, 2, 0, 0, 30, 5, 15.0),
+    ('A5', 'Cast iron skillet', 'Amazon Warehouse', 'Kitchen', 500, 0, 1, 1, 7, 3, 25.0),
+]
+
+
+@pytest.fixture
+def products(db):
+    assert not setupDatabaseTables().isValid()
+
+    q = QSqlQuery(db)
+    assert q.exec_("INSERT INTO Categories(CategoryName, Restricted) VALUES('Kitchen', 0), ('Grocery', 1)")
+    for asin, title, merchant, category, timestamp, tracking, prime, privatelabel, crank, offers, price in PRODUCTS:
+        q.prepare('INSERT OR IGNORE INTO Merchants(MerchantName) VALUES(?)')
+        q.addBindValue(merchant)
+        assert q.exec_()
+
+        q.prepare('INSERT INTO Products(Asin, Title, MerchantId, CategoryId, Timestamp, Tracking, Prime, PrivateLabel, '
+                  'CRank, Offers, Price) VALUES(?, ?, (SELECT MerchantId FROM Merchants WHERE MerchantName=?), '
+                  '(SELECT CategoryId FROM Categories WHERE CategoryName=?), ?, ?, ?, ?, ?, ?, ?)')
+        for value in [asin, title, merchant, category, timestamp, tracking, prime, privatelabel, crank, offers, price]:
+            q.addBindValue(value)
+        assert q.exec_(), q.lastError().text()
+
+    return db
+
+
+def matching(db, clause, values):
+    q = QSqlQuery(db)
+    q.prepare('SELECT Asin FROM Products' + (' WHERE ' + clause if clause else '') + ' ORDER BY Asin')
+    for value in values:
+        q.addBindValue(value)
+    assert q.exec_(), q.lastError().text()
+
+    asins = []
+    while q.next():
+        asins.append(q.value(0))
+    return asins
+
+
+@pytest.mark.parametrize('state, expected', [
+    ({}, ['A1', 'A2', 'A3', 'A4', 'A5']),
+    ({'date': ALL_RESULTS}, ['A1', 'A2', 'A3', 'A4', 'A5']),
+    ({'date': LAST_SEARCH, 'since': 300}, ['A3', 'A4', 'A5']),
+    ({'date': TRACKED}, ['A2', 'A4']),
+    ({'keywords': 'garlic'}, ['A1', 'A2', 'A4']),
+    ({'keywords': '"garlic press"'}, ['A1']),
+    ({'keywords': 'gar*', 'excludeKeywords': 'jar peeler'}, ['A1']),
+    ({'excludeKeywords': 'garlic'}, ['A3', 'A5']),
+    ({'prime': False}, ['A3', 'A4']),
+    ({'amazon': False}, ['A1', 'A3', 'A4']),
+    ({'privateLabel': False}, ['A1', 'A2', 'A4']),
+    ({'restricted': False}, ['A1', 'A2', 'A5']),
+    ({'zeroes': False}, ['A1', 'A3', 'A4', 'A5']),
+    ({'maxOffers': 3}, ['A1', 'A3', 'A5']),
+    ({'minPrice': 4.0, 'maxPrice': 20.0}, ['A1', 'A3', 'A4']),
+    ({'maxRank': 10}, ['A1', 'A2', 'A5']),
+    ({'maxOffers': 0, 'minPrice': 0, 'maxPrice': 0, 'maxRank': 0}, ['A1', 'A2', 'A3', 'A4', 'A5']),
+    ({'amazon': False, 'restricted': False, 'zeroes': False, 'keywords': 'garlic'}, ['A1']),
+])
+def test_compile(products, state, expected):
+    clause, values = FilterCompiler(products).compile(state)
+    assert clause.count('?') == len(values)
+    assert matching(products, clause, values) == expected
+
+
+def test_no_filter(products):
+    assert FilterCompiler(products).compile({}) == ('', [])
+
+
+def test_same_shape(products):
+    """Filters that differ only in their values compile to the same statement text, so it can be reused."""
+    compiler = FilterCompiler(products)
+    first = compiler.compile({'date': LAST_SEARCH, 'since': 100, 'keywords': 'garlic', 'maxPrice': 10.0})
+    second = compiler.compile({'date': LAST_SEARCH, 'since': 400, 'keywords': 'lemon', 'maxPrice': 20.0})
+
+    assert first[0] == second[0]
+    assert first[1] != second[1]
+
+
+def test_uses_indexes(products, capsys):
+    """With debugging on, the query plans are printed, and range filters search the index on their column."""
+    FilterCompiler(products, debug=True).compile({'maxRank': 10}, ' ORDER BY CRank')
+    assert 'USING INDEX Products_CRank' in capsys.readouterr().out
@@ -0,0 +1,100 @@
+from PyQt5.QtSql import *
+
+from initdb import MIGRATIONS, schemaVersion, setupDatabaseTables
+
+
+# The tables as the first release of initdb.py created them. Observations got a single 'MerchantIdPrice' column, and
+# Merchants a MerchantId that isn't an alias for the rowid.
+BASELINE_SCHEMA = [
+    'CREATE TABLE Products(Tracking INT DEFAULT 0, CRank INT, Timestamp INT, Asin VARCHAR PRIMARY KEY, '
+    'ProductGroupId INT, CategoryId INT DEFAULT 1,SalesRank INT, Offers INT, Prime BOOL, Price FLOAT, MerchantId INT, '
+    'Title VARCHAR, Url VARCHAR, PrivateLabel BOOL, Manufacturer VARCHAR, PartNumber VARCHAR, UPC INT, MyPrice FLOAT, '
+    'MyCost FLOAT,FBAFees FLOAT, MonthlyVolume INT, Weight FLOAT DEFAULT 0, ItemLength FLOAT DEFAULT 0, '
+    'ItemWidth FLOAT DEFAULT 0, ItemHeight FLOAT DEFAULT 0)',
+    'CREATE TABLE Categories(CategoryId INTEGER PRIMARY KEY, CategoryName VARCHAR UNIQUE, MaxRank INT DEFAULT 0, '
+    'Restricted BOOL, FtkToken VARCHAR)',
+    'CREATE TABLE ProductGroups(ProductGroupId INTEGER PRIMARY KEY, ProductGroupName VARCHAR UNIQUE, '
+    'CategoryId INT DEFAULT 1)',
+    'CREATE TABLE Merchants(MerchantId INT PRIMARY KEY, MerchantName VARCHAR UNIQUE NOT NULL)',
+    'CREATE TABLE Observations(Asin VARCHAR, Timestamp INT, SalesRank INT, Offers INT, Prime BOOL, '
+    'MerchantIdPrice FLOAT, FOREIGN KEY(Asin) REFERENCES Products(Asin) ON DELETE CASCADE)',
+]
+
+
+def run(db, statement, values=()):
+    q = QSqlQuery(db)
+    q.prepare(statement)
+    for value in values:
+        q.addBindValue(value)
+    assert q.exec_(), q.lastError().text()
+
+    rows = []
+    while q.next():
+        rows.append(tuple(q.value(i) for i in range(q.record().count())))
+    return rows
+
+
+def createBaseline(db):
+    for statement in BASELINE_SCHEMA:
+        run(db, statement)
+
+    run(db, "INSERT INTO Merchants(MerchantName) VALUES('Acme')")
+    for asin, title, timestamp, rank, price in [('A1', 'Stainless garlic press', 300, 10, 9.5),
+                                                ('A2', 'Lemon squeezer', 300, 20, 4.25)]:
+        run(db, 'INSERT INTO Products(Asin, Title, Timestamp, SalesRank, Offers, Prime, Price) '
+                'VALUES(?, ?, ?, ?, 1, 0, ?)', [asin, title, timestamp, rank, price])
+    for asin, timestamp, rank, price in [('A1', 100, 12, 9.0), ('A1', 200, 11, 9.25), ('A2', 100, 25, 4.0)]:
+        run(db, 'INSERT INTO Observations VALUES(?, ?, ?, 1, 0, ?)', [asin, timestamp, rank, price])
+
+
+def test_migrate_baseline(db):
+    createBaseline(db)
+
+    error = setupDatabaseTables()
+    assert not error.isValid(), error.text()
+    assert schemaVersion(db) == len(MIGRATIONS)
+
+    # Merchants have IDs, and products without one point at 'N/A'
+    merchants = dict(run(db, 'SELECT MerchantName, MerchantId FROM Merchants'))
+    assert set(merchants) == {'Acme', 'N/A'} and all(isinstance(i, int) for i in merchants.values())
+    assert run(db, 'SELECT DISTINCT MerchantId FROM Products') == [(merchants['N/A'],)]
+
+    # The old observations, with their prices recovered, and the current listings are all in the history
+    assert run(db, 'SELECT Asin, Timestamp, SalesRank, Price FROM ProductHistory ORDER BY Asin, Timestamp') == [
+        ('A1', 100, 12, 9.0), ('A1', 200, 11, 9.25), ('A1', 300, 10, 9.5), ('A2', 100, 25, 4.0), ('A2', 300, 20, 4.25)]
+    assert not run(db, "SELECT 1 FROM sqlite_master WHERE name='Observations'")
+
+    # Score columns are added empty, for the score updater to fill in
+    assert run(db, 'SELECT COUNT(*) FROM Products WHERE Profit IS NULL AND Velocity IS NULL') == [(2,)]
+    assert run(db, "SELECT Title FROM Products WHERE rowid IN "
+                   "(SELECT rowid FROM ProductsSearch WHERE ProductsSearch MATCH '\"gar\"*')") == \
+        [('Stainless garlic press',)]
+
+
+def test_migrate_again(db):
+    """Migrations already applied are skipped."""
+    createBaseline(db)
+    assert not setupDatabaseTables().isValid()
+
+    assert not setupDatabaseTables().isValid()
+    assert run(db, 'SELECT COUNT(*) FROM schema_version') == [(len(MIGRATIONS),)]
+    assert run(db, 'SELECT COUNT(*) FROM ProductHistory') == [(5,)]
+
+
+def test_history_runs(db):
+    """After migrating, unchanged observations extend the product's latest run and changed ones start a new one."""
+    createBaseline(db)
+    assert not setupDatabaseTables().isValid()
+
+    run(db, "UPDATE Products SET Timestamp=400 WHERE Asin='A1'")
+    run(db, "UPDATE Products SET Timestamp=500, SalesRank=8 WHERE Asin='A1'")
+    run(db, "UPDATE Products SET Timestamp=600 WHERE Asin='A1'")
+
+    assert run(db, "SELECT Timestamp, ValidUntil, SalesRank FROM ProductHistory WHERE Asin='A1' AND Timestamp>=300 "
+                   "ORDER BY Timestamp") == [(300, 400, 10), (500, 600, 8)]
+
+
+def test_new_database(db):
+    assert not setupDatabaseTables().isValid()
+    assert schemaVersion(db) == len(MIGRATIONS)
+    assert run(db, 'SELECT CategoryName FROM Categories') == [('Unknown',)]
@@ -0,0 +1,34 @@
+import pytest
+
+from fuzzywuzzy import fuzz
+
+from privatelabel import PrivateLabelClassifier, couldMatch
+
+
+@pytest.mark.parametrize('merchant, title, make, expected', [
+    ('Acme', 'Widget', 'Acme', True),
+    ('Acme Kitchen', 'Acme Kitchen garlic press', 'Generic', True),
+    ('Bob', 'Widget', 'Thing', False),
+    ('  ACME ', 'Widget', 'acme', True),
+])
+def test_isPrivateLabel(merchant, title, make, expected):
+    assert PrivateLabelClassifier().isPrivateLabel(merchant, title, make) == expected
+
+
+def test_cache():
+    """Makes are cached under their normalized pair, and titles aren't cached at all."""
+    classifier = PrivateLabelClassifier(cachesize=2)
+    classifier.isPrivateLabel('Acme ', 'Some title', 'acme')
+    classifier.isPrivateLabel('acme', 'Another title', ' ACME')
+    assert list(classifier.cache) == [('acme', 'acme')]
+
+    classifier.isPrivateLabel('Bob', 'Widget', 'Thing')
+    classifier.isPrivateLabel('Carol', 'Widget', 'Thing')
+    assert list(classifier.cache) == [('bob', 'thing'), ('carol', 'thing')]
+
+
+@pytest.mark.parametrize('a, b', [('acme', 'acme kitchen tools'), ('garlic press', 'stainless garlic press'),
+                                  ('bob', 'widget'), ('', 'widget')])
+def test_couldMatch(a, b):
+    """couldMatch never rules out a pair that partial_ratio would match."""
+    assert couldMatch(a, b) or not fuzz.partial_ratio(a, b) > 80
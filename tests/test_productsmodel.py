@@ -0,0 +1,128 @@
+import random
+
+import pytest
+
+from PyQt5.QtCore import *
+from PyQt5.QtSql import *
+
+from initdb import setupDatabaseTables
+from productsmodel import ProductsTableModel
+
+
+@pytest.fixture
+def products(db):
+    """A migrated database with 100 products. Ranks repeat, and every 9th product has none."""
+    assert not setupDatabaseTables().isValid()
+
+    q = QSqlQuery(db)
+    q.prepare('INSERT INTO Products(Asin, CRank, Price) VALUES(?, ?, ?)')
+    q.addBindValue(['B{:03d}'.format(i) for i in range(100)])
+    q.addBindValue([None if i % 9 == 0 else (i * 7) % 13 for i in range(100)])
+    q.addBindValue([float(i % 10) for i in range(100)])
+    assert q.execBatch(), q.lastError().text()
+    return db
+
+
+@pytest.fixture
+def model(products, monkeypatch):
+    """A model with small pages, which records the statements it runs in it's ``run`` list."""
+    model = ProductsTableModel(pagesize=7, maxpages=3)
+    model.run = []
+
+    query = model.query
+    monkeypatch.setattr(model, 'query', lambda statement, *args: model.run.append(statement) or query(statement, *args))
+    yield model
+
+    model.statements.clear()
+
+
+def expectedOrder(db, column, order, where=''):
+    q = QSqlQuery(db)
+    direction = ' DESC' if order == Qt.DescendingOrder else ''
+    q.exec_('SELECT Asin FROM Products{} ORDER BY {}{}, rowid{}'.format(where, column, direction, direction))
+
+    asins = []
+    while q.next():
+        asins.append(q.value(0))
+    return asins
+
+
+def shownOrder(model, rows):
+    column = model.columns.index('Asin')
+    return {row: model.fetchRow(row)[column] for row in rows}
+
+
+@pytest.mark.parametrize('column', ['CRank', 'Price', 'Asin'])
+@pytest.mark.parametrize('order', [Qt.AscendingOrder, Qt.DescendingOrder])
+def test_paging(products, model, column, order):
+    """Rows come out in the same order reading forwards, backwards or jumping about, with only a few pages loaded."""
+    model.sort(model.columns.index(column), order)
+    expected = expectedOrder(products, column, order)
+    assert model.rowCount() == len(expected)
+
+    rows = list(range(len(expected)))
+    shuffled = rows[:]
+    random.Random(0).shuffle(shuffled)
+
+    for walk in [rows, rows[::-1], shuffled]:
+        assert shownOrder(model, walk) == dict(enumerate(expected))
+        assert len(model.pages) <= model.maxpages
+
+
+def test_keyset(products, model):
+    """Pages next to a loaded one are read by keyset, except where the sort values are NULL."""
+    model.sort(model.columns.index('CRank'), Qt.AscendingOrder)
+    expected = expectedOrder(products, 'CRank', Qt.AscendingOrder)
+
+    model.run.clear()
+    assert shownOrder(model, range(len(expected))) == dict(enumerate(expected))
+
+    keyset = [statement for statement in model.run if '(CRank, rowid) > (?, ?)' in statement]
+    offset = [statement for statement in model.run if 'OFFSET' in statement]
+
+    # The first page is all products without a rank, so it has no key to continue from and the second needs an offset
+    assert len(model.run) == 15
+    assert len(offset) == 2 and len(keyset) == 13
+
+    # Going backwards continues from the page after
+    model.run.clear()
+    shownOrder(model, range(len(expected) - 1, -1, -1))
+    assert any('(CRank, rowid) < (?, ?)' in statement for statement in model.run)
+
+
+def test_filter(products, model):
+    model.setFilter('Price >= ?', [5.0])
+    model.select()
+
+    expected = expectedOrder(products, 'CRank', Qt.AscendingOrder, ' WHERE Price >= 5')
+    assert model.rowCount() == len(expected)
+    assert shownOrder(model, range(len(expected))) == dict(enumerate(expected))
+
+
+@pytest.mark.parametrize('order', [Qt.AscendingOrder, Qt.DescendingOrder])
+def test_rowForAsin(products, model, order):
+    """Rows are found without loading their pages."""
+    model.sort(model.columns.index('CRank'), order)
+
+    for row, asin in enumerate(expectedOrder(products, 'CRank', order)):
+        assert model.rowForAsin(asin) == row
+
+    assert model.rowForAsin('NOPE') == -1
+    assert not model.pages
+
+
+def test_refreshListings(products, model):
+    """Loaded rows are updated in place, a batch of ASINs at a time."""
+    model.maxpages = 100
+    asins = list(shownOrder(model, range(model.rowCount())).values())
+
+    q = QSqlQuery(products)
+    assert q.exec_('UPDATE Products SET Price = Price + 100')
+
+    model.run.clear()
+    model.refreshListings(asins, batchsize=30)
+
+    assert len(model.run) == 4 and all('Asin IN' in statement for statement in model.run)
+    price = model.columns.index('Price')
+    assert all(model.fetchRow(row)[price] >= 100 for row in range(model.rowCount()))
+    assert not model.refreshTimer.isActive()
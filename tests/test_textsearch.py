@@ -0,0 +1,67 @@
+import pytest
+
+from PyQt5.QtSql import *
+
+from textsearch import matchExpression
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('', ''),
+    ('   ', ''),
+    ('garlic press', '"garlic" "press"'),
+    ('"garlic press" steel', '"garlic press" "steel"'),
+    ('gar*', '"gar"*'),
+    ('"garlic pr"*', '"garlic pr"*'),
+    ('garlic - & press', '"garlic" "press"'),
+    ('"" garlic', '"garlic"'),
+])
+def test_terms(text, expected):
+    assert matchExpression(text) == expected
+
+
+def test_any():
+    assert matchExpression('garlic "lemon squeezer"', any=True) == '"garlic" OR "lemon squeezer"'
+    assert matchExpression('garlic', any=True) == '"garlic"'
+
+
+@pytest.fixture
+def search(db):
+    q = QSqlQuery(db)
+    assert q.exec_('CREATE VIRTUAL TABLE Search USING fts5(Title, prefix="2 3")')
+    for title in ['Stainless garlic press', 'Garlic peeler', 'Lemon squeezer', 'AND OR NOT gadget', 'title: tongs']:
+        q.prepare('INSERT INTO Search(Title) VALUES(?)')
+        q.addBindValue(title)
+        assert q.exec_()
+    return db
+
+
+def matching(db, expression):
+    q = QSqlQuery(db)
+    q.prepare('SELECT Title FROM Search WHERE Search MATCH ? ORDER BY rowid')
+    q.addBindValue(expression)
+    assert q.exec_(), q.lastError().text()
+
+    titles = []
+    while q.next():
+        titles.append(q.value(0))
+    return titles
+
+
+@pytest.mark.parametrize('text, any, expected', [
+    ('garlic', False, ['Stainless garlic press', 'Garlic peeler']),
+    ('garlic press', False, ['Stainless garlic press']),
+    ('"press garlic"', False, []),
+    ('"garlic press"', False, ['Stainless garlic press']),
+    ('gar*', False, ['Stainless garlic press', 'Garlic peeler']),
+    ('"garlic pr"*', False, ['Stainless garlic press']),
+    ('peeler lemon', True, ['Garlic peeler', 'Lemon squeezer']),
+    ('AND OR', False, ['AND OR NOT gadget']),
+    ('NOT', False, ['AND OR NOT gadget']),
+    ('title:', False, ['title: tongs']),
+    ('title:tongs', False, ['title: tongs']),
+    ('^garlic NEAR(lemon)', True, ['Stainless garlic press', 'Garlic peeler']),
+    ('say "hi', False, []),
+])
+def test_fts5_match(search, text, any, expected):
+    """Expressions are valid FTS5, and FTS5 operators and column filters typed by the user are searched for as words."""
+    assert matching(search, matchExpression(text, any=any)) == expected
@@ -0,0 +1,25 @@
+import re
+
+
+# A "quoted phrase", optionally followed by * for a prefix search, or a single word
+TERM = re.compile(r'"([^"]*)"(\*?)|(\S+)')
+
+
+def matchExpression(text, any=False):
+    """Turn keywords typed by the user into an FTS5 query on the ProductsSearch table. Words and "quoted phrases" must
+    all be present, or just one of them if ``any`` is True, and a trailing * makes a word or phrase a prefix. Every term
+    is quoted, so nothing the user types is taken as FTS5 syntax. Returns '' if there are no terms."""
+    terms = []
+
+    for phrase, star, word in TERM.findall(text):
+        if word:
+            phrase = word.rstrip('*')
+            star = '*' if word.endswith('*') else ''
+
+        # Terms without any letters or digits have no tokens to match
+        if not [c for c in phrase if c.isalnum()]:
+            continue
+
+        terms.append('"{}"{}'.format(phrase.replace('"', '""'), star))
+
+    return (' OR ' if any else ' ').join(terms)